@@ -0,0 +1,225 @@
+"""Deterministic synthetic clinic data, at the scale the design assumes (many
+patients, most of them with only closed history, and few open requests).
+
+The same config (and seed) always generates the same history, open tasks and
+task input stream, so benchmark runs are comparable.
+"""
+
+from datetime import datetime, timedelta, timezone
+from random import Random
+from typing import Generator
+from uuid import UUID
+
+from pydantic import BaseModel, Field
+
+from clinic_manager import ClinicManager
+from models import PatientRequest, PatientTask, TaskInput
+from models.patient_task import Medication
+
+BASE_DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+MEDICATIONS = [
+    Medication(code="ACET001", name="Acetaminophen 500 mg"),
+    Medication(code="IBU001", name="Ibuprofen 200 mg"),
+    Medication(code="LISI001", name="Lisinopril 10 mg"),
+    Medication(code="METR001", name="Metronidazole 0.75% gel"),
+    Medication(code="AMOX001", name="Amoxicillin 500 mg"),
+]
+
+
+class SyntheticConfig(BaseModel):
+    """The shape of the generated data. The rates of a task input batch (new,
+    close and move) are fractions of its tasks; the remaining tasks are updates
+    (a newer message) of open tasks."""
+
+    seed: int = 0
+    patient_count: int = Field(default=10_000, gt=0)
+    # The fraction of the patients that have open tasks to begin with
+    open_patient_ratio: float = Field(default=0.05, ge=0, le=1)
+    # The closed history of every patient
+    closed_requests_per_patient: int = Field(default=2, ge=0)
+    tasks_per_request: int = Field(default=3, gt=0)
+    department_weights: dict[str, float] = {
+        "Primary": 0.6,
+        "Dermatology": 0.25,
+        "Radiology": 0.15,
+    }
+    batch_count: int = Field(default=50, ge=0)
+    batch_size: int = Field(default=200, gt=0)
+    new_task_rate: float = Field(default=0.4, ge=0, le=1)
+    close_rate: float = Field(default=0.3, ge=0, le=1)
+    # Tasks that are reassigned to another department
+    move_rate: float = Field(default=0.1, ge=0, le=1)
+
+
+class SyntheticDataGenerator:
+    """Generates the history, the open tasks and the task input stream of a
+    SyntheticConfig. Call the methods in that order: the stream updates the
+    open tasks generated before it."""
+
+    def __init__(self, config: SyntheticConfig):
+        self.config = config
+        self.random = Random(config.seed)
+        self._departments = list(config.department_weights)
+        self._department_weights = list(config.department_weights.values())
+        self._clock = BASE_DATE
+        self._id_count = 0
+
+        # The open tasks by id, and their ids as a list to pick from in O(1)
+        self.open_tasks: dict[str, PatientTask] = {}
+        self._open_task_ids: list[str] = []
+        self._open_task_positions: dict[str, int] = {}
+
+    def history_batches(
+        self, patients_per_batch: int = 1000
+    ) -> Generator[tuple[list[dict], list[dict]], None, None]:
+        """Yields the closed history, as (task documents, request documents)
+        batches for write_batch, patients_per_batch patients at a time."""
+        task_docs, request_docs = [], []
+
+        for patient in range(self.config.patient_count):
+            patient_id = self._patient_id(patient)
+            for _ in range(self.config.closed_requests_per_patient):
+                department = self._department()
+                tasks = [
+                    self._task(patient_id, department, status="Closed")
+                    for _ in range(self.config.tasks_per_request)
+                ]
+                task_docs += [task.model_dump() for task in tasks]
+                request_docs.append(
+                    self._closed_request(patient_id, tasks).model_dump()
+                )
+
+            if (patient + 1) % patients_per_batch == 0:
+                yield task_docs, request_docs
+                task_docs, request_docs = [], []
+
+        if task_docs or request_docs:
+            yield task_docs, request_docs
+
+    def initial_open_tasks(self) -> list[PatientTask]:
+        """Returns the open tasks of the patients that have open requests to begin
+        with (every open request with tasks_per_request tasks)."""
+        open_patient_count = round(
+            self.config.patient_count * self.config.open_patient_ratio
+        )
+        patients = self.random.sample(
+            range(self.config.patient_count), open_patient_count
+        )
+
+        tasks = []
+        for patient in patients:
+            department = self._department()
+            for _ in range(self.config.tasks_per_request):
+                tasks.append(self._task(self._patient_id(patient), department))
+
+        for task in tasks:
+            self._set_open(task)
+        return tasks
+
+    def task_inputs(self) -> Generator[TaskInput, None, None]:
+        """Yields batch_count task inputs of batch_size modified tasks each."""
+        config = self.config
+        close_threshold = config.new_task_rate + config.close_rate
+        move_threshold = close_threshold + config.move_rate
+
+        for _ in range(config.batch_count):
+            tasks = []
+            for _ in range(config.batch_size):
+                roll = self.random.random()
+                if roll < config.new_task_rate or not self._open_task_ids:
+                    patient = self.random.randrange(config.patient_count)
+                    task = self._task(self._patient_id(patient), self._department())
+                else:
+                    task = self.open_tasks[self.random.choice(self._open_task_ids)]
+                    update = {"updated_date": self._now()}
+                    if roll < close_threshold:
+                        update["status"] = "Closed"
+                    elif roll < move_threshold:
+                        update["assigned_to"] = self._other_department(task.assigned_to)
+                    else:
+                        update["message"] = f"{task.message} (updated)"
+                    task = task.model_copy(update=update)
+
+                self._set_open(task)
+                tasks.append(task)
+
+            yield TaskInput(tasks=tasks)
+
+    def seed(self, clinic_manager: ClinicManager, chunk_size: int = 1000) -> None:
+        """Writes the history to the storage of clinic_manager and processes the
+        initial open tasks with it, so that the open requests are built the way
+        its request service builds them."""
+        for task_docs, request_docs in self.history_batches():
+            clinic_manager.storage.write_batch(task_docs, request_docs)
+
+        clinic_manager.process_tasks_stream(self.initial_open_tasks(), chunk_size)
+
+    def _now(self) -> datetime:
+        """A clock that moves forward a second every time it is read."""
+        self._clock += timedelta(seconds=1)
+        return self._clock
+
+    def _next_id(self) -> str:
+        """A UUID shaped id that only depends on the order of generation."""
+        self._id_count += 1
+        return str(UUID(int=self.random.getrandbits(96) << 32 | self._id_count))
+
+    @staticmethod
+    def _patient_id(patient: int) -> str:
+        return f"patient{patient}"
+
+    def _department(self) -> str:
+        return self.random.choices(self._departments, self._department_weights)[0]
+
+    def _other_department(self, department: str) -> str:
+        departments = [d for d in self._departments if d != department]
+        return self.random.choice(departments) if departments else department
+
+    def _task(
+        self, patient_id: str, department: str, status: str = "Open"
+    ) -> PatientTask:
+        now = self._now()
+        task_id = self._next_id()
+        return PatientTask(
+            id=task_id,
+            patient_id=patient_id,
+            status=status,
+            assigned_to=department,
+            created_date=now,
+            updated_date=now,
+            message=f"Message of task {task_id}",
+            medications=self.random.sample(MEDICATIONS, self.random.randint(0, 2)),
+            pharmacy_id=self.random.choice([None, *range(1, 21)]),
+        )
+
+    def _closed_request(
+        self, patient_id: str, tasks: list[PatientTask]
+    ) -> PatientRequest:
+        return PatientRequest(
+            id=self._next_id(),
+            patient_id=patient_id,
+            status="Closed",
+            assigned_to=tasks[-1].assigned_to,
+            created_date=tasks[0].created_date,
+            updated_date=tasks[-1].updated_date,
+            pharmacy_id=tasks[-1].pharmacy_id,
+            task_ids={task.id for task in tasks},
+            newest_task_id=tasks[-1].id,
+        )
+
+    def _set_open(self, task: PatientTask) -> None:
+        """Keeps open_tasks in line with the latest version of task."""
+        if task.status == "Open":
+            if task.id not in self.open_tasks:
+                self._open_task_positions[task.id] = len(self._open_task_ids)
+                self._open_task_ids.append(task.id)
+            self.open_tasks[task.id] = task
+        elif task.id in self.open_tasks:
+            # Swap the last id into the position of the removed one
+            position = self._open_task_positions.pop(task.id)
+            last_id = self._open_task_ids.pop()
+            if last_id != task.id:
+                self._open_task_ids[position] = last_id
+                self._open_task_positions[last_id] = position
+            del self.open_tasks[task.id]
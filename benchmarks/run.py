@@ -0,0 +1,301 @@
+"""Benchmarks ClinicManager.process_tasks_update on synthetic data.
+
+Every scenario (request service x storage) seeds a fresh storage with the
+synthetic history and open tasks, then replays the same stream of task inputs,
+timing every process_tasks_update. Peak memory is measured (with tracemalloc)
+in a second, identical replay, so that tracing doesn't skew the latencies.
+
+Usage:
+    python -m benchmarks.run --patients 10000 --batches 50 --save baseline
+    python -m benchmarks.run --patients 10000 --batches 50 --compare baseline
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable
+
+from pydantic import BaseModel
+
+import db.db_tinydb as db_tinydb
+from clinic_manager import ClinicManager
+from db.bloom import OpenRequestsFilter
+from db.cache import OpenRequestsCache
+from db.db_log import LogStorage
+from db.db_sqlite import SQLiteStorage
+from db.sharding import ShardedStorage
+from db.storage import Storage
+from parallel_clinic_manager import SQLiteShardStorageFactory
+from services.abstract_patient_request_service import PatientRequestService
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+
+from .data_generator import SyntheticConfig, SyntheticDataGenerator
+
+BASELINES_DIR = Path(__file__).parent / "baselines"
+
+REQUEST_SERVICES: dict[str, type[PatientRequestService]] = {
+    "per_patient": PerPatientRequestService,
+    "department": DepartmentPatientRequestService,
+}
+
+
+def _tinydb_storage(directory: str) -> Storage:
+    """The TinyDB storage, on a database in directory that replaces the process
+    wide one until the scenario ends (see _replay)."""
+    db_tinydb.set_clinic(db_tinydb.open_clinic(f"{directory}/db.json"))
+    return db_tinydb.TinyDBStorage()
+
+
+# Storage factories, called with a fresh temporary directory for each scenario
+STORAGES: dict[str, Callable[[str], Storage]] = {
+    "sqlite": lambda directory: SQLiteStorage(f"{directory}/db.sqlite3"),
+    "sqlite_cached": lambda directory: OpenRequestsCache(
+        SQLiteStorage(f"{directory}/db.sqlite3")
+    ),
+    "sqlite_filtered": lambda directory: OpenRequestsFilter(
+        SQLiteStorage(f"{directory}/db.sqlite3")
+    ),
+    "sqlite_sharded": lambda directory: ShardedStorage.open(
+        SQLiteShardStorageFactory(f"{directory}/shard_{{shard}}.sqlite3"),
+        shard_count=4,
+    ),
+    "log": lambda directory: LogStorage(directory),
+    "tinydb": _tinydb_storage,
+}
+
+
+class BenchmarkResult(BaseModel):
+    """The measurements of a scenario. Latencies are per process_tasks_update."""
+
+    scenario: str
+    tasks: int
+    batches: int
+    seconds: float
+    tasks_per_second: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    peak_memory_mb: float | None = None
+
+
+class Baseline(BaseModel):
+    """Saved benchmark results, along with the config they were measured with."""
+
+    config: SyntheticConfig
+    results: list[BenchmarkResult]
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    """Returns the fraction percentile of sorted_values, interpolating linearly
+    between the closest values."""
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+
+    position = fraction * (len(sorted_values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (
+        position - lower
+    )
+
+
+def _replay(
+    config: SyntheticConfig,
+    request_service_class: type[PatientRequestService],
+    storage_factory: Callable[[str], Storage],
+) -> list[float]:
+    """Seeds a fresh storage and replays the task input stream of config,
+    returning the duration (in seconds) of every process_tasks_update."""
+    with (
+        tempfile.TemporaryDirectory() as directory,
+        db_tinydb.restoring_clinic(),
+    ):
+        storage = storage_factory(directory)
+        clinic_manager = ClinicManager(request_service_class(storage=storage))
+
+        generator = SyntheticDataGenerator(config)
+        generator.seed(clinic_manager)
+
+        durations = []
+        for task_input in generator.task_inputs():
+            start = time.perf_counter()
+            clinic_manager.process_tasks_update(task_input)
+            durations.append(time.perf_counter() - start)
+
+        if hasattr(storage, "close"):
+            storage.close()
+
+    return durations
+
+
+def run_scenario(
+    config: SyntheticConfig,
+    request_service: str,
+    storage: str,
+    measure_memory: bool = True,
+) -> BenchmarkResult:
+    """Runs a scenario, see the module docstring."""
+    request_service_class = REQUEST_SERVICES[request_service]
+    storage_factory = STORAGES[storage]
+
+    durations = _replay(config, request_service_class, storage_factory)
+
+    peak_memory_mb = None
+    if measure_memory:
+        tracemalloc.start()
+        try:
+            _replay(config, request_service_class, storage_factory)
+            peak_memory_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+
+    seconds = sum(durations)
+    sorted_durations = sorted(durations) or [0.0]
+    task_count = config.batch_count * config.batch_size
+    return BenchmarkResult(
+        scenario=f"{request_service}/{storage}",
+        tasks=task_count,
+        batches=config.batch_count,
+        seconds=seconds,
+        tasks_per_second=task_count / seconds if seconds else 0.0,
+        p50_ms=percentile(sorted_durations, 0.50) * 1000,
+        p95_ms=percentile(sorted_durations, 0.95) * 1000,
+        p99_ms=percentile(sorted_durations, 0.99) * 1000,
+        peak_memory_mb=peak_memory_mb,
+    )
+
+
+def save_baseline(name: str, baseline: Baseline) -> Path:
+    BASELINES_DIR.mkdir(exist_ok=True)
+    path = BASELINES_DIR / f"{name}.json"
+    path.write_text(baseline.model_dump_json(indent=2))
+    return path
+
+
+def load_baseline(name: str) -> Baseline:
+    return Baseline.model_validate_json((BASELINES_DIR / f"{name}.json").read_text())
+
+
+def find_regressions(
+    results: list[BenchmarkResult], baseline: Baseline, tolerance: float = 0.2
+) -> list[str]:
+    """Returns a description of every measurement of results that is worse than
+    the same scenario's baseline by more than tolerance (a fraction)."""
+    baseline_results = {result.scenario: result for result in baseline.results}
+
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get(result.scenario)
+        if baseline_result is None:
+            continue
+
+        for field, higher_is_better in (
+            ("tasks_per_second", True),
+            ("p50_ms", False),
+            ("p95_ms", False),
+            ("p99_ms", False),
+            ("peak_memory_mb", False),
+        ):
+            value = getattr(result, field)
+            baseline_value = getattr(baseline_result, field)
+            if value is None or not baseline_value:
+                continue
+
+            change = (value - baseline_value) / baseline_value
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(
+                    f"{result.scenario} {field}: {value:.2f}"
+                    f" (baseline {baseline_value:.2f}, {change:+.0%})"
+                )
+
+    return regressions
+
+
+def format_results(results: list[BenchmarkResult]) -> str:
+    lines = [
+        f"{'scenario':<28}{'tasks/s':>10}{'p50 ms':>10}{'p95 ms':>10}"
+        f"{'p99 ms':>10}{'peak MB':>10}"
+    ]
+    for result in results:
+        peak_memory = (
+            f"{result.peak_memory_mb:.1f}" if result.peak_memory_mb is not None else "-"
+        )
+        lines.append(
+            f"{result.scenario:<28}{result.tasks_per_second:>10.0f}"
+            f"{result.p50_ms:>10.2f}{result.p95_ms:>10.2f}{result.p99_ms:>10.2f}"
+            f"{peak_memory:>10}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--patients", type=int, default=10_000)
+    parser.add_argument("--open-ratio", type=float, default=0.05)
+    parser.add_argument("--closed-requests", type=int, default=2)
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--move-rate", type=float, default=0.1)
+    parser.add_argument(
+        "--services",
+        nargs="+",
+        choices=REQUEST_SERVICES,
+        default=list(REQUEST_SERVICES),
+    )
+    parser.add_argument(
+        "--storages", nargs="+", choices=STORAGES, default=["sqlite", "log"]
+    )
+    parser.add_argument("--no-memory", action="store_true", help="Skip peak memory")
+    parser.add_argument("--save", metavar="NAME", help="Save the results as a baseline")
+    parser.add_argument(
+        "--compare", metavar="NAME", help="Compare the results to a saved baseline"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    config = SyntheticConfig(
+        seed=args.seed,
+        patient_count=args.patients,
+        open_patient_ratio=args.open_ratio,
+        closed_requests_per_patient=args.closed_requests,
+        batch_count=args.batches,
+        batch_size=args.batch_size,
+        move_rate=args.move_rate,
+    )
+
+    results = []
+    for request_service in args.services:
+        for storage in args.storages:
+            results.append(
+                run_scenario(
+                    config, request_service, storage, measure_memory=not args.no_memory
+                )
+            )
+    print(format_results(results))
+
+    if args.save:
+        print(
+            f"Saved baseline to {save_baseline(args.save, Baseline(config=config, results=results))}"
+        )
+
+    if args.compare:
+        baseline = load_baseline(args.compare)
+        if baseline.config != config:
+            print("Warning: the baseline was measured with a different config")
+
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
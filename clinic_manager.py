@@ -1,31 +1,121 @@
+import copy
 from itertools import chain
-from typing import Generator
+from typing import Generator, Iterable
 
-from models import TaskInput
+from db.storage import Storage, get_storage
+from db.unit_of_work import UnitOfWork
+from metrics import TASKS_PROCESSED, get_metrics
+from models import PatientTask, TaskInput
 from services.abstract_patient_request_service import PatientRequestService
 from services.patient_request_service import PerPatientRequestService
 from services.task_service import TaskService
+from task_input_loader import chunk_tasks, coalesce_task_inputs, coalesce_tasks
 
 
 class ClinicManager:
 
-    def __init__(self, patientRequestService: PatientRequestService = None):
+    def __init__(
+        self,
+        patientRequestService: PatientRequestService = None,
+        storage: Storage = None,
+        trusted_reads: bool = False,
+    ):
+        """
+        Args:
+            patientRequestService (PatientRequestService): The request service to
+                use, defaults to a PerPatientRequestService.
+            storage (Storage): The storage to use, defaults to the storage of
+                patientRequestService (or the default storage).
+            trusted_reads (bool): Whether the tasks (and the requests of the default
+                request service) read from the storage are built without being
+                validated again. The task inputs are always validated.
+        """
+        # The storage defaults to the one of the given request service, so that
+        # tasks and requests always end up in the same DB
+        if storage is None:
+            storage = (
+                patientRequestService.storage
+                if patientRequestService
+                else get_storage()
+            )
+
+        if isinstance(storage, UnitOfWork):
+            storage = storage.storage
+
+        self.storage = storage
+        # All the services write through the unit of work, so that the writes of
+        # an update are buffered and applied to the storage at once
+        self.unit_of_work = UnitOfWork(storage)
+        # A copy of the given request service writes through the unit of work,
+        # so that the caller's service keeps writing straight to its storage
         self.patient_request_service = (
-            patientRequestService or PerPatientRequestService()
+            copy.copy(patientRequestService)
+            if patientRequestService
+            else PerPatientRequestService(storage=storage, trusted_reads=trusted_reads)
+        )
+        self.patient_request_service.storage = self.unit_of_work
+        self.task_service = TaskService(
+            storage=self.unit_of_work, trusted_reads=trusted_reads
         )
-        self.task_service = TaskService()
 
     def process_tasks_update(self, task_input: TaskInput):
         """Accepts a task_input object that contains all the tasks that were modified since
         the last time this method was called. The method process the changes to the tasks, and updates the patient requests appropriately.
+
+        All the DB changes made by the update are written at once when it ends, and
+        none of them are written if it raises. Only the latest version of a task
+        that appears several times in task_input is processed.
         """
 
-        tasks = task_input.tasks
+        tasks = coalesce_tasks(task_input.tasks)
         if not tasks:
             return
 
-        # update DB with the newly modified tasks
-        self.task_service.updates_tasks(tasks)
+        metrics = get_metrics()
+        with metrics.timer("process_tasks_update"):
+            with self.unit_of_work:
+                self._process_tasks_update(tasks)
+        metrics.increment(TASKS_PROCESSED, len(tasks))
+
+    def process_tasks_stream(
+        self, tasks: Iterable[PatientTask], chunk_size: int = 1000
+    ) -> None:
+        """Processes a (possibly very large) stream of tasks, e.g. from
+        task_input_loader.iter_tasks, in chunks of at most chunk_size tasks.
+        Each chunk is processed as a separate task update, so memory use is bounded
+        by the chunk size rather than by the size of the stream."""
+        for task_input in chunk_tasks(tasks, chunk_size):
+            self.process_tasks_update(task_input)
+
+    def process_queued_updates(
+        self, task_inputs: Iterable[TaskInput], max_batches: int = 10
+    ) -> None:
+        """Processes task inputs that were queued (e.g. while catching up), merging
+        up to max_batches consecutive inputs into a single update that only keeps
+        the latest version of every task. The tasks and requests end up the same
+        as when processing the inputs one by one, with fewer writes and request
+        recomputations (see task_input_loader.coalesce_task_inputs)."""
+        for task_input in coalesce_task_inputs(task_inputs, max_batches):
+            self.process_tasks_update(task_input)
+
+    def _process_tasks_update(self, tasks):
+        metrics = get_metrics()
+
+        # update DB with the newly modified tasks. Tasks that didn't actually
+        # change can't change any request, so only the changed ones go on
+        with metrics.timer("updates_tasks"):
+            tasks, previous_states = self.task_service.updates_tasks(tasks)
+        if not tasks:
+            return
+
+        if self.patient_request_service.incremental:
+            # The request service applies the modified tasks to the existing
+            # requests, so the other open tasks of the patients aren't needed
+            with metrics.timer("update_requests"):
+                self.patient_request_service.update_requests(
+                    tasks=tasks, previous_states=previous_states
+                )
+            return
 
         # Get the tasks that will require updating of patient requests.
         # 1 - The newly closed tasks
@@ -37,10 +127,14 @@ class ClinicManager:
 
         # 2 - *All* open tasks for the *affected patients* (from the updated DB)
         affected_patients_ids = {t.patient_id for t in tasks}
-        all_open_tasks: Generator = self.task_service.get_open_tasks(
-            patient_ids=affected_patients_ids
-        )
+        with metrics.timer("get_open_tasks"):
+            all_open_tasks: Generator = self.task_service.get_open_tasks(
+                patient_ids=affected_patients_ids
+            )
 
         relevant_tasks = (task for task in chain(all_open_tasks, newly_closed_tasks))
 
-        self.patient_request_service.update_requests(tasks=relevant_tasks)
+        with metrics.timer("update_requests"):
+            self.patient_request_service.update_requests(
+                tasks=relevant_tasks, previous_states=previous_states
+            )
@@ -0,0 +1,251 @@
+from itertools import chain
+from typing import Hashable, Iterable
+
+from .storage import Storage
+
+ARCHIVED_STATUS = "Closed"
+
+
+def _split_archived(docs: Iterable[dict]) -> tuple[list[dict], list[dict]]:
+    """Splits docs into the working (open) and the archived (closed) ones."""
+    working_docs, archived_docs = [], []
+    for doc in docs:
+        if doc["status"] == ARCHIVED_STATUS:
+            archived_docs.append(doc)
+        else:
+            working_docs.append(doc)
+    return working_docs, archived_docs
+
+
+def _dedupe(*doc_lists: list[dict]) -> list[dict]:
+    """Concatenates doc_lists (the documents read from the working storage
+    first), keeping the first copy of a document found in both storages after an
+    interrupted move (see ArchivingStorage)."""
+    docs, seen_ids = [], set()
+    for doc in chain.from_iterable(doc_lists):
+        if doc["id"] not in seen_ids:
+            seen_ids.add(doc["id"])
+            docs.append(doc)
+    return docs
+
+
+def _written_last(working_doc: dict, archived_doc: dict) -> dict:
+    """Returns whichever copy of a document found in both storages was written
+    last: the most recently updated one, or the archived one on a tie (a request
+    is closed without being updated, but never reopened)."""
+    if working_doc["updated_date"] > archived_doc["updated_date"]:
+        return working_doc
+    return archived_doc
+
+
+def _stale_copies(
+    working_docs: list[dict], archived_docs: list[dict]
+) -> tuple[set[str], set[str]]:
+    """Returns the ids of the documents found in both storages whose working
+    copy, and the ids of those whose archived copy, wasn't written last."""
+    working_docs_by_id = {doc["id"]: doc for doc in working_docs}
+    stale_working_ids, stale_archived_ids = set(), set()
+    for archived_doc in archived_docs:
+        working_doc = working_docs_by_id.get(archived_doc["id"])
+        if working_doc is None:
+            continue
+        if _written_last(working_doc, archived_doc) is working_doc:
+            stale_archived_ids.add(archived_doc["id"])
+        else:
+            stale_working_ids.add(working_doc["id"])
+    return stale_working_ids, stale_archived_ids
+
+
+class ArchivingStorage(Storage):
+    """Storage that keeps the working set (open tasks and patient requests) in
+    one storage and moves the closed ones, which are only kept as medical
+    history, to a separate archive storage as soon as they are written closed.
+
+    The services only look for open documents, so their queries never touch the
+    history, however big it grows. Searches for closed documents (and the
+    search_archived_* history API) go to the archive, searches without a status
+    filter and lookups by id go to both.
+
+    A closed document is written to the archive before it is removed from the
+    working storage (and the other way around for a reopened task), so if the
+    process dies in between, nothing is lost but the document is in both
+    storages. The writes to the two storages aren't atomic, and a batch isn't
+    replayed after a failure (the unit of work discards it). Until archive_closed
+    (meant to be run at startup) repairs the interrupted moves, lookups that read
+    both storages return the working copy of such a document, and searches for
+    open documents may return it even if it was closed.
+
+    Example:
+        storage = ArchivingStorage(
+            working=SQLiteStorage("sqlite/db.sqlite3"),
+            archive=LogStorage("sqlite/archive"),
+        )
+        storage.archive_closed()  # Moves the already stored history, once
+        clinic_manager = ClinicManager(storage=storage)
+    """
+
+    def __init__(self, working: Storage, archive: Storage):
+        self.working = working
+        self.archive = archive
+
+    def _storages_for(self, status: str | None) -> list[Storage]:
+        """Returns the storages that can hold documents with the given status."""
+        if status is None:
+            return [self.working, self.archive]
+        if status == ARCHIVED_STATUS:
+            return [self.archive]
+        return [self.working]
+
+    def upsert_tasks(self, task_docs: list[dict]) -> None:
+        self.write_batch(task_docs=task_docs, request_docs=[])
+
+    def get_task(self, task_id: str) -> dict | None:
+        task_doc = self.working.get_task(task_id)
+        if task_doc is None:
+            task_doc = self.archive.get_task(task_id)
+        return task_doc
+
+    def get_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        task_ids = set(task_ids)
+        task_docs = self.working.get_tasks(task_ids)
+
+        archived_ids = task_ids - {task_doc["id"] for task_doc in task_docs}
+        if archived_ids:
+            task_docs += self.archive.get_tasks(archived_ids)
+        return task_docs
+
+    def delete_tasks(self, task_ids: Iterable[str]) -> None:
+        task_ids = set(task_ids)
+        self.working.delete_tasks(task_ids)
+        self.archive.delete_tasks(task_ids)
+
+    def search_tasks(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+    ) -> list[dict]:
+        if patient_ids is not None:
+            patient_ids = set(patient_ids)
+
+        return _dedupe(
+            *(
+                storage.search_tasks(patient_ids=patient_ids, status=status)
+                for storage in self._storages_for(status)
+            ),
+        )
+
+    def upsert_patient_requests(self, request_docs: list[dict]) -> None:
+        self.write_batch(task_docs=[], request_docs=request_docs)
+
+    def delete_patient_requests(self, request_ids: Iterable[str]) -> None:
+        request_ids = set(request_ids)
+        self.working.delete_patient_requests(request_ids)
+        self.archive.delete_patient_requests(request_ids)
+
+    def search_patient_requests(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+        assigned_to: str | None = None,
+    ) -> list[dict]:
+        if patient_ids is not None:
+            patient_ids = set(patient_ids)
+
+        return _dedupe(
+            *(
+                storage.search_patient_requests(
+                    patient_ids=patient_ids, status=status, assigned_to=assigned_to
+                )
+                for storage in self._storages_for(status)
+            ),
+        )
+
+    def search_patient_requests_by_task(self, task_id: str) -> list[dict]:
+        return _dedupe(
+            self.working.search_patient_requests_by_task(task_id),
+            self.archive.search_patient_requests_by_task(task_id),
+        )
+
+    def search_patient_requests_by_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        task_ids = set(task_ids)
+        return _dedupe(
+            self.working.search_patient_requests_by_tasks(task_ids),
+            self.archive.search_patient_requests_by_tasks(task_ids),
+        )
+
+    def write_batch(self, task_docs: list[dict], request_docs: list[dict]) -> None:
+        # Only the last version of a document counts, and decides where it belongs
+        working_tasks, archived_tasks = _split_archived(
+            {d["id"]: d for d in task_docs}.values()
+        )
+        working_requests, archived_requests = _split_archived(
+            {d["id"]: d for d in request_docs}.values()
+        )
+
+        if archived_tasks or archived_requests:
+            self.archive.write_batch(archived_tasks, archived_requests)
+        if working_tasks or working_requests:
+            self.working.write_batch(working_tasks, working_requests)
+
+        if archived_tasks:
+            self.working.delete_tasks(d["id"] for d in archived_tasks)
+        if archived_requests:
+            self.working.delete_patient_requests(d["id"] for d in archived_requests)
+        if working_tasks:
+            self.archive.delete_tasks(d["id"] for d in working_tasks)
+        if working_requests:
+            self.archive.delete_patient_requests(d["id"] for d in working_requests)
+
+    def partition_for(self, patient_id: str) -> Hashable | None:
+        partitions = (
+            self.working.partition_for(patient_id),
+            self.archive.partition_for(patient_id),
+        )
+        return None if partitions == (None, None) else partitions
+
+    def drop_tables(self) -> None:
+        self.working.drop_tables()
+        self.archive.drop_tables()
+
+    def archive_closed(self) -> None:
+        """Moves the closed documents that are still in the working storage (e.g.
+        written before archiving was enabled, or by init_db) to the archive, after
+        repairing the moves that were interrupted (see repair_interrupted_moves)."""
+        self.repair_interrupted_moves()
+        self.write_batch(
+            task_docs=self.working.search_tasks(status=ARCHIVED_STATUS),
+            request_docs=self.working.search_patient_requests(status=ARCHIVED_STATUS),
+        )
+
+    def repair_interrupted_moves(self) -> None:
+        """Keeps only the copy that was written last of every document found in
+        both storages, because the process died while moving it."""
+        working_tasks = self.working.search_tasks()
+        stale_working_ids, stale_archived_ids = _stale_copies(
+            working_tasks,
+            (
+                self.archive.get_tasks(d["id"] for d in working_tasks)
+                if working_tasks
+                else []
+            ),
+        )
+        if stale_working_ids:
+            self.working.delete_tasks(stale_working_ids)
+        if stale_archived_ids:
+            self.archive.delete_tasks(stale_archived_ids)
+
+        working_requests = self.working.search_patient_requests()
+        stale_working_ids, stale_archived_ids = _stale_copies(
+            working_requests,
+            (
+                self.archive.search_patient_requests(
+                    patient_ids={d["patient_id"] for d in working_requests}
+                )
+                if working_requests
+                else []
+            ),
+        )
+        if stale_working_ids:
+            self.working.delete_patient_requests(stale_working_ids)
+        if stale_archived_ids:
+            self.archive.delete_patient_requests(stale_archived_ids)
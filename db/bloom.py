@@ -0,0 +1,198 @@
+import math
+from hashlib import blake2b
+from typing import Generator, Hashable, Iterable
+
+from metrics import OPEN_REQUESTS_FILTER_NEGATIVES, get_metrics
+
+from .storage import Storage
+
+OPEN_STATUS = "Open"
+
+
+class BloomFilter:
+    """A set of strings that may answer that it contains a string it doesn't
+    (with about false_positive_rate probability, up to capacity strings), but
+    never the other way around. Strings can't be removed.
+
+    Uses bit_count bits (about 1.2 bytes per string at a 1% false positive rate)
+    and hash_count positions per string, derived from a single blake2b hash.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float = 0.01):
+        self.capacity = max(capacity, 1)
+        self.false_positive_rate = false_positive_rate
+        self.bit_count = max(
+            8,
+            math.ceil(
+                -self.capacity * math.log(false_positive_rate) / math.log(2) ** 2
+            ),
+        )
+        self.hash_count = max(1, round(self.bit_count / self.capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value: str) -> Generator[int, None, None]:
+        digest = blake2b(value.encode(), digest_size=16).digest()
+        first_hash = int.from_bytes(digest[:8], "little")
+        second_hash = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (first_hash + i * second_hash) % self.bit_count
+
+    def add(self, value: str) -> None:
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value)
+        )
+
+
+def _patient_key(patient_id: str, assigned_to: str | None = None) -> str:
+    """The filter key of the open requests of a patient (in a department)."""
+    return f"{patient_id}\x1f{assigned_to or ''}"
+
+
+class OpenRequestsFilter(Storage):
+    """Storage that wraps another storage and keeps a Bloom filter of the
+    patients, and the (patient, department) pairs, that have open requests.
+
+    A search for the open requests of patients (as the request services do)
+    only queries the patients that may have open requests, and doesn't query at
+    all when none of them may: most patients of an update have no open request,
+    only closed history.
+
+    The filter is built from the open requests of the storage when the wrapper
+    is created, and updated by the writes: the patients of the written open
+    requests are added. Closed (or deleted) requests can't be removed from the
+    filter, so they are only counted, and once they are as many as the open
+    requests added to the filter, it is rebuilt (with more capacity if needed).
+
+    The wrapper must be the only writer of the wrapped storage. Put it under the
+    unit of work, and under an OpenRequestsCache if there is one.
+
+    Example:
+        storage = OpenRequestsCache(OpenRequestsFilter(SQLiteStorage()))
+        clinic_manager = ClinicManager(storage=storage)
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        capacity: int = 100_000,
+        false_positive_rate: float = 0.01,
+    ):
+        """
+        Args:
+            storage (Storage): The wrapped storage.
+            capacity (int): The number of keys (2 per open request) the filter is
+                sized for, at false_positive_rate.
+            false_positive_rate (float): The fraction of the patients without open
+                requests that are queried anyway.
+        """
+        self.storage = storage
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.negatives = 0
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        """Rebuilds the filter from the open requests of the storage."""
+        open_request_docs = self.storage.search_patient_requests(status=OPEN_STATUS)
+        # Every request adds 2 keys, and the filter has room to grow
+        self.capacity = max(self.capacity, 4 * len(open_request_docs))
+        self.filter = BloomFilter(self.capacity, self.false_positive_rate)
+        self._stale_count = 0
+        self._add(open_request_docs)
+
+    def _add(self, request_docs: Iterable[dict]) -> None:
+        for request_doc in request_docs:
+            self.filter.add(_patient_key(request_doc["patient_id"]))
+            self.filter.add(
+                _patient_key(request_doc["patient_id"], request_doc["assigned_to"])
+            )
+
+    def _write_through(self, request_docs: list[dict]) -> None:
+        open_request_docs = [d for d in request_docs if d["status"] == OPEN_STATUS]
+        self._add(open_request_docs)
+        self._stale_count += len(request_docs) - len(open_request_docs)
+        self._rebuild_if_needed()
+
+    def _rebuild_if_needed(self) -> None:
+        if (
+            self._stale_count * 2 >= max(self.filter.count, 1)
+            or self.filter.count > self.filter.capacity
+        ):
+            self.rebuild()
+
+    def upsert_tasks(self, task_docs: list[dict]) -> None:
+        self.storage.upsert_tasks(task_docs)
+
+    def get_task(self, task_id: str) -> dict | None:
+        return self.storage.get_task(task_id)
+
+    def get_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        return self.storage.get_tasks(task_ids)
+
+    def delete_tasks(self, task_ids: Iterable[str]) -> None:
+        self.storage.delete_tasks(task_ids)
+
+    def search_tasks(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+    ) -> list[dict]:
+        return self.storage.search_tasks(patient_ids=patient_ids, status=status)
+
+    def upsert_patient_requests(self, request_docs: list[dict]) -> None:
+        self.storage.upsert_patient_requests(request_docs)
+        self._write_through(request_docs)
+
+    def search_patient_requests(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+        assigned_to: str | None = None,
+    ) -> list[dict]:
+        if patient_ids is not None and status == OPEN_STATUS:
+            patient_ids = set(patient_ids)
+            candidate_ids = {
+                patient_id
+                for patient_id in patient_ids
+                if _patient_key(patient_id, assigned_to) in self.filter
+            }
+            negatives = len(patient_ids) - len(candidate_ids)
+            self.negatives += negatives
+            get_metrics().increment(OPEN_REQUESTS_FILTER_NEGATIVES, negatives)
+            if not candidate_ids:
+                return []
+            patient_ids = candidate_ids
+
+        return self.storage.search_patient_requests(
+            patient_ids=patient_ids, status=status, assigned_to=assigned_to
+        )
+
+    def search_patient_requests_by_task(self, task_id: str) -> list[dict]:
+        return self.storage.search_patient_requests_by_task(task_id)
+
+    def search_patient_requests_by_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        return self.storage.search_patient_requests_by_tasks(task_ids)
+
+    def delete_patient_requests(self, request_ids: Iterable[str]) -> None:
+        request_ids = set(request_ids)
+        self.storage.delete_patient_requests(request_ids)
+        self._stale_count += len(request_ids)
+        self._rebuild_if_needed()
+
+    def write_batch(self, task_docs: list[dict], request_docs: list[dict]) -> None:
+        self.storage.write_batch(task_docs, request_docs)
+        self._write_through(request_docs)
+
+    def partition_for(self, patient_id: str) -> Hashable | None:
+        return self.storage.partition_for(patient_id)
+
+    def drop_tables(self) -> None:
+        self.storage.drop_tables()
+        self.rebuild()
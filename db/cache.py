@@ -0,0 +1,177 @@
+from collections import OrderedDict
+from typing import Hashable, Iterable
+
+from metrics import OPEN_REQUESTS_CACHE_HITS, OPEN_REQUESTS_CACHE_MISSES, get_metrics
+
+from .storage import Storage
+
+OPEN_STATUS = "Open"
+
+
+def _copy_request_doc(request_doc: dict) -> dict:
+    """Returns a copy of request_doc that callers can change (e.g. its task_ids)
+    without changing the cached document."""
+    return {**request_doc, "task_ids": set(request_doc["task_ids"])}
+
+
+class OpenRequestsCache(Storage):
+    """Storage that wraps another storage and keeps the open patient requests of
+    the most recently used patients in memory, so that the request services'
+    lookups of the open requests of active patients don't query the storage.
+
+    Every cached patient holds all the patient's open requests (at most one per
+    department), so a lookup by patient, and optionally by department
+    (assigned_to), is answered from the cache, including when the patient has no
+    open request. Only the patients that aren't cached are queried, with a
+    single query, and then cached (read-through). The writes update the cached
+    patients (write-through): a closed request is dropped and an open one is
+    added or replaced. Up to max_patients patients are cached, and the least
+    recently used ones are evicted first.
+
+    The cache must be the only writer of the wrapped storage. Put it under the
+    unit of work (as ClinicManager does with its storage), so that it only sees
+    the writes that are committed.
+
+    Example:
+        storage = OpenRequestsCache(SQLiteStorage(), max_patients=10_000)
+        clinic_manager = ClinicManager(storage=storage)
+        ...
+        print(storage.hits, storage.misses)
+    """
+
+    def __init__(self, storage: Storage, max_patients: int = 10_000):
+        self.storage = storage
+        self.max_patients = max_patients
+        # The open requests of the cached patients, least recently used first
+        self._open_requests: OrderedDict[str, dict[str, dict]] = OrderedDict()
+        # The cached patient of every cached request, by request id
+        self._patient_ids: dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self) -> None:
+        self._open_requests.clear()
+        self._patient_ids.clear()
+
+    def _cache_patient(self, patient_id: str, request_docs: list[dict]) -> None:
+        self._open_requests[patient_id] = {}
+        for request_doc in request_docs:
+            self._open_requests[patient_id][request_doc["id"]] = _copy_request_doc(
+                request_doc
+            )
+            self._patient_ids[request_doc["id"]] = patient_id
+
+        while len(self._open_requests) > self.max_patients:
+            _, evicted_requests = self._open_requests.popitem(last=False)
+            for request_id in evicted_requests:
+                del self._patient_ids[request_id]
+
+    def _get_open_requests(self, patient_ids: set[str]) -> list[dict]:
+        """Returns the open requests of patient_ids, querying the storage for the
+        patients that aren't cached only."""
+        missing_patient_ids = set()
+        request_docs = []
+        for patient_id in patient_ids:
+            cached_requests = self._open_requests.get(patient_id)
+            if cached_requests is None:
+                missing_patient_ids.add(patient_id)
+            else:
+                self._open_requests.move_to_end(patient_id)
+                request_docs += cached_requests.values()
+
+        hits = len(patient_ids) - len(missing_patient_ids)
+        self.hits += hits
+        self.misses += len(missing_patient_ids)
+        metrics = get_metrics()
+        metrics.increment(OPEN_REQUESTS_CACHE_HITS, hits)
+        metrics.increment(OPEN_REQUESTS_CACHE_MISSES, len(missing_patient_ids))
+
+        if missing_patient_ids:
+            requests_by_patient = {patient_id: [] for patient_id in missing_patient_ids}
+            for request_doc in self.storage.search_patient_requests(
+                patient_ids=missing_patient_ids, status=OPEN_STATUS
+            ):
+                requests_by_patient[request_doc["patient_id"]].append(request_doc)
+                request_docs.append(request_doc)
+            for patient_id, patient_request_docs in requests_by_patient.items():
+                self._cache_patient(patient_id, patient_request_docs)
+
+        return request_docs
+
+    def _write_through(self, request_docs: list[dict]) -> None:
+        """Updates the cached patients with the written request_docs."""
+        for request_doc in request_docs:
+            cached_requests = self._open_requests.get(request_doc["patient_id"])
+            if cached_requests is None:
+                continue
+
+            if request_doc["status"] == OPEN_STATUS:
+                cached_requests[request_doc["id"]] = _copy_request_doc(request_doc)
+                self._patient_ids[request_doc["id"]] = request_doc["patient_id"]
+            elif cached_requests.pop(request_doc["id"], None) is not None:
+                del self._patient_ids[request_doc["id"]]
+
+    def upsert_tasks(self, task_docs: list[dict]) -> None:
+        self.storage.upsert_tasks(task_docs)
+
+    def get_task(self, task_id: str) -> dict | None:
+        return self.storage.get_task(task_id)
+
+    def get_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        return self.storage.get_tasks(task_ids)
+
+    def delete_tasks(self, task_ids: Iterable[str]) -> None:
+        self.storage.delete_tasks(task_ids)
+
+    def search_tasks(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+    ) -> list[dict]:
+        return self.storage.search_tasks(patient_ids=patient_ids, status=status)
+
+    def upsert_patient_requests(self, request_docs: list[dict]) -> None:
+        self.storage.upsert_patient_requests(request_docs)
+        self._write_through(request_docs)
+
+    def search_patient_requests(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+        assigned_to: str | None = None,
+    ) -> list[dict]:
+        if patient_ids is None or status != OPEN_STATUS:
+            return self.storage.search_patient_requests(
+                patient_ids=patient_ids, status=status, assigned_to=assigned_to
+            )
+
+        return [
+            _copy_request_doc(request_doc)
+            for request_doc in self._get_open_requests(set(patient_ids))
+            if assigned_to is None or request_doc["assigned_to"] == assigned_to
+        ]
+
+    def search_patient_requests_by_task(self, task_id: str) -> list[dict]:
+        return self.storage.search_patient_requests_by_task(task_id)
+
+    def search_patient_requests_by_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        return self.storage.search_patient_requests_by_tasks(task_ids)
+
+    def delete_patient_requests(self, request_ids: Iterable[str]) -> None:
+        request_ids = set(request_ids)
+        self.storage.delete_patient_requests(request_ids)
+        for request_id in request_ids:
+            patient_id = self._patient_ids.pop(request_id, None)
+            if patient_id is not None:
+                del self._open_requests[patient_id][request_id]
+
+    def write_batch(self, task_docs: list[dict], request_docs: list[dict]) -> None:
+        self.storage.write_batch(task_docs, request_docs)
+        self._write_through(request_docs)
+
+    def partition_for(self, patient_id: str) -> Hashable | None:
+        return self.storage.partition_for(patient_id)
+
+    def drop_tables(self) -> None:
+        self.storage.drop_tables()
+        self.clear()
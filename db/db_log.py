@@ -0,0 +1,266 @@
+import json
+import os
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable
+
+from . import encoding
+from .storage import Storage, matches_filters
+
+SNAPSHOT_FILE = "snapshot.json"
+LOG_FILE = "log.ndjson"
+
+# The log is compacted into the snapshot once it is at least this big and at least
+# as big as the snapshot, so compaction costs O(1) amortized per logged byte
+MIN_COMPACTION_SIZE = 1024 * 1024
+
+
+class LogStorage(Storage):
+    """Storage backend that keeps the documents in memory and persists every
+    write as an appended line of a write-ahead log, instead of rewriting the
+    whole database like TinyDB's JSONStorage does.
+
+    The log is periodically compacted into a snapshot of all the documents. On
+    startup the state is rebuilt from the snapshot followed by the log. Each
+    line of the log holds a whole write_batch, so a batch is either replayed
+    completely or (if the process died while writing it) not at all.
+
+    Files, in the given directory:
+        snapshot.json: {"tasks": [...], "patient_requests": [...]}
+        log.ndjson: a {"tasks": [...], "patient_requests": [...]} batch (or a
+            {"deleted_tasks": [...]} / {"deleted_patient_requests": [...]} batch
+            of ids) per line
+    """
+
+    def __init__(
+        self,
+        directory: str = "log",
+        min_compaction_size: int = MIN_COMPACTION_SIZE,
+        fsync: bool = True,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.snapshot_path = self.directory / SNAPSHOT_FILE
+        self.log_path = self.directory / LOG_FILE
+        self.min_compaction_size = min_compaction_size
+        self.fsync = fsync
+
+        self._tasks: dict[str, dict] = {}
+        self._requests: dict[str, dict] = {}
+        self._request_ids_by_task: dict[str, set[str]] = defaultdict(set)
+        self._snapshot_size = 0
+
+        self._load()
+        self._log = open(self.log_path, "a", encoding="utf-8")
+
+    def upsert_tasks(self, task_docs: list[dict]) -> None:
+        self.write_batch(task_docs=task_docs, request_docs=[])
+
+    def get_task(self, task_id: str) -> dict | None:
+        task_doc = self._tasks.get(task_id)
+        return dict(task_doc) if task_doc is not None else None
+
+    def get_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        return [
+            dict(self._tasks[task_id])
+            for task_id in set(task_ids)
+            if task_id in self._tasks
+        ]
+
+    def delete_tasks(self, task_ids: Iterable[str]) -> None:
+        task_ids = [task_id for task_id in set(task_ids) if task_id in self._tasks]
+        if not task_ids:
+            return
+
+        self._append({"deleted_tasks": task_ids})
+        self._delete(task_ids, [])
+        self._compact_if_needed()
+
+    def search_tasks(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+    ) -> list[dict]:
+        if patient_ids is not None:
+            patient_ids = set(patient_ids)
+
+        filters = {"patient_id": patient_ids, "status": status}
+        return [
+            dict(task_doc)
+            for task_doc in self._tasks.values()
+            if matches_filters(task_doc, filters)
+        ]
+
+    def upsert_patient_requests(self, request_docs: list[dict]) -> None:
+        self.write_batch(task_docs=[], request_docs=request_docs)
+
+    def write_batch(self, task_docs: list[dict], request_docs: list[dict]) -> None:
+        if not task_docs and not request_docs:
+            return
+
+        self._append({"tasks": task_docs, "patient_requests": request_docs})
+        self._apply(task_docs, request_docs)
+        self._compact_if_needed()
+
+    def delete_patient_requests(self, request_ids: Iterable[str]) -> None:
+        request_ids = [
+            request_id
+            for request_id in set(request_ids)
+            if request_id in self._requests
+        ]
+        if not request_ids:
+            return
+
+        self._append({"deleted_patient_requests": request_ids})
+        self._delete([], request_ids)
+        self._compact_if_needed()
+
+    def search_patient_requests(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+        assigned_to: str | None = None,
+    ) -> list[dict]:
+        if patient_ids is not None:
+            patient_ids = set(patient_ids)
+
+        filters = {
+            "patient_id": patient_ids,
+            "status": status,
+            "assigned_to": assigned_to,
+        }
+        return [
+            dict(request_doc)
+            for request_doc in self._requests.values()
+            if matches_filters(request_doc, filters)
+        ]
+
+    def search_patient_requests_by_task(self, task_id: str) -> list[dict]:
+        return self.search_patient_requests_by_tasks([task_id])
+
+    def search_patient_requests_by_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        request_ids = set()
+        for task_id in set(task_ids):
+            request_ids |= self._request_ids_by_task.get(task_id, set())
+        return [dict(self._requests[request_id]) for request_id in request_ids]
+
+    def drop_tables(self) -> None:
+        self._tasks.clear()
+        self._requests.clear()
+        self._request_ids_by_task.clear()
+        self.compact()
+
+    def compact(self) -> None:
+        """Writes all the documents to a new snapshot and empties the log.
+
+        The snapshot replaces the previous one atomically, and is written before
+        the log is emptied, so a crash at any point leaves a snapshot and a log
+        that rebuild the current state (replaying batches that the snapshot
+        already contains is harmless, since they are upserts).
+        """
+        snapshot = encoding.dumps(
+            {
+                "tasks": list(self._tasks.values()),
+                "patient_requests": list(self._requests.values()),
+            }
+        )
+
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(snapshot)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self._snapshot_size = len(snapshot)
+
+        self._log.seek(0)
+        self._log.truncate()
+
+    def close(self) -> None:
+        self._log.close()
+
+    def _load(self) -> None:
+        """Rebuilds the documents from the snapshot and the log. A batch that
+        was only partially written to the end of the log is dropped."""
+        if self.snapshot_path.exists():
+            raw = self.snapshot_path.read_text(encoding="utf-8")
+            self._snapshot_size = len(raw)
+            if raw:
+                self._apply_encoded_batch(json.loads(raw))
+
+        if not self.log_path.exists():
+            return
+
+        valid_size = 0
+        with open(self.log_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    batch = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                self._apply_encoded_batch(batch)
+                valid_size += len(line)
+
+        if valid_size != self.log_path.stat().st_size:
+            os.truncate(self.log_path, valid_size)
+
+    def _append(self, batch: dict) -> None:
+        """Appends a batch as a line of the log."""
+        self._log.write(encoding.dumps(batch) + "\n")
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+
+    def _compact_if_needed(self) -> None:
+        if self._log.tell() >= max(self.min_compaction_size, self._snapshot_size):
+            self.compact()
+
+    def _apply_encoded_batch(self, batch: dict) -> None:
+        self._delete(
+            batch.get("deleted_tasks", ()), batch.get("deleted_patient_requests", ())
+        )
+        self._apply(
+            [encoding.decode_doc(doc) for doc in batch.get("tasks", ())],
+            [encoding.decode_doc(doc) for doc in batch.get("patient_requests", ())],
+        )
+
+    def _delete(self, task_ids: Iterable[str], request_ids: Iterable[str]) -> None:
+        """Removes the documents from memory and from the task index."""
+        for task_id in task_ids:
+            self._tasks.pop(task_id, None)
+
+        for request_id in request_ids:
+            request_doc = self._requests.pop(request_id, None)
+            if request_doc is not None:
+                self._unindex_request_tasks(request_id, request_doc.get("task_ids", ()))
+
+    def _apply(self, task_docs: list[dict], request_docs: list[dict]) -> None:
+        """Upserts the documents in memory and keeps the task index in sync."""
+        for task_doc in task_docs:
+            self._tasks[task_doc["id"]] = dict(task_doc)
+
+        for request_doc in request_docs:
+            request_id = request_doc["id"]
+            previous_doc = self._requests.get(request_id)
+            previous_task_ids = (
+                previous_doc.get("task_ids", set()) if previous_doc else set()
+            )
+            task_ids = set(request_doc.get("task_ids", ()))
+
+            self._unindex_request_tasks(request_id, previous_task_ids - task_ids)
+            for task_id in task_ids - previous_task_ids:
+                self._request_ids_by_task[task_id].add(request_id)
+
+            self._requests[request_id] = dict(request_doc)
+            if "task_ids" in request_doc:
+                self._requests[request_id]["task_ids"] = task_ids
+
+    def _unindex_request_tasks(self, request_id: str, task_ids: Iterable[str]) -> None:
+        """Removes request_id from the task index entries of task_ids."""
+        for task_id in task_ids:
+            self._request_ids_by_task[task_id].discard(request_id)
+            if not self._request_ids_by_task[task_id]:
+                del self._request_ids_by_task[task_id]
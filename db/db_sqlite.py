@@ -0,0 +1,217 @@
+import sqlite3
+from pathlib import Path
+from typing import Iterable
+
+from . import encoding
+from .storage import Storage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    patient_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    assigned_to TEXT NOT NULL,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_tasks_patient_id_status ON tasks (patient_id, status);
+CREATE INDEX IF NOT EXISTS ix_tasks_status ON tasks (status);
+CREATE INDEX IF NOT EXISTS ix_tasks_assigned_to ON tasks (assigned_to);
+
+CREATE TABLE IF NOT EXISTS patient_requests (
+    id TEXT PRIMARY KEY,
+    patient_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    assigned_to TEXT NOT NULL,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_patient_requests_patient_id_status
+    ON patient_requests (patient_id, status, assigned_to);
+CREATE INDEX IF NOT EXISTS ix_patient_requests_status ON patient_requests (status);
+CREATE INDEX IF NOT EXISTS ix_patient_requests_assigned_to
+    ON patient_requests (assigned_to);
+
+CREATE TABLE IF NOT EXISTS request_tasks (
+    task_id TEXT NOT NULL,
+    request_id TEXT NOT NULL,
+    PRIMARY KEY (task_id, request_id)
+);
+CREATE INDEX IF NOT EXISTS ix_request_tasks_request_id ON request_tasks (request_id);
+"""
+
+# Keeps the rowid (and so the insertion order) of documents that are replaced
+UPSERT_CLAUSE = (
+    " ON CONFLICT (id) DO UPDATE SET patient_id = excluded.patient_id,"
+    " status = excluded.status, assigned_to = excluded.assigned_to,"
+    " doc = excluded.doc"
+)
+
+
+def _where(filters: dict) -> tuple[str, list]:
+    """Builds a WHERE clause (and its parameters) out of the non None filters.
+    Iterable values are matched with IN."""
+    clauses, params = [], []
+    for column, value in filters.items():
+        if value is None:
+            continue
+        if isinstance(value, str):
+            clauses.append(f"{column} = ?")
+            params.append(value)
+        else:
+            values = list(value)
+            clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+
+    if not clauses:
+        return "", params
+
+    return " WHERE " + " AND ".join(clauses), params
+
+
+class SQLiteStorage(Storage):
+    """Storage backend on top of the stdlib sqlite3 module.
+
+    The columns that the services filter on are indexed, and the task ids of
+    every patient request are kept in the ``request_tasks`` join table, so
+    lookups don't grow with the size of the tables.
+    """
+
+    def __init__(self, path: str = "sqlite/db.sqlite3"):
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+
+    def upsert_tasks(self, task_docs: list[dict]) -> None:
+        with self.connection:
+            self._upsert_tasks(task_docs)
+
+    def _upsert_tasks(self, task_docs: list[dict]) -> None:
+        """Upserts task_docs, without committing."""
+        self.connection.executemany(
+            "INSERT INTO tasks (id, patient_id, status, assigned_to, doc)"
+            " VALUES (?, ?, ?, ?, ?)" + UPSERT_CLAUSE,
+            (
+                (
+                    task_doc["id"],
+                    task_doc["patient_id"],
+                    task_doc["status"],
+                    task_doc["assigned_to"],
+                    encoding.dumps(task_doc),
+                )
+                for task_doc in task_docs
+            ),
+        )
+
+    def get_task(self, task_id: str) -> dict | None:
+        row = self.connection.execute(
+            "SELECT doc FROM tasks WHERE id = ?", (task_id,)
+        ).fetchone()
+        return encoding.loads_doc(row[0]) if row else None
+
+    def get_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        where, params = _where({"id": set(task_ids)})
+        rows = self.connection.execute(f"SELECT doc FROM tasks{where}", params)
+        return [encoding.loads_doc(row[0]) for row in rows]
+
+    def delete_tasks(self, task_ids: Iterable[str]) -> None:
+        where, params = _where({"id": set(task_ids)})
+        with self.connection:
+            self.connection.execute(f"DELETE FROM tasks{where}", params)
+
+    def search_tasks(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+    ) -> list[dict]:
+        where, params = _where({"patient_id": patient_ids, "status": status})
+        rows = self.connection.execute(
+            f"SELECT doc FROM tasks{where} ORDER BY rowid", params
+        )
+        return [encoding.loads_doc(row[0]) for row in rows]
+
+    def upsert_patient_requests(self, request_docs: list[dict]) -> None:
+        with self.connection:
+            self._upsert_patient_requests(request_docs)
+
+    def write_batch(self, task_docs: list[dict], request_docs: list[dict]) -> None:
+        with self.connection:
+            self._upsert_tasks(task_docs)
+            self._upsert_patient_requests(request_docs)
+
+    def _upsert_patient_requests(self, request_docs: list[dict]) -> None:
+        """Upserts request_docs and their task ids, without committing."""
+        self.connection.executemany(
+            "INSERT INTO patient_requests"
+            " (id, patient_id, status, assigned_to, doc) VALUES (?, ?, ?, ?, ?)"
+            + UPSERT_CLAUSE,
+            (
+                (
+                    request_doc["id"],
+                    request_doc["patient_id"],
+                    request_doc["status"],
+                    request_doc["assigned_to"],
+                    encoding.dumps(request_doc),
+                )
+                for request_doc in request_docs
+            ),
+        )
+        self.connection.executemany(
+            "DELETE FROM request_tasks WHERE request_id = ?",
+            ((request_doc["id"],) for request_doc in request_docs),
+        )
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO request_tasks (task_id, request_id)"
+            " VALUES (?, ?)",
+            (
+                (task_id, request_doc["id"])
+                for request_doc in {d["id"]: d for d in request_docs}.values()
+                for task_id in request_doc.get("task_ids", ())
+            ),
+        )
+
+    def delete_patient_requests(self, request_ids: Iterable[str]) -> None:
+        request_ids = set(request_ids)
+        with self.connection:
+            where, params = _where({"id": request_ids})
+            self.connection.execute(f"DELETE FROM patient_requests{where}", params)
+            where, params = _where({"request_id": request_ids})
+            self.connection.execute(f"DELETE FROM request_tasks{where}", params)
+
+    def search_patient_requests(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+        assigned_to: str | None = None,
+    ) -> list[dict]:
+        where, params = _where(
+            {"patient_id": patient_ids, "status": status, "assigned_to": assigned_to}
+        )
+        rows = self.connection.execute(
+            f"SELECT doc FROM patient_requests{where} ORDER BY rowid", params
+        )
+        return [encoding.loads_doc(row[0]) for row in rows]
+
+    def search_patient_requests_by_task(self, task_id: str) -> list[dict]:
+        rows = self.connection.execute(
+            "SELECT pr.doc FROM request_tasks rt"
+            " JOIN patient_requests pr ON pr.id = rt.request_id"
+            " WHERE rt.task_id = ?",
+            (task_id,),
+        )
+        return [encoding.loads_doc(row[0]) for row in rows]
+
+    def search_patient_requests_by_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        where, params = _where({"task_id": set(task_ids)})
+        rows = self.connection.execute(
+            "SELECT doc FROM patient_requests WHERE id IN"
+            f" (SELECT request_id FROM request_tasks{where}) ORDER BY rowid",
+            params,
+        )
+        return [encoding.loads_doc(row[0]) for row in rows]
+
+    def drop_tables(self) -> None:
+        with self.connection:
+            for table in ("tasks", "patient_requests", "request_tasks"):
+                self.connection.execute(f"DELETE FROM {table}")
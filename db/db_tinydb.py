@@ -1,35 +1,198 @@
-import json
+import os
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator
 from uuid import uuid4
 
 from tinydb.storages import JSONStorage
-from tinydb_serialization import SerializationMiddleware, Serializer
-from tinydb_serialization.serializers import DateTimeSerializer
+from tinydb.table import Table
 
-from tinydb import TinyDB
+from tinydb import Query, TinyDB, storages, where
 
+from . import encoding, snapshot
+from .storage import Storage
 
-class SetSerializer(Serializer):
-    OBJ_CLASS = set
+DB_PATH = "tinydb/db.json"
+# Files with this suffix are opened with ClinicSnapshotStorage
+SNAPSHOT_SUFFIX = ".snapshot"
 
-    def encode(self, obj):
-        return json.dumps(list(obj))
+PATIENT_REQUESTS_TABLE = "PatientRequest"
+TASKS_TABLE = "Tasks"
 
-    def decode(self, s):
-        return set(json.loads(s))
+# Create a Query object for TinyDB queries
+item = Query()
 
 
-serialization = SerializationMiddleware(JSONStorage)
+class ClinicJSONStorage(JSONStorage):
+    """JSON file storage using the compact encoding of db/encoding.py (sets as
+    arrays, datetimes as epoch integers) in a single encoding pass.
 
-serialization.register_serializer(DateTimeSerializer(), "TinyDate")
-serialization.register_serializer(SetSerializer(), "TinySet")
+    Files written with the old SerializationMiddleware storage are read as well,
+    and rewritten in the compact encoding on the next write.
+    """
 
-clinic = TinyDB("tinydb/db.json", create_dirs=True, storage=serialization)
-# clinic = TinyDB(storage=MemoryStorage)
+    def read(self):
+        self._handle.seek(0, os.SEEK_END)
+        if not self._handle.tell():
+            # The file is empty, so TinyDB initializes the database
+            return None
 
-patient_requests = clinic.table("PatientRequest")
-tasks = clinic.table("Tasks")
-# either creates a new database file or accesses an existing one named `my_tiny_database`
+        self._handle.seek(0)
+        return encoding.loads_tables(self._handle.read())
+
+    def write(self, data):
+        self._handle.seek(0)
+        self._handle.write(encoding.dumps(data))
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+        # Remove what's left of the previous content if the file got shorter
+        self._handle.truncate()
+
+
+class ClinicSnapshotStorage(storages.Storage):
+    """File storage in the fast-load snapshot format of db/snapshot.py.
+
+    Unlike JSONStorage, which parses the whole file on every read, a read maps
+    the file in memory and only decodes the tables that are accessed, and the
+    tables that weren't are written back without re-encoding them.
+    """
+
+    def __init__(self, path: str, create_dirs: bool = False, **kwargs):
+        if create_dirs:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).touch()
+        self.path = path
+        # The tables of the last read, whose file mapping is closed on the next one
+        self._tables = None
+
+    def read(self):
+        self.close()
+        self._tables = snapshot.load_tables(self.path)
+        return self._tables
+
+    def write(self, data):
+        snapshot.dump_tables(self.path, data)
+
+    def close(self):
+        if self._tables is not None:
+            self._tables.close()
+            self._tables = None
+
+
+class RequestIndex:
+    """The patient requests of a database indexed by id (to their TinyDB
+    doc_id) and by task id (to the ids of the requests referencing the task)."""
+
+    def __init__(self, generation: int):
+        # The generation of the database the index was built from
+        self.generation = generation
+        self.doc_ids_by_request: dict[str, int] = {}
+        self.task_ids_by_request: dict[str, set[str]] = {}
+        self.request_ids_by_task: dict[str, set[str]] = defaultdict(set)
+
+    def index_request_tasks(self, request_id: str, task_ids: set[str]) -> None:
+        """Points the task index at request_id for exactly the given task_ids."""
+        previous_task_ids = self.task_ids_by_request.get(request_id, set())
+
+        for task_id in previous_task_ids - task_ids:
+            self.request_ids_by_task[task_id].discard(request_id)
+            if not self.request_ids_by_task[task_id]:
+                del self.request_ids_by_task[task_id]
+
+        for task_id in task_ids - previous_task_ids:
+            self.request_ids_by_task[task_id].add(request_id)
+
+        self.task_ids_by_request[request_id] = set(task_ids)
+
+    def remove_request(self, request_id: str) -> None:
+        del self.doc_ids_by_request[request_id]
+        self.index_request_tasks(request_id, set())
+        del self.task_ids_by_request[request_id]
+
+
+class ClinicTinyDB(TinyDB):
+    """TinyDB that holds the request index of the TinyDBStorages on top of it,
+    so that they all see the same index, and counts how many times its tables
+    were dropped, so that the index knows when it has to be rebuilt."""
+
+    generation = 0
+    request_index: RequestIndex | None = None
+
+    def drop_tables(self) -> None:
+        super().drop_tables()
+        self.generation += 1
+
+    def drop_table(self, name: str) -> None:
+        super().drop_table(name)
+        self.generation += 1
+
+
+_clinic: ClinicTinyDB | None = None
+
+
+def open_clinic(path: str = DB_PATH) -> ClinicTinyDB:
+    """Opens the TinyDB database at path, creating it if needed. Files ending
+    with SNAPSHOT_SUFFIX are in the fast-load snapshot format, other files are
+    JSON."""
+    storage = (
+        ClinicSnapshotStorage if path.endswith(SNAPSHOT_SUFFIX) else ClinicJSONStorage
+    )
+    return ClinicTinyDB(path, create_dirs=True, storage=storage)
+
+
+def get_clinic() -> ClinicTinyDB:
+    """Returns the process wide database, opening DB_PATH on first use (unless
+    set otherwise with set_clinic)."""
+    global _clinic
+
+    if _clinic is None:
+        _clinic = open_clinic()
+
+    return _clinic
+
+
+def set_clinic(clinic: ClinicTinyDB | None) -> None:
+    """Replaces the process wide database. Passing None opens DB_PATH again on
+    the next call to get_clinic()."""
+    global _clinic
+    _clinic = clinic
+
+
+@contextmanager
+def restoring_clinic() -> Iterator[None]:
+    """Restores the process wide database when the block ends, closing the one
+    set in the block with set_clinic (if any)."""
+    global _clinic
+
+    previous_clinic = _clinic
+    try:
+        yield
+    finally:
+        if _clinic is not None and _clinic is not previous_clinic:
+            _clinic.close()
+        _clinic = previous_clinic
+
+
+def _patient_requests() -> Table:
+    return get_clinic().table(PATIENT_REQUESTS_TABLE)
+
+
+def _tasks() -> Table:
+    return get_clinic().table(TASKS_TABLE)
+
+
+def __getattr__(name: str):
+    """Opens the database on first access of the module level clinic,
+    patient_requests and tasks, instead of when the module is imported."""
+    if name == "clinic":
+        return get_clinic()
+    if name == "patient_requests":
+        return _patient_requests()
+    if name == "tasks":
+        return _tasks()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def init_db():
@@ -38,6 +201,7 @@ def init_db():
         "\n--------------------------------------------\nInitializing the PatientRequest table"
     )
 
+    patient_requests = _patient_requests()
     existing_docs = len(patient_requests)
     if existing_docs > 100:
         print(f"PatientRequest table already initialized with {existing_docs} requests")
@@ -59,5 +223,207 @@ def init_db():
     ]
 
     patient_requests.insert_multiple(generated_requests)
+    # Written to the table directly, so the request index is rebuilt
+    get_clinic().request_index = None
 
     print(f"Inserted {len(patient_requests)} patient requests")
+
+
+def _update_tables(updaters: dict) -> None:
+    """Applies each updater to its table's documents (a {doc_id: document} dict)
+    with a single read and a single write of the storage, for all the tables.
+
+    This mirrors TinyDB's own (per table) Table._update_table, which all of its
+    write operations are built on.
+    """
+    clinic = get_clinic()
+    data = clinic.storage.read() or {}
+
+    for table, updater in updaters.items():
+        documents = {
+            table.document_id_class(doc_id): doc
+            for doc_id, doc in data.get(table.name, {}).items()
+        }
+        updater(documents)
+        data[table.name] = {str(doc_id): doc for doc_id, doc in documents.items()}
+
+    clinic.storage.write(data)
+
+    for table in updaters:
+        table.clear_cache()
+        # Let TinyDB recompute the next doc_id, since the updater may have added documents
+        table._next_id = None
+
+
+class TinyDBStorage(Storage):
+    """Storage backend on top of the process wide TinyDB tables (see
+    get_clinic).
+
+    Patient requests are indexed in memory by id (to their TinyDB doc_id) and
+    by task id (to the ids of the requests referencing the task), so that
+    finding the request(s) owning a task doesn't scan the table. The index
+    (see RequestIndex) is kept on the database, so every TinyDBStorage of the
+    database uses the same one. It is built on first use and kept in sync by
+    upsert_patient_request, so requests must not be written to the table
+    directly.
+    """
+
+    def upsert_tasks(self, task_docs: list[dict]) -> None:
+        self.write_batch(task_docs=task_docs, request_docs=[])
+
+    def get_task(self, task_id: str) -> dict | None:
+        return _tasks().get(where("id") == task_id)
+
+    def get_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        return _tasks().search(item.id.one_of(set(task_ids)))
+
+    def delete_tasks(self, task_ids: Iterable[str]) -> None:
+        task_ids = set(task_ids)
+        if not _tasks().contains(item.id.one_of(task_ids)):
+            return
+
+        def updater(table: dict):
+            for doc_id in [d_id for d_id, d in table.items() if d["id"] in task_ids]:
+                del table[doc_id]
+
+        _update_tables({_tasks(): updater})
+
+    def search_tasks(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+    ) -> list[dict]:
+        query = item.noop()
+        if patient_ids is not None:
+            query &= item.patient_id.one_of(set(patient_ids))
+        if status is not None:
+            query &= where("status") == status
+
+        return _tasks().search(query)
+
+    def upsert_patient_requests(self, request_docs: list[dict]) -> None:
+        self.write_batch(task_docs=[], request_docs=request_docs)
+
+    def write_batch(self, task_docs: list[dict], request_docs: list[dict]) -> None:
+        updaters = {}
+        if task_docs:
+            updaters[_tasks()] = self._tasks_updater(task_docs)
+        if request_docs:
+            index = self._request_index()
+            updaters[_patient_requests()] = self._requests_updater(index, request_docs)
+
+        if not updaters:
+            return
+
+        _update_tables(updaters)
+
+        for request_doc in request_docs:
+            index.index_request_tasks(
+                request_doc["id"], request_doc.get("task_ids", set())
+            )
+
+    def delete_patient_requests(self, request_ids: Iterable[str]) -> None:
+        index = self._request_index()
+
+        request_ids = set(request_ids) & index.doc_ids_by_request.keys()
+        if not request_ids:
+            return
+
+        doc_ids = {index.doc_ids_by_request[r_id] for r_id in request_ids}
+
+        def updater(table: dict):
+            for doc_id in doc_ids:
+                table.pop(doc_id, None)
+
+        _update_tables({_patient_requests(): updater})
+
+        for request_id in request_ids:
+            index.remove_request(request_id)
+
+    def search_patient_requests(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+        assigned_to: str | None = None,
+    ) -> list[dict]:
+        query = item.noop()
+        if patient_ids is not None:
+            query &= item.patient_id.one_of(set(patient_ids))
+        if status is not None:
+            query &= where("status") == status
+        if assigned_to is not None:
+            query &= where("assigned_to") == assigned_to
+
+        return _patient_requests().search(query)
+
+    def search_patient_requests_by_task(self, task_id: str) -> list[dict]:
+        return self.search_patient_requests_by_tasks([task_id])
+
+    def search_patient_requests_by_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        index = self._request_index()
+
+        request_ids = set()
+        for task_id in set(task_ids):
+            request_ids |= index.request_ids_by_task.get(task_id, set())
+        if not request_ids:
+            return []
+
+        return _patient_requests().get(
+            doc_ids=[index.doc_ids_by_request[r_id] for r_id in request_ids]
+        )
+
+    def drop_tables(self) -> None:
+        get_clinic().drop_tables()
+
+    @staticmethod
+    def _tasks_updater(task_docs: list[dict]):
+        """Returns a table updater that upserts task_docs by their id."""
+
+        def updater(table: dict):
+            doc_ids_by_task = {doc["id"]: doc_id for doc_id, doc in table.items()}
+            next_doc_id = max(table, default=0) + 1
+
+            for task_doc in task_docs:
+                doc_id = doc_ids_by_task.get(task_doc["id"])
+                if doc_id is None:
+                    doc_id = doc_ids_by_task[task_doc["id"]] = next_doc_id
+                    next_doc_id += 1
+                table[doc_id] = dict(task_doc)
+
+        return updater
+
+    @staticmethod
+    def _requests_updater(index: RequestIndex, request_docs: list[dict]):
+        """Returns a table updater that upserts request_docs by their id, using
+        (and extending) the request id -> doc_id index."""
+
+        def updater(table: dict):
+            next_doc_id = max(table, default=0) + 1
+
+            for request_doc in request_docs:
+                doc_id = index.doc_ids_by_request.get(request_doc["id"])
+                if doc_id is None:
+                    doc_id = index.doc_ids_by_request[request_doc["id"]] = next_doc_id
+                    next_doc_id += 1
+                table[doc_id] = dict(request_doc)
+
+        return updater
+
+    @staticmethod
+    def _request_index() -> RequestIndex:
+        """Returns the request index of the database, (re)building it if it
+        wasn't built yet, or if the tables were dropped since it was built."""
+        clinic = get_clinic()
+        index = clinic.request_index
+        if index is not None and index.generation == clinic.generation:
+            return index
+
+        index = RequestIndex(clinic.generation)
+        for request_doc in _patient_requests().all():
+            index.doc_ids_by_request[request_doc["id"]] = request_doc.doc_id
+            index.index_request_tasks(
+                request_doc["id"], request_doc.get("task_ids", set())
+            )
+
+        clinic.request_index = index
+        return index
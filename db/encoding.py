@@ -0,0 +1,90 @@
+"""Compact JSON encoding of the clinic documents.
+
+Sets are stored as JSON arrays and timezone aware datetimes as integer
+microseconds since the epoch (naive datetimes, which can't be placed on the
+epoch without guessing their timezone, are stored as ISO strings). Encoding is a
+single json.dumps pass, and decoding only converts the known set and datetime
+fields of each document (see DATE_FIELDS and SET_FIELDS).
+
+Documents written with the old tinydb-serialization tags ("{TinyDate}:..." and
+"{TinySet}:...") are decoded as well, see migrate_db_file.
+"""
+
+import json
+from datetime import datetime, timedelta, timezone
+from os import PathLike
+
+DATE_FIELDS = frozenset({"created_date", "updated_date"})
+SET_FIELDS = frozenset({"task_ids"})
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+LEGACY_DATE_TAG = "{TinyDate}:"
+LEGACY_SET_TAG = "{TinySet}:"
+
+
+def _default(obj):
+    """json.dumps hook for the types JSON doesn't support natively."""
+    if isinstance(obj, datetime):
+        if obj.tzinfo is None:
+            return obj.isoformat()
+        return (obj - EPOCH) // timedelta(microseconds=1)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def decode_doc(doc: dict) -> dict:
+    """Decodes, in place, the set and datetime fields of a document that was
+    loaded from JSON. Returns doc."""
+    for field in DATE_FIELDS:
+        value = doc.get(field)
+        if isinstance(value, int):
+            doc[field] = EPOCH + timedelta(microseconds=value)
+        elif isinstance(value, str):
+            doc[field] = datetime.fromisoformat(value.removeprefix(LEGACY_DATE_TAG))
+
+    for field in SET_FIELDS:
+        value = doc.get(field)
+        if isinstance(value, list):
+            doc[field] = set(value)
+        elif isinstance(value, str):
+            doc[field] = set(json.loads(value.removeprefix(LEGACY_SET_TAG)))
+
+    return doc
+
+
+def dumps(obj) -> str:
+    """Encodes a document, or TinyDB's {table name: {doc_id: document}} data,
+    as compact JSON."""
+    return json.dumps(obj, default=_default, separators=(",", ":"))
+
+
+def loads_doc(raw: str) -> dict:
+    """Decodes a single document encoded by dumps."""
+    return decode_doc(json.loads(raw))
+
+
+def loads_tables(raw: str) -> dict:
+    """Decodes TinyDB's {table name: {doc_id: document}} data encoded by dumps
+    (or by the old tinydb-serialization storage)."""
+    tables = json.loads(raw)
+    for table in tables.values():
+        for doc in table.values():
+            decode_doc(doc)
+    return tables
+
+
+def migrate_db_file(path: PathLike) -> None:
+    """Rewrites a TinyDB JSON file written with the old tinydb-serialization
+    storage (tagged datetime and set strings) in the compact encoding.
+    Files that are already in the compact encoding are left as they are."""
+    with open(path) as f:
+        raw = f.read()
+
+    if not raw or (LEGACY_DATE_TAG not in raw and LEGACY_SET_TAG not in raw):
+        return
+
+    encoded = dumps(loads_tables(raw))
+    with open(path, "w") as f:
+        f.write(encoded)
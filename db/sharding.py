@@ -0,0 +1,187 @@
+from collections import defaultdict
+from typing import Callable, Iterable
+from zlib import crc32
+
+from .storage import Storage
+
+
+def shard_for(patient_id: str, shard_count: int) -> int:
+    """Returns the shard (0 to shard_count - 1) that patient_id belongs to.
+
+    The hash is stable across processes and runs (unlike the builtin hash()),
+    so a patient always maps to the same shard for a given shard_count.
+    """
+    return crc32(patient_id.encode()) % shard_count
+
+
+class ShardedStorage(Storage):
+    """Storage that partitions the documents across several storages (shards) by
+    a stable hash of their patient_id (see shard_for).
+
+    Writes are split by shard, so a batch only writes the shards of its patients
+    (each with a single write_batch), and searches by patient only query the
+    shards of those patients. Lookups by id can't be routed, so they query all
+    the shards, unless the storage was scoped to the patients of the update with
+    for_patients (as the services do).
+
+    A task can't move to a patient of another shard, since its stored version
+    (and its request) would stay in the previous shard: TaskService rejects
+    such updates, which means that the tasks that aren't found in the shards of
+    their patients (e.g. new tasks) are looked up in the other shards too.
+
+    Every shard is written with its own write_batch, so a failing batch may
+    leave the shards written before the failure updated. All the documents of a
+    patient are in the same shard, so each patient is updated completely or not
+    at all. Shards in separate files (e.g. with SQLiteShardStorageFactory) can
+    be written by separate processes, as ParallelClinicManager does.
+
+    Example:
+        storage = ShardedStorage.open(SQLiteShardStorageFactory(), shard_count=8)
+        clinic_manager = ClinicManager(storage=storage)
+    """
+
+    def __init__(self, shards: list[Storage], shard_ids: Iterable[int] = None):
+        """
+        Args:
+            shards (list[Storage]): The storage of every shard. Their number and
+                order decide where the documents of a patient are, so they must
+                stay the same for the same data.
+            shard_ids (Iterable[int]): The shards that lookups by id (and searches
+                of all the patients) query, defaults to all of them.
+        """
+        self.shards = list(shards)
+        self.shard_ids = sorted(
+            range(len(self.shards)) if shard_ids is None else set(shard_ids)
+        )
+
+    @classmethod
+    def open(
+        cls, storage_factory: Callable[[int], Storage], shard_count: int
+    ) -> "ShardedStorage":
+        """Opens the storage of every shard with storage_factory(shard)."""
+        return cls([storage_factory(shard) for shard in range(shard_count)])
+
+    def shard_for(self, patient_id: str) -> int:
+        return shard_for(patient_id, len(self.shards))
+
+    def partition_for(self, patient_id: str) -> int:
+        return self.shard_for(patient_id)
+
+    def for_patients(self, patient_ids: Iterable[str]) -> "ShardedStorage":
+        return ShardedStorage(
+            self.shards, {self.shard_for(patient_id) for patient_id in patient_ids}
+        )
+
+    def _split_docs(self, docs: Iterable[dict]) -> dict[int, list[dict]]:
+        """Groups docs by the shard of their patient_id, keeping their order."""
+        docs_by_shard = defaultdict(list)
+        for doc in docs:
+            docs_by_shard[self.shard_for(doc["patient_id"])].append(doc)
+        return docs_by_shard
+
+    def _split_patients(
+        self, patient_ids: Iterable[str] | None
+    ) -> dict[int, set[str] | None]:
+        """Groups patient_ids by shard, or returns all the shards (without a
+        patient filter) when patient_ids is None."""
+        if patient_ids is None:
+            return {shard: None for shard in self.shard_ids}
+
+        patient_ids_by_shard = defaultdict(set)
+        for patient_id in patient_ids:
+            patient_ids_by_shard[self.shard_for(patient_id)].add(patient_id)
+        return patient_ids_by_shard
+
+    def upsert_tasks(self, task_docs: list[dict]) -> None:
+        for shard, shard_task_docs in self._split_docs(task_docs).items():
+            self.shards[shard].upsert_tasks(shard_task_docs)
+
+    def get_task(self, task_id: str) -> dict | None:
+        for shard in self.shard_ids:
+            task_doc = self.shards[shard].get_task(task_id)
+            if task_doc is not None:
+                return task_doc
+        return None
+
+    def get_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        task_ids = set(task_ids)
+        task_docs = []
+        for shard in self.shard_ids:
+            if not task_ids:
+                break
+            shard_task_docs = self.shards[shard].get_tasks(task_ids)
+            task_ids -= {task_doc["id"] for task_doc in shard_task_docs}
+            task_docs += shard_task_docs
+        return task_docs
+
+    def delete_tasks(self, task_ids: Iterable[str]) -> None:
+        task_ids = set(task_ids)
+        for shard in self.shard_ids:
+            self.shards[shard].delete_tasks(task_ids)
+
+    def search_tasks(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+    ) -> list[dict]:
+        return [
+            task_doc
+            for shard, shard_patient_ids in self._split_patients(patient_ids).items()
+            for task_doc in self.shards[shard].search_tasks(
+                patient_ids=shard_patient_ids, status=status
+            )
+        ]
+
+    def upsert_patient_requests(self, request_docs: list[dict]) -> None:
+        for shard, shard_request_docs in self._split_docs(request_docs).items():
+            self.shards[shard].upsert_patient_requests(shard_request_docs)
+
+    def search_patient_requests(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+        assigned_to: str | None = None,
+    ) -> list[dict]:
+        return [
+            request_doc
+            for shard, shard_patient_ids in self._split_patients(patient_ids).items()
+            for request_doc in self.shards[shard].search_patient_requests(
+                patient_ids=shard_patient_ids, status=status, assigned_to=assigned_to
+            )
+        ]
+
+    def search_patient_requests_by_task(self, task_id: str) -> list[dict]:
+        return [
+            request_doc
+            for shard in self.shard_ids
+            for request_doc in self.shards[shard].search_patient_requests_by_task(
+                task_id
+            )
+        ]
+
+    def search_patient_requests_by_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        task_ids = set(task_ids)
+        return [
+            request_doc
+            for shard in self.shard_ids
+            for request_doc in self.shards[shard].search_patient_requests_by_tasks(
+                task_ids
+            )
+        ]
+
+    def delete_patient_requests(self, request_ids: Iterable[str]) -> None:
+        request_ids = set(request_ids)
+        for shard in self.shard_ids:
+            self.shards[shard].delete_patient_requests(request_ids)
+
+    def write_batch(self, task_docs: list[dict], request_docs: list[dict]) -> None:
+        task_docs_by_shard = self._split_docs(task_docs)
+        request_docs_by_shard = self._split_docs(request_docs)
+        for shard in sorted(task_docs_by_shard.keys() | request_docs_by_shard.keys()):
+            self.shards[shard].write_batch(
+                task_docs_by_shard.get(shard, []), request_docs_by_shard.get(shard, [])
+            )
+
+    def drop_tables(self) -> None:
+        for shard in self.shard_ids:
+            self.shards[shard].drop_tables()
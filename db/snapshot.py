@@ -0,0 +1,140 @@
+"""Fast-load snapshot format of TinyDB's {table name: {doc_id: document}} data.
+
+The file starts with a one line header, followed by every table encoded on its
+own (with db/encoding.py) one after the other:
+
+    CLINICSNAP1 {"Tasks": [offset, length], "PatientRequest": [offset, length]}
+    {"1": {...}, "2": {...}}{"1": {...}}
+
+Offsets are relative to the end of the header line. Reading maps the file in
+memory and only parses the header: a table is decoded the first time it's
+accessed, and the tables that are never accessed are written back as they were,
+without decoding and re-encoding them. So opening the database, or reading one
+table, doesn't grow with the size of the other tables.
+
+The mapping is closed once every table was decoded, once the tables were
+written back with dump_tables, or with SnapshotTables.close().
+"""
+
+import json
+import mmap
+import os
+from collections.abc import MutableMapping
+from os import PathLike
+from typing import Iterator
+
+from . import encoding
+
+MAGIC = b"CLINICSNAP1 "
+
+
+class SnapshotTables(MutableMapping):
+    """The tables of a snapshot file, decoded on first access."""
+
+    def __init__(self, buffer: bytes | mmap.mmap, sections: dict, body_offset: int):
+        self._buffer = buffer
+        # The (offset, length) of the tables that weren't decoded yet
+        self._sections: dict[str, tuple[int, int]] = {
+            name: (body_offset + offset, length)
+            for name, (offset, length) in sections.items()
+        }
+        self._tables: dict[str, dict] = {}
+
+    def raw_table(self, name: str) -> bytes | None:
+        """Returns the encoded table if it wasn't decoded, None otherwise."""
+        if name not in self._sections:
+            return None
+        offset, length = self._sections[name]
+        return self._buffer[offset : offset + length]
+
+    def __getitem__(self, name: str) -> dict:
+        if name not in self._tables:
+            raw = self.raw_table(name)
+            if raw is None:
+                raise KeyError(name)
+            self._tables[name] = encoding.loads_tables(b'{"t":' + raw + b"}")["t"]
+            del self._sections[name]
+            if not self._sections:
+                # Nothing is left to read from the file
+                self.close()
+        return self._tables[name]
+
+    def __setitem__(self, name: str, table: dict) -> None:
+        self._sections.pop(name, None)
+        self._tables[name] = table
+
+    def __delitem__(self, name: str) -> None:
+        if name not in self._sections and name not in self._tables:
+            raise KeyError(name)
+        self._sections.pop(name, None)
+        self._tables.pop(name, None)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._sections
+        yield from self._tables
+
+    def __len__(self) -> int:
+        return len(self._sections) + len(self._tables)
+
+    def close(self) -> None:
+        """Closes the file mapping. The tables that weren't decoded can't be
+        accessed anymore."""
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+    def __enter__(self) -> "SnapshotTables":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def load_tables(path: PathLike) -> SnapshotTables | None:
+    """Maps the snapshot file at path in memory and returns its (not yet
+    decoded) tables, or None if the file is empty."""
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return None
+        # The mapping stays valid once the file is closed
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header_end = buffer.find(b"\n")
+    header = buffer[:header_end]
+    if not header.startswith(MAGIC):
+        buffer.close()
+        raise ValueError(f"{path} is not a clinic snapshot file")
+
+    sections = json.loads(header[len(MAGIC) :])
+    return SnapshotTables(buffer, sections, header_end + 1)
+
+
+def dump_tables(path: PathLike, tables: MutableMapping) -> None:
+    """Writes tables to the snapshot file at path, replacing it atomically.
+
+    The tables of a SnapshotTables that weren't decoded are copied as is, and
+    its mapping is then closed, since the file it maps gets replaced.
+    """
+    encoded_tables = {}
+    for name in tables:
+        raw = None
+        if isinstance(tables, SnapshotTables):
+            raw = tables.raw_table(name)
+        encoded_tables[name] = (
+            raw if raw is not None else encoding.dumps(tables[name]).encode()
+        )
+    if isinstance(tables, SnapshotTables):
+        tables.close()
+
+    sections, offset = {}, 0
+    for name, raw in encoded_tables.items():
+        sections[name] = [offset, len(raw)]
+        offset += len(raw)
+
+    tmp_path = f"{os.fspath(path)}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + json.dumps(sections, separators=(",", ":")).encode() + b"\n")
+        for raw in encoded_tables.values():
+            f.write(raw)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,171 @@
+from abc import ABC, abstractmethod
+from typing import Hashable, Iterable
+
+
+def matches_filters(doc: dict, filters: dict) -> bool:
+    """Returns True if doc matches all the non None filters, as the storages'
+    search methods do (iterable values are matched with IN)."""
+    for field, value in filters.items():
+        if value is None:
+            continue
+        if isinstance(value, str):
+            if doc.get(field) != value:
+                return False
+        elif doc.get(field) not in value:
+            return False
+    return True
+
+
+class Storage(ABC):
+    """Abstract base class for the clinic storage backends.
+
+    The services only talk to the DB through this interface. Documents are
+    plain dicts, as produced by ``model_dump()`` on the models, and are returned
+    in the same shape (datetimes as ``datetime`` and task_ids as ``set``).
+    """
+
+    @abstractmethod
+    def upsert_tasks(self, task_docs: list[dict]) -> None:
+        """Inserts the task documents, or replaces the stored tasks with the same
+        ids, as a single batch. Later documents win over earlier ones with the same id.
+        """
+        raise NotImplementedError
+
+    def upsert_task(self, task_doc: dict) -> None:
+        """Inserts the task document, or replaces the stored task with the same id."""
+        self.upsert_tasks([task_doc])
+
+    @abstractmethod
+    def get_task(self, task_id: str) -> dict | None:
+        """Returns the task document with the given id, or None if not found."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        """Returns the task documents with the given ids (ids that are not found
+        are skipped), with a single lookup."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_tasks(self, task_ids: Iterable[str]) -> None:
+        """Removes the tasks with the given ids (ids that are not found are skipped)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def search_tasks(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+    ) -> list[dict]:
+        """Returns the task documents matching all the given (non None) filters."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def upsert_patient_requests(self, request_docs: list[dict]) -> None:
+        """Inserts the patient request documents, or replaces the stored requests
+        with the same ids, as a single batch. Later documents win over earlier ones
+        with the same id."""
+        raise NotImplementedError
+
+    def upsert_patient_request(self, request_doc: dict) -> None:
+        """Inserts the patient request document, or replaces the stored request
+        with the same id."""
+        self.upsert_patient_requests([request_doc])
+
+    @abstractmethod
+    def search_patient_requests(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+        assigned_to: str | None = None,
+    ) -> list[dict]:
+        """Returns the patient request documents matching all the given
+        (non None) filters."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def search_patient_requests_by_task(self, task_id: str) -> list[dict]:
+        """Returns the patient request documents that reference task_id."""
+        raise NotImplementedError
+
+    def search_patient_requests_by_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        """Returns the patient request documents that reference any of task_ids
+        (each document once). Backends override it to use a single lookup."""
+        request_docs = {}
+        for task_id in set(task_ids):
+            for request_doc in self.search_patient_requests_by_task(task_id):
+                request_docs.setdefault(request_doc["id"], request_doc)
+        return list(request_docs.values())
+
+    @abstractmethod
+    def delete_patient_requests(self, request_ids: Iterable[str]) -> None:
+        """Removes the patient requests with the given ids (ids that are not found
+        are skipped)."""
+        raise NotImplementedError
+
+    def search_archived_tasks(
+        self, patient_ids: Iterable[str] | None = None
+    ) -> list[dict]:
+        """Returns the closed (history) task documents, see ArchivingStorage."""
+        return self.search_tasks(patient_ids=patient_ids, status="Closed")
+
+    def search_archived_patient_requests(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        assigned_to: str | None = None,
+    ) -> list[dict]:
+        """Returns the closed (history) patient request documents, see
+        ArchivingStorage."""
+        return self.search_patient_requests(
+            patient_ids=patient_ids, status="Closed", assigned_to=assigned_to
+        )
+
+    def write_batch(self, task_docs: list[dict], request_docs: list[dict]) -> None:
+        """Upserts both the task and the patient request documents. Backends that
+        can do so apply both as a single (atomic) write."""
+        self.upsert_tasks(task_docs)
+        self.upsert_patient_requests(request_docs)
+
+    @abstractmethod
+    def drop_tables(self) -> None:
+        """Removes all the documents from the storage. **CANNOT BE REVERSED!**"""
+        raise NotImplementedError
+
+    def for_patients(self, patient_ids: Iterable[str]) -> "Storage":
+        """Returns the storage to use for documents of patient_ids only.
+
+        Storages partitioned by patient (see db/sharding.py ShardedStorage)
+        return a storage whose lookups by id skip the partitions of other
+        patients. Other storages return themselves.
+        """
+        return self
+
+    def partition_for(self, patient_id: str) -> Hashable | None:
+        """Returns the partition that holds the documents of patient_id in a
+        storage partitioned by patient (see db/sharding.py ShardedStorage), or
+        None if the storage isn't partitioned. Storages that wrap other storages
+        return the partition of the wrapped storage.
+        """
+        return None
+
+
+_default_storage: Storage | None = None
+
+
+def get_storage() -> Storage:
+    """Returns the process wide default storage (TinyDB unless set otherwise)."""
+    global _default_storage
+
+    if _default_storage is None:
+        from .db_tinydb import TinyDBStorage
+
+        _default_storage = TinyDBStorage()
+
+    return _default_storage
+
+
+def set_storage(storage: Storage | None) -> None:
+    """Replaces the process wide default storage. Passing None restores the
+    TinyDB default on the next call to get_storage()."""
+    global _default_storage
+    _default_storage = storage
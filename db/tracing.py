@@ -0,0 +1,275 @@
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Generator, Hashable, Iterable, NamedTuple
+
+from .storage import Storage
+
+WRITE_OPERATIONS = frozenset(
+    {
+        "upsert_tasks",
+        "upsert_patient_requests",
+        "write_batch",
+        "delete_tasks",
+        "delete_patient_requests",
+        "drop_tables",
+    }
+)
+
+
+class QueryRecord(NamedTuple):
+    """A storage operation: its arguments (the predicate, for reads), the number
+    of documents it returned (or wrote) and how long it took."""
+
+    operation: str
+    predicate: dict
+    rows: int
+    seconds: float
+
+    @property
+    def is_write(self) -> bool:
+        return self.operation in WRITE_OPERATIONS
+
+
+class UpdateTrace:
+    """The storage operations issued by an update (e.g. a process_tasks_update)."""
+
+    def __init__(self, label: str | None = None):
+        self.label = label
+        self.records: list[QueryRecord] = []
+
+    @property
+    def reads(self) -> list[QueryRecord]:
+        return [record for record in self.records if not record.is_write]
+
+    @property
+    def writes(self) -> list[QueryRecord]:
+        return [record for record in self.records if record.is_write]
+
+    def operation_counts(self) -> Counter:
+        return Counter(record.operation for record in self.records)
+
+    def repeated_operations(self, threshold: int = 2) -> dict[str, int]:
+        """Returns the operations issued more than threshold times, which usually
+        means a query per item (N+1) rather than a query per update."""
+        return {
+            operation: count
+            for operation, count in self.operation_counts().items()
+            if count > threshold
+        }
+
+    def report(self) -> str:
+        lines = [f"Update {self.label or ''}: {len(self.records)} storage operations"]
+        lines += [
+            f"  {r.operation}({r.predicate}) -> {r.rows} rows in {r.seconds * 1000:.2f} ms"
+            for r in self.records
+        ]
+        return "\n".join(lines)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when an update issues more storage operations than its budget."""
+
+
+class QueryBudget:
+    """Limits on the storage operations of an update. None means no limit.
+
+    Args:
+        max_reads (int | None): The maximum number of read operations.
+        max_writes (int | None): The maximum number of write operations.
+        max_per_operation (int | None): The maximum number of calls of any single
+            operation, which catches N+1 patterns whatever the batch size.
+    """
+
+    def __init__(
+        self,
+        max_reads: int | None = None,
+        max_writes: int | None = None,
+        max_per_operation: int | None = None,
+    ):
+        self.max_reads = max_reads
+        self.max_writes = max_writes
+        self.max_per_operation = max_per_operation
+
+    def check(self, trace: UpdateTrace) -> None:
+        """Raises QueryBudgetExceeded if trace goes over the budget."""
+        violations = []
+        if self.max_reads is not None and len(trace.reads) > self.max_reads:
+            violations.append(f"{len(trace.reads)} reads > {self.max_reads}")
+        if self.max_writes is not None and len(trace.writes) > self.max_writes:
+            violations.append(f"{len(trace.writes)} writes > {self.max_writes}")
+        if self.max_per_operation is not None:
+            violations += [
+                f"{count} calls of {operation} > {self.max_per_operation}"
+                for operation, count in trace.repeated_operations(
+                    self.max_per_operation
+                ).items()
+            ]
+
+        if violations:
+            raise QueryBudgetExceeded(
+                f"Query budget exceeded ({', '.join(violations)})\n{trace.report()}"
+            )
+
+
+class TracingStorage(Storage):
+    """Storage that wraps another storage and records every operation issued
+    through it, grouped by update.
+
+    Wrap each process_tasks_update in update() to get its trace (and to check it
+    against the budget). Since ClinicManager buffers the writes of an update in a
+    unit of work on top of its storage, the trace holds the reads that reached
+    the storage and the single write_batch of the update.
+
+    Example:
+        storage = TracingStorage(SQLiteStorage(), budget=QueryBudget(max_reads=3))
+        clinic_manager = ClinicManager(storage=storage)
+        with storage.update("input 1") as trace:
+            clinic_manager.process_tasks_update(task_input)
+        print(trace.report())
+    """
+
+    def __init__(self, storage: Storage, budget: QueryBudget | None = None):
+        self.storage = storage
+        self.budget = budget
+        self.traces: list[UpdateTrace] = []
+        self._trace: UpdateTrace | None = None
+
+    @contextmanager
+    def update(self, label: str | None = None) -> Generator[UpdateTrace, None, None]:
+        """Groups the operations issued in the block into a new UpdateTrace, and
+        checks it against the budget (unless the block raised)."""
+        if self._trace is not None:
+            raise RuntimeError("An update is already being traced")
+
+        trace = self._trace = UpdateTrace(label)
+        try:
+            yield trace
+        finally:
+            self._trace = None
+            self.traces.append(trace)
+
+        if self.budget is not None:
+            self.budget.check(trace)
+
+    def _record(
+        self, operation: str, predicate: dict, call: Callable, rows: Callable = len
+    ):
+        start = time.perf_counter()
+        result = call()
+        seconds = time.perf_counter() - start
+
+        if self._trace is not None:
+            self._trace.records.append(
+                QueryRecord(operation, predicate, rows(result), seconds)
+            )
+        return result
+
+    def upsert_tasks(self, task_docs: list[dict]) -> None:
+        self._record(
+            "upsert_tasks",
+            {},
+            lambda: self.storage.upsert_tasks(task_docs),
+            rows=lambda _: len(task_docs),
+        )
+
+    def get_task(self, task_id: str) -> dict | None:
+        return self._record(
+            "get_task",
+            {"id": task_id},
+            lambda: self.storage.get_task(task_id),
+            rows=lambda task_doc: int(task_doc is not None),
+        )
+
+    def get_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        task_ids = set(task_ids)
+        return self._record(
+            "get_tasks", {"ids": task_ids}, lambda: self.storage.get_tasks(task_ids)
+        )
+
+    def delete_tasks(self, task_ids: Iterable[str]) -> None:
+        task_ids = set(task_ids)
+        self._record(
+            "delete_tasks",
+            {"ids": task_ids},
+            lambda: self.storage.delete_tasks(task_ids),
+            rows=lambda _: len(task_ids),
+        )
+
+    def search_tasks(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+    ) -> list[dict]:
+        if patient_ids is not None:
+            patient_ids = set(patient_ids)
+
+        return self._record(
+            "search_tasks",
+            {"patient_ids": patient_ids, "status": status},
+            lambda: self.storage.search_tasks(patient_ids=patient_ids, status=status),
+        )
+
+    def upsert_patient_requests(self, request_docs: list[dict]) -> None:
+        self._record(
+            "upsert_patient_requests",
+            {},
+            lambda: self.storage.upsert_patient_requests(request_docs),
+            rows=lambda _: len(request_docs),
+        )
+
+    def delete_patient_requests(self, request_ids: Iterable[str]) -> None:
+        request_ids = set(request_ids)
+        self._record(
+            "delete_patient_requests",
+            {"ids": request_ids},
+            lambda: self.storage.delete_patient_requests(request_ids),
+            rows=lambda _: len(request_ids),
+        )
+
+    def search_patient_requests(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+        assigned_to: str | None = None,
+    ) -> list[dict]:
+        if patient_ids is not None:
+            patient_ids = set(patient_ids)
+
+        return self._record(
+            "search_patient_requests",
+            {"patient_ids": patient_ids, "status": status, "assigned_to": assigned_to},
+            lambda: self.storage.search_patient_requests(
+                patient_ids=patient_ids, status=status, assigned_to=assigned_to
+            ),
+        )
+
+    def search_patient_requests_by_task(self, task_id: str) -> list[dict]:
+        return self._record(
+            "search_patient_requests_by_task",
+            {"task_id": task_id},
+            lambda: self.storage.search_patient_requests_by_task(task_id),
+        )
+
+    def search_patient_requests_by_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        task_ids = set(task_ids)
+        return self._record(
+            "search_patient_requests_by_tasks",
+            {"task_ids": task_ids},
+            lambda: self.storage.search_patient_requests_by_tasks(task_ids),
+        )
+
+    def write_batch(self, task_docs: list[dict], request_docs: list[dict]) -> None:
+        self._record(
+            "write_batch",
+            {},
+            lambda: self.storage.write_batch(task_docs, request_docs),
+            rows=lambda _: len(task_docs) + len(request_docs),
+        )
+
+    def partition_for(self, patient_id: str) -> Hashable | None:
+        # Not a query of the storage, so it isn't recorded
+        return self.storage.partition_for(patient_id)
+
+    def drop_tables(self) -> None:
+        self._record("drop_tables", {}, self.storage.drop_tables, rows=lambda _: 0)
@@ -0,0 +1,265 @@
+import copy
+from contextlib import contextmanager
+from typing import Hashable, Iterable, Iterator
+
+from metrics import DeferredCounts, get_metrics
+
+from .storage import Storage, matches_filters
+
+
+class UnitOfWork(Storage):
+    """Storage that wraps another storage and, while a unit of work is active,
+    buffers all the writes and applies them with a single write_batch() when
+    the unit of work ends.
+
+    Reads made during the unit of work see the buffered writes. If the unit of
+    work ends with an exception, the buffered writes are discarded, so nothing
+    done during it reaches the wrapped storage. Outside of a unit of work,
+    all calls go straight to the wrapped storage.
+
+    The counters of the writes (see deferred_counts) are reported to the metrics
+    once the buffered writes are applied, and dropped with them otherwise.
+
+    Example:
+        with unit_of_work:
+            task_service.updates_tasks(tasks)
+            patient_request_service.update_requests(tasks)
+    """
+
+    def __init__(self, storage: Storage):
+        self.storage = storage
+        self._task_docs: dict[str, dict] | None = None
+        self._request_docs: dict[str, dict] | None = None
+        self._deleted_task_ids: set[str] = set()
+        self._deleted_request_ids: set[str] = set()
+        self.counts: DeferredCounts | None = None
+
+    @property
+    def active(self) -> bool:
+        return self._task_docs is not None
+
+    def __enter__(self):
+        if self.active:
+            raise RuntimeError("A unit of work is already active")
+
+        self._task_docs = {}
+        self._request_docs = {}
+        self.counts = DeferredCounts()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        task_docs, request_docs = self._task_docs, self._request_docs
+        deleted_task_ids, self._deleted_task_ids = self._deleted_task_ids, set()
+        deleted_request_ids, self._deleted_request_ids = (
+            self._deleted_request_ids,
+            set(),
+        )
+        self._task_docs = self._request_docs = None
+        counts, self.counts = self.counts, None
+
+        if exc_type is not None:
+            return
+
+        metrics = get_metrics()
+        with metrics.timer("write_batch"):
+            if task_docs or request_docs:
+                self.storage.write_batch(
+                    task_docs=list(task_docs.values()),
+                    request_docs=list(request_docs.values()),
+                )
+            if deleted_task_ids:
+                self.storage.delete_tasks(deleted_task_ids)
+            if deleted_request_ids:
+                self.storage.delete_patient_requests(deleted_request_ids)
+        counts.report(metrics)
+
+    def upsert_tasks(self, task_docs: list[dict]) -> None:
+        if not self.active:
+            self.storage.upsert_tasks(task_docs)
+            return
+
+        for task_doc in task_docs:
+            self._task_docs[task_doc["id"]] = task_doc
+            self._deleted_task_ids.discard(task_doc["id"])
+
+    def get_task(self, task_id: str) -> dict | None:
+        if self.active and task_id in self._task_docs:
+            return self._task_docs[task_id]
+        if self.active and task_id in self._deleted_task_ids:
+            return None
+        return self.storage.get_task(task_id)
+
+    def get_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        if not self.active:
+            return self.storage.get_tasks(task_ids)
+
+        task_ids = set(task_ids)
+        stored_ids = task_ids - self._task_docs.keys() - self._deleted_task_ids
+        stored_docs = self.storage.get_tasks(stored_ids) if stored_ids else []
+        return stored_docs + [
+            self._task_docs[task_id] for task_id in task_ids & self._task_docs.keys()
+        ]
+
+    def delete_tasks(self, task_ids: Iterable[str]) -> None:
+        if not self.active:
+            self.storage.delete_tasks(task_ids)
+            return
+
+        for task_id in task_ids:
+            self._task_docs.pop(task_id, None)
+            self._deleted_task_ids.add(task_id)
+
+    def search_tasks(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+    ) -> list[dict]:
+        if patient_ids is not None:
+            patient_ids = set(patient_ids)
+
+        stored_docs = self.storage.search_tasks(patient_ids=patient_ids, status=status)
+        if not self.active:
+            return stored_docs
+
+        return self._overlay(
+            stored_docs,
+            self._task_docs,
+            self._deleted_task_ids,
+            {"patient_id": patient_ids, "status": status},
+        )
+
+    def upsert_patient_requests(self, request_docs: list[dict]) -> None:
+        if not self.active:
+            self.storage.upsert_patient_requests(request_docs)
+            return
+
+        for request_doc in request_docs:
+            self._request_docs[request_doc["id"]] = request_doc
+            self._deleted_request_ids.discard(request_doc["id"])
+
+    def delete_patient_requests(self, request_ids: Iterable[str]) -> None:
+        if not self.active:
+            self.storage.delete_patient_requests(request_ids)
+            return
+
+        for request_id in request_ids:
+            self._request_docs.pop(request_id, None)
+            self._deleted_request_ids.add(request_id)
+
+    def search_patient_requests(
+        self,
+        patient_ids: Iterable[str] | None = None,
+        status: str | None = None,
+        assigned_to: str | None = None,
+    ) -> list[dict]:
+        if patient_ids is not None:
+            patient_ids = set(patient_ids)
+
+        stored_docs = self.storage.search_patient_requests(
+            patient_ids=patient_ids, status=status, assigned_to=assigned_to
+        )
+        if not self.active:
+            return stored_docs
+
+        return self._overlay(
+            stored_docs,
+            self._request_docs,
+            self._deleted_request_ids,
+            {"patient_id": patient_ids, "status": status, "assigned_to": assigned_to},
+        )
+
+    def search_patient_requests_by_task(self, task_id: str) -> list[dict]:
+        stored_docs = self.storage.search_patient_requests_by_task(task_id)
+        if not self.active:
+            return stored_docs
+
+        return self._overlay(
+            stored_docs,
+            self._request_docs,
+            self._deleted_request_ids,
+            {},
+            predicate=lambda doc: task_id in doc.get("task_ids", ()),
+        )
+
+    def search_patient_requests_by_tasks(self, task_ids: Iterable[str]) -> list[dict]:
+        task_ids = set(task_ids)
+        stored_docs = self.storage.search_patient_requests_by_tasks(task_ids)
+        if not self.active:
+            return stored_docs
+
+        return self._overlay(
+            stored_docs,
+            self._request_docs,
+            self._deleted_request_ids,
+            {},
+            predicate=lambda doc: not task_ids.isdisjoint(doc.get("task_ids", ())),
+        )
+
+    def for_patients(self, patient_ids: Iterable[str]) -> "UnitOfWork":
+        storage = self.storage.for_patients(patient_ids)
+        if storage is self.storage:
+            return self
+
+        # Shares the buffered writes, so the unit of work still applies them. It
+        # must not be kept after the unit of work ends
+        scoped = copy.copy(self)
+        scoped.storage = storage
+        return scoped
+
+    def partition_for(self, patient_id: str) -> Hashable | None:
+        return self.storage.partition_for(patient_id)
+
+    def drop_tables(self) -> None:
+        if self.active:
+            self._task_docs.clear()
+            self._request_docs.clear()
+            self._deleted_task_ids.clear()
+            self._deleted_request_ids.clear()
+        self.storage.drop_tables()
+
+    @staticmethod
+    def _overlay(
+        stored_docs: list[dict],
+        buffered_docs: dict[str, dict],
+        deleted_ids: set[str],
+        filters: dict,
+        predicate=lambda doc: True,
+    ) -> list[dict]:
+        """Returns the stored_docs as they would be after the buffered writes:
+        stored documents are replaced by their buffered version (and dropped if it
+        no longer matches or if they were deleted), and new matching buffered
+        documents are appended."""
+
+        def is_match(doc):
+            return matches_filters(doc, filters) and predicate(doc)
+
+        docs = []
+        seen_ids = set()
+        for doc in stored_docs:
+            if doc["id"] in deleted_ids:
+                continue
+            seen_ids.add(doc["id"])
+            doc = buffered_docs.get(doc["id"], doc)
+            if is_match(doc):
+                docs.append(doc)
+
+        docs.extend(
+            doc
+            for doc_id, doc in buffered_docs.items()
+            if doc_id not in seen_ids and is_match(doc)
+        )
+        return docs
+
+
+@contextmanager
+def deferred_counts(storage: Storage) -> Iterator[DeferredCounts]:
+    """Yields the counters to record the writes made to storage in: the ones of
+    its unit of work if one is active, reported when it's committed, or counters
+    reported when the block ends, as the writes are made right away."""
+    if isinstance(storage, UnitOfWork) and storage.active:
+        yield storage.counts
+        return
+
+    counts = DeferredCounts()
+    yield counts
+    counts.report(get_metrics())
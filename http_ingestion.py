@@ -0,0 +1,290 @@
+"""An asyncio HTTP endpoint that accepts task inputs pushed by the upstream
+system, and processes the concurrent submissions together.
+
+Usage:
+    python -m http_ingestion --port 8080 --sqlite sqlite/db.sqlite3
+
+    curl -X POST localhost:8080/tasks -d @data/input_task_1.json
+"""
+
+import argparse
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+from pydantic import ValidationError
+
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
+from metrics import INPUTS_INGESTED, get_metrics
+from models import TaskInput
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+
+TASKS_PATH = "/tasks"
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Content Too Large",
+    500: "Internal Server Error",
+}
+
+
+class _Submission(NamedTuple):
+    task_input: TaskInput
+    # Resolved once the batch of the submission is committed
+    committed: asyncio.Future
+
+
+class IngestionServer:
+    """Accepts TaskInput JSON documents with POST /tasks, and processes all the
+    submissions received within a tick (tick_seconds, or until max_batch_tasks
+    tasks are pending) together with ClinicManager.process_queued_updates, which
+    merges them into as few updates as possible, with the same outcome as
+    processing them one by one. A submission is acknowledged
+    (200, with its task count) once its batch is committed. If the batch fails,
+    each of its submissions is processed on its own, so that only the ones that
+    fail by themselves are answered with a 500. Invalid task inputs are answered
+    with a 400 and the validation errors.
+
+    Many small concurrent pushes are thus amortized into a few large batches.
+    The validation of the submissions and the processing of the batches run in
+    worker threads, so the event loop keeps accepting submissions meanwhile; a
+    single thread processes the batches, one at a time, since ClinicManager
+    isn't thread safe.
+
+    Example:
+        server = IngestionServer(ClinicManager(storage=storage), port=8080)
+        await server.serve_forever()
+    """
+
+    def __init__(
+        self,
+        clinic_manager: ClinicManager,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+        tick_seconds: float = 0.05,
+        max_batch_tasks: int = 5000,
+        max_body_size: int = 16 * 2**20,
+    ):
+        self.clinic_manager = clinic_manager
+        self.host = host
+        self.port = port
+        self.tick_seconds = tick_seconds
+        self.max_batch_tasks = max_batch_tasks
+        self.max_body_size = max_body_size
+
+        self._pending: list[_Submission] = []
+        self._pending_task_count = 0
+        self._has_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._validation_executor = ThreadPoolExecutor(
+            thread_name_prefix="ingestion-validation"
+        )
+        self._processing_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="ingestion-processing"
+        )
+        self._server: asyncio.Server | None = None
+        self._batcher: asyncio.Task | None = None
+        self._closing = False
+
+    async def start(self) -> None:
+        """Starts listening (on a free port if port is 0, see self.port)."""
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._batcher = asyncio.create_task(self._process_batches())
+
+    async def close(self) -> None:
+        """Stops accepting connections, and waits until the batch in progress and
+        the pending submissions are processed."""
+        self._server.close()
+        await self._server.wait_closed()
+        self._closing = True
+        # Wakes the batcher up if it's waiting for submissions
+        self._has_pending.set()
+        await self._batcher
+        self._validation_executor.shutdown()
+        self._processing_executor.shutdown()
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def submit(self, task_input: TaskInput) -> None:
+        """Adds task_input to the next batch, and returns once the batch is
+        committed (or raises its error).
+
+        Raises:
+            RuntimeError: If the server is closed.
+        """
+        if self._batcher is None or self._batcher.done():
+            raise RuntimeError("The ingestion server is closed")
+
+        committed = asyncio.get_running_loop().create_future()
+        self._pending.append(_Submission(task_input, committed))
+        self._pending_task_count += len(task_input.tasks)
+        self._has_pending.set()
+        if self._pending_task_count >= self.max_batch_tasks:
+            self._batch_full.set()
+        await committed
+
+    async def _process_batches(self) -> None:
+        metrics = get_metrics()
+
+        while True:
+            # Once closing, the pending submissions are processed right away
+            if not self._closing:
+                await self._has_pending.wait()
+            if not self._closing:
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.tick_seconds)
+                except asyncio.TimeoutError:
+                    pass
+            if not self._pending:
+                # Woken up by close, with nothing left to process
+                return
+
+            batch, self._pending, self._pending_task_count = self._pending, [], 0
+            self._has_pending.clear()
+            self._batch_full.clear()
+
+            with metrics.timer("ingestion_batch"):
+                if not await self._process_batch(batch, raise_errors=len(batch) == 1):
+                    # Process the submissions one by one, so that each of them
+                    # gets its own outcome rather than the error of another one
+                    for submission in batch:
+                        await self._process_batch([submission], raise_errors=True)
+
+    async def _process_batch(
+        self, batch: list[_Submission], raise_errors: bool
+    ) -> bool:
+        """Processes batch, and resolves the futures of its submissions if it's
+        committed, or (if raise_errors) with its error if it fails. Returns
+        whether it was committed."""
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self._processing_executor,
+                self.clinic_manager.process_queued_updates,
+                [submission.task_input for submission in batch],
+                len(batch),
+            )
+        except Exception as error:
+            if not raise_errors:
+                return False
+            for submission in batch:
+                if not submission.committed.done():
+                    submission.committed.set_exception(error)
+            return False
+
+        get_metrics().increment(INPUTS_INGESTED, len(batch))
+        for submission in batch:
+            if not submission.committed.done():
+                submission.committed.set_result(None)
+        return True
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            status, response = await self._handle_request(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+
+        body = json.dumps(response).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader: asyncio.StreamReader) -> tuple[int, dict]:
+        """Reads a request, and returns the status and the body of the response."""
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if len(request_line) != 3:
+            return 400, {"error": "Invalid request line"}
+        method, path, _ = request_line
+        if path != TASKS_PATH:
+            return 404, {"error": f"Task inputs are posted to {TASKS_PATH}"}
+        if method != "POST":
+            return 405, {"error": "Task inputs are posted"}
+        if not headers.get("content-length", "").isdigit():
+            return 411, {"error": "A Content-Length is required"}
+        content_length = int(headers["content-length"])
+        if content_length > self.max_body_size:
+            return 413, {"error": f"The body is over {self.max_body_size} bytes"}
+
+        body = await reader.readexactly(content_length)
+        try:
+            task_input = await asyncio.get_running_loop().run_in_executor(
+                self._validation_executor, TaskInput.model_validate_json, body
+            )
+        except ValidationError as error:
+            return 400, {"error": json.loads(error.json(include_url=False))}
+
+        try:
+            await self.submit(task_input)
+        except Exception as error:
+            return 500, {"error": f"The batch failed: {error!r}"}
+        return 200, {"status": "committed", "tasks": len(task_input.tasks)}
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--sqlite", default="sqlite/db.sqlite3")
+    parser.add_argument(
+        "--departments",
+        action="store_true",
+        help="Keep a request per patient and department",
+    )
+    parser.add_argument(
+        "--tick", type=float, default=0.05, help="The batching delay, in seconds"
+    )
+    parser.add_argument("--max-batch-tasks", type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    Path(args.sqlite).parent.mkdir(parents=True, exist_ok=True)
+    storage = SQLiteStorage(args.sqlite)
+    request_service_class = (
+        DepartmentPatientRequestService
+        if args.departments
+        else PerPatientRequestService
+    )
+    server = IngestionServer(
+        ClinicManager(request_service_class(storage=storage)),
+        host=args.host,
+        port=args.port,
+        tick_seconds=args.tick,
+        max_batch_tasks=args.max_batch_tasks,
+    )
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
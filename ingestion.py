@@ -0,0 +1,321 @@
+"""A long running ingestion service, that feeds the task inputs of a spool
+directory (and of an in-process queue) to a ClinicManager in micro-batches.
+
+Usage:
+    python -m ingestion --spool spool --sqlite sqlite/db.sqlite3 --max-wait 1
+"""
+
+import argparse
+import logging
+import queue
+import signal
+import threading
+import time
+from os import PathLike
+from pathlib import Path
+from typing import NamedTuple
+from uuid import uuid4
+
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
+from metrics import INPUTS_FAILED, INPUTS_INGESTED, get_metrics
+from models import TaskInput
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+from task_input_loader import NDJSON_SUFFIXES, iter_tasks
+
+logger = logging.getLogger(__name__)
+
+SPOOL_SUFFIXES = {".json", *NDJSON_SUFFIXES}
+PROCESSED_DIR = "processed"
+FAILED_DIR = "failed"
+
+
+class _PendingInput(NamedTuple):
+    task_input: TaskInput
+    # The spool file of the input, None for the inputs of the queue
+    path: Path | None
+
+
+class IngestionService:
+    """Collects task inputs into windows and processes every window with
+    ClinicManager.process_queued_updates, which merges them into as few updates
+    as possible.
+
+    A window is processed once it holds max_batch_tasks tasks (or
+    max_batch_inputs inputs), or max_wait_seconds after its first input arrived,
+    whichever comes first. So max_wait_seconds bounds the latency of a quiet
+    stream, and the size limits bound the batches (and the memory) of a busy one.
+
+    The inputs come from:
+    - The spool directory: a TaskInput JSON (or NDJSON) file per input, picked in
+      name order. Producers should write a file under another name (e.g. with a
+      .tmp suffix) and rename it once complete. The files of a window are moved
+      to spool/processed once the window is committed, which checkpoints them:
+      a restarted service only picks up the remaining files. Files that
+      aren't valid task inputs are moved to spool/failed.
+    - The queue, with submit. The queue holds at most max_queue_size inputs, and
+      submit blocks while it is full, so producers are slowed down to the pace
+      of the processing rather than piling up inputs in memory. The spool is
+      read a window at a time, so a backlog of files stays on disk.
+
+    A window that fails is retried up to max_retries times, waiting
+    retry_backoff_seconds and then twice as long after every attempt, which
+    rides out transient errors (e.g. of the DB). Retrying is harmless, since
+    unchanged tasks and requests aren't written again. If it still fails, its
+    inputs are processed one by one, and the ones that fail are set aside: spool
+    files are moved to spool/failed, and queued inputs are written there (or
+    only logged, without a spool directory). So neither an input that can't be
+    processed nor an outage stops the service, but the inputs of a long outage
+    end up in spool/failed, to be moved back to the spool once it's over.
+
+    Example:
+        service = IngestionService(ClinicManager(storage=storage), spool_dir="spool")
+        threading.Thread(target=service.run).start()
+        service.submit(task_input)
+        ...
+        service.stop()
+    """
+
+    def __init__(
+        self,
+        clinic_manager: ClinicManager,
+        spool_dir: PathLike | None = None,
+        max_batch_tasks: int = 5000,
+        max_batch_inputs: int = 100,
+        max_wait_seconds: float = 1.0,
+        poll_interval: float = 0.2,
+        max_queue_size: int = 100,
+        max_retries: int = 3,
+        retry_backoff_seconds: float = 0.5,
+    ):
+        self.clinic_manager = clinic_manager
+        self.spool_dir = Path(spool_dir) if spool_dir is not None else None
+        self.max_batch_tasks = max_batch_tasks
+        self.max_batch_inputs = max_batch_inputs
+        self.max_wait_seconds = max_wait_seconds
+        self.poll_interval = poll_interval
+        self.queue: queue.Queue[TaskInput] = queue.Queue(max_queue_size)
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self._stopped = threading.Event()
+
+        if self.spool_dir is not None:
+            for directory in (PROCESSED_DIR, FAILED_DIR):
+                (self.spool_dir / directory).mkdir(parents=True, exist_ok=True)
+
+    def submit(self, task_input: TaskInput, timeout: float | None = None) -> None:
+        """Queues task_input for processing, waiting while the queue is full.
+
+        Raises:
+            queue.Full: If the queue is still full after timeout seconds.
+        """
+        self.queue.put(task_input, timeout=timeout)
+
+    def run(self) -> None:
+        """Processes windows until stop is called, and then the inputs that are
+        still queued. The spool files that weren't picked yet are left for the
+        next run."""
+        while not self._stopped.is_set():
+            try:
+                self.process_window()
+            except Exception:
+                # e.g. the spool directory can't be read
+                logger.exception("Failed to collect a window of task inputs")
+                self._stopped.wait(self.retry_backoff_seconds)
+
+        while self.process_window(wait=False, spool=False):
+            pass
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def process_window(self, wait: bool = True, spool: bool = True) -> int:
+        """Collects a window of inputs and processes it.
+
+        Args:
+            wait (bool): Whether to wait up to poll_interval for a first input,
+                and up to max_wait_seconds for the window to fill up.
+            spool (bool): Whether to pick inputs from the spool directory too, or
+                only from the queue.
+
+        Returns:
+            int: The number of inputs processed, including the ones that failed
+                and were set aside.
+        """
+        window = self._collect_window(wait, spool)
+        if not window:
+            return 0
+
+        with get_metrics().timer("ingestion_window"):
+            if not self._process_with_retries(window):
+                # Set aside the inputs that fail on their own, so that they
+                # don't hold up the others
+                for pending in window:
+                    if not self._process_with_retries([pending], max_retries=0):
+                        self._set_aside(pending)
+        return len(window)
+
+    def _process_with_retries(
+        self, window: list[_PendingInput], max_retries: int | None = None
+    ) -> bool:
+        """Processes window, retrying it with a backoff if it fails. Returns
+        whether it was processed (and checkpointed)."""
+        if max_retries is None:
+            max_retries = self.max_retries
+
+        for attempt in range(max_retries + 1):
+            if attempt:
+                self._stopped.wait(self.retry_backoff_seconds * 2 ** (attempt - 1))
+            try:
+                self.clinic_manager.process_queued_updates(
+                    (pending.task_input for pending in window),
+                    max_batches=len(window),
+                )
+            except Exception:
+                logger.exception(
+                    "Failed to process a window of %d task inputs (attempt %d of %d)",
+                    len(window),
+                    attempt + 1,
+                    max_retries + 1,
+                )
+            else:
+                get_metrics().increment(INPUTS_INGESTED, len(window))
+                for pending in window:
+                    if pending.path is not None:
+                        self._move(pending.path, PROCESSED_DIR)
+                return True
+        return False
+
+    def _set_aside(self, pending: _PendingInput) -> None:
+        """Moves (or writes) an input that can't be processed to spool/failed."""
+        get_metrics().increment(INPUTS_FAILED)
+        if pending.path is not None:
+            logger.error("Moving task input file %s to %s", pending.path, FAILED_DIR)
+            self._move(pending.path, FAILED_DIR)
+        elif self.spool_dir is not None:
+            path = self.spool_dir / FAILED_DIR / f"queued_{uuid4()}.json"
+            logger.error("Writing queued task input to %s", path)
+            path.write_text(pending.task_input.model_dump_json())
+        else:
+            logger.error(
+                "Dropping queued task input: %s", pending.task_input.model_dump_json()
+            )
+
+    @staticmethod
+    def _move(path: Path, directory: str) -> None:
+        path.replace(path.parent / directory / path.name)
+
+    def _collect_window(self, wait: bool, spool: bool = True) -> list[_PendingInput]:
+        window: list[_PendingInput] = []
+        task_count = 0
+        # The spool files in the window, and the ones to pick next (in reverse
+        # name order), so that the spool is only listed when they run out
+        claimed_paths: set[Path] = set()
+        spool_files: list[Path] = []
+        deadline = time.monotonic() + (self.poll_interval if wait else 0)
+
+        while len(window) < self.max_batch_inputs and task_count < self.max_batch_tasks:
+            pending = self._next_input(claimed_paths, spool_files, spool)
+            if pending is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stopped.is_set():
+                    break
+                # Nothing is available yet: wait for the queue, which also paces
+                # the polling of the spool
+                try:
+                    task_input = self.queue.get(
+                        timeout=min(remaining, self.poll_interval)
+                    )
+                except queue.Empty:
+                    continue
+                pending = _PendingInput(task_input, None)
+
+            if not window:
+                # The window is processed at most max_wait_seconds after its
+                # first input arrived
+                deadline = time.monotonic() + (self.max_wait_seconds if wait else 0)
+            window.append(pending)
+            task_count += len(pending.task_input.tasks)
+
+        return window
+
+    def _next_input(
+        self, claimed_paths: set[Path], spool_files: list[Path], spool: bool = True
+    ) -> _PendingInput | None:
+        """Returns the next queued input, or else (if spool) the next spool file
+        that isn't in the window yet, if any."""
+        try:
+            return _PendingInput(self.queue.get_nowait(), None)
+        except queue.Empty:
+            pass
+
+        if self.spool_dir is None or not spool:
+            return None
+
+        if not spool_files:
+            spool_files += sorted(
+                (
+                    path
+                    for path in self.spool_dir.iterdir()
+                    if path not in claimed_paths
+                    and path.suffix in SPOOL_SUFFIXES
+                    and not path.name.startswith(".")
+                    and path.is_file()
+                ),
+                reverse=True,
+            )
+
+        while spool_files:
+            path = spool_files.pop()
+            claimed_paths.add(path)
+            try:
+                return _PendingInput(TaskInput(tasks=list(iter_tasks(path))), path)
+            except ValueError as error:
+                logger.error("Invalid task input file %s: %s", path, error)
+                self._move(path, FAILED_DIR)
+
+        return None
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--spool", required=True, help="The spool directory")
+    parser.add_argument("--sqlite", default="sqlite/db.sqlite3")
+    parser.add_argument(
+        "--departments",
+        action="store_true",
+        help="Keep a request per patient and department",
+    )
+    parser.add_argument("--max-batch-tasks", type=int, default=5000)
+    parser.add_argument("--max-batch-inputs", type=int, default=100)
+    parser.add_argument(
+        "--max-wait", type=float, default=1.0, help="The maximum batching delay"
+    )
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    Path(args.sqlite).parent.mkdir(parents=True, exist_ok=True)
+    storage = SQLiteStorage(args.sqlite)
+    request_service_class = (
+        DepartmentPatientRequestService
+        if args.departments
+        else PerPatientRequestService
+    )
+    service = IngestionService(
+        ClinicManager(request_service_class(storage=storage)),
+        spool_dir=args.spool,
+        max_batch_tasks=args.max_batch_tasks,
+        max_batch_inputs=args.max_batch_inputs,
+        max_wait_seconds=args.max_wait,
+        poll_interval=args.poll_interval,
+    )
+
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: service.stop())
+    service.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""Timers and counters of the task processing stages, reported to a pluggable
+metrics sink.
+
+The default sink discards everything, and costs no more than a method call per
+stage. To collect the metrics, set an InMemorySink (or any MetricsSink) with
+set_metrics:
+
+    sink = InMemorySink()
+    set_metrics(sink)
+    clinic_manager.process_tasks_update(task_input)
+    print(to_prometheus_text(sink))
+"""
+
+import time
+from abc import ABC, abstractmethod
+from contextlib import AbstractContextManager, nullcontext
+
+# Counter names
+TASKS_PROCESSED = "tasks_processed"
+TASKS_UNCHANGED = "tasks_unchanged"
+TASKS_COALESCED = "tasks_coalesced"
+REQUESTS_CREATED = "requests_created"
+REQUESTS_UPDATED = "requests_updated"
+REQUESTS_CLOSED = "requests_closed"
+REQUESTS_UNCHANGED = "requests_unchanged"
+TASKS_MOVED = "tasks_moved"
+INPUTS_INGESTED = "inputs_ingested"
+INPUTS_FAILED = "inputs_failed"
+OPEN_REQUESTS_CACHE_HITS = "open_requests_cache_hits"
+OPEN_REQUESTS_CACHE_MISSES = "open_requests_cache_misses"
+OPEN_REQUESTS_FILTER_NEGATIVES = "open_requests_filter_negatives"
+
+
+class MetricsSink(ABC):
+    """Receives the stage durations and the counters."""
+
+    @abstractmethod
+    def observe(self, stage: str, seconds: float) -> None:
+        """Records a duration of stage."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def increment(self, counter: str, value: int = 1) -> None:
+        """Adds value to counter."""
+        raise NotImplementedError
+
+    def timer(self, stage: str) -> AbstractContextManager:
+        """Returns a context manager that records the duration of its block as a
+        duration of stage."""
+        return _Timer(self, stage)
+
+
+class _Timer:
+    __slots__ = ("sink", "stage", "start")
+
+    def __init__(self, sink: MetricsSink, stage: str):
+        self.sink = sink
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.sink.observe(self.stage, time.perf_counter() - self.start)
+
+
+_NULL_TIMER = nullcontext()
+
+
+class NullSink(MetricsSink):
+    """Sink that discards everything (the default)."""
+
+    def observe(self, stage: str, seconds: float) -> None:
+        pass
+
+    def increment(self, counter: str, value: int = 1) -> None:
+        pass
+
+    def timer(self, stage: str) -> AbstractContextManager:
+        return _NULL_TIMER
+
+
+class DeferredCounts:
+    """Counters of an update in progress, added to a sink with report() once the
+    update is committed, so that the updates that are rolled back aren't counted.
+
+    Each request is counted once, by its outcome over the whole update: created
+    if it didn't exist before, closed if it was open and ends up closed, updated
+    if it changed otherwise, and unchanged if none of its writes changed it.
+    """
+
+    def __init__(self):
+        self.counters: dict[str, int] = {}
+        # The status of each request before the update (None for new requests),
+        # its last status, and whether it changed, by request id
+        self._requests: dict[str, tuple[str | None, str, bool]] = {}
+
+    def increment(self, counter: str, value: int = 1) -> None:
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def add_request(
+        self, request_id: str, previous_status: str | None, status: str, changed: bool
+    ) -> None:
+        """Records a write of a request that had previous_status before it."""
+        if request_id in self._requests:
+            previous_status, _, was_changed = self._requests[request_id]
+            changed = changed or was_changed
+        self._requests[request_id] = (previous_status, status, changed)
+
+    def report(self, sink: MetricsSink) -> None:
+        for previous_status, status, changed in self._requests.values():
+            if previous_status is None:
+                sink.increment(REQUESTS_CREATED)
+            elif not changed:
+                sink.increment(REQUESTS_UNCHANGED)
+            elif status == "Closed" and previous_status != "Closed":
+                sink.increment(REQUESTS_CLOSED)
+            else:
+                sink.increment(REQUESTS_UPDATED)
+        for counter, value in self.counters.items():
+            sink.increment(counter, value)
+
+
+class StageStats:
+    """The count, total and maximum of the durations of a stage."""
+
+    __slots__ = ("count", "total_seconds", "max_seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+
+class InMemorySink(MetricsSink):
+    """Sink that aggregates the durations per stage and the counters in memory."""
+
+    def __init__(self):
+        self.stages: dict[str, StageStats] = {}
+        self.counters: dict[str, int] = {}
+
+    def observe(self, stage: str, seconds: float) -> None:
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages[stage] = StageStats()
+        stats.add(seconds)
+
+    def increment(self, counter: str, value: int = 1) -> None:
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def reset(self) -> None:
+        self.stages.clear()
+        self.counters.clear()
+
+
+def to_prometheus_text(sink: InMemorySink, prefix: str = "clinic_") -> str:
+    """Returns the metrics of sink in the Prometheus text exposition format: a
+    counter per counter, and the stage durations as a summary (count and sum)
+    plus a gauge of the maximum, labelled by stage."""
+    lines = []
+
+    for counter, value in sorted(sink.counters.items()):
+        name = f"{prefix}{counter}_total"
+        lines += [f"# TYPE {name} counter", f"{name} {value}"]
+
+    if sink.stages:
+        name = f"{prefix}stage_duration_seconds"
+        lines.append(f"# TYPE {name} summary")
+        for stage, stats in sorted(sink.stages.items()):
+            lines.append(f'{name}_count{{stage="{stage}"}} {stats.count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {stats.total_seconds!r}')
+
+        name = f"{prefix}stage_duration_max_seconds"
+        lines.append(f"# TYPE {name} gauge")
+        for stage, stats in sorted(sink.stages.items()):
+            lines.append(f'{name}{{stage="{stage}"}} {stats.max_seconds!r}')
+
+    return "\n".join(lines) + "\n"
+
+
+_metrics: MetricsSink = NullSink()
+
+
+def get_metrics() -> MetricsSink:
+    """Returns the process wide metrics sink (a NullSink unless set otherwise)."""
+    return _metrics
+
+
+def set_metrics(sink: MetricsSink | None) -> None:
+    """Replaces the process wide metrics sink. Passing None disables the metrics."""
+    global _metrics
+    _metrics = sink or NullSink()
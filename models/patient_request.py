@@ -1,10 +1,13 @@
 from datetime import datetime
 from operator import attrgetter
-from typing import Literal, Optional
+from typing import TYPE_CHECKING, Iterable, Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
-from services.task_service import TaskService
+from .patient_task import PatientTask
+
+if TYPE_CHECKING:
+    from services.task_service import TaskService
 
 task_date_getter = attrgetter("updated_date")
 
@@ -19,13 +22,70 @@ class PatientRequest(BaseModel):
     pharmacy_id: Optional[int]
 
     task_ids: set[str]
+    # The id of the task the request's updated_date, assigned_to and pharmacy_id
+    # come from, kept for incremental updates of the request
+    newest_task_id: Optional[str] = None
+
+    # The tasks referenced by task_ids, fetched once by the first property that
+    # needs them (or by prefetch_tasks for many requests at once)
+    _tasks: Optional[list[PatientTask]] = PrivateAttr(default=None)
+
+    @classmethod
+    def from_storage(cls, request_doc: dict, trusted: bool = False) -> "PatientRequest":
+        """Builds a PatientRequest from a document read from the DB.
+
+        With trusted=True the document is not validated again (see
+        PatientTask.from_storage). task_ids is copied, since the request services
+        modify it in place.
+        """
+        if not trusted:
+            return cls(**request_doc)
+
+        return cls.model_construct(
+            **{**request_doc, "task_ids": set(request_doc["task_ids"])}
+        )
+
+    @classmethod
+    def prefetch_tasks(
+        cls,
+        patient_requests: Iterable["PatientRequest"],
+        task_service: "TaskService" = None,
+    ) -> None:
+        """Fetches the tasks of all patient_requests with a single lookup, so that
+        reading their messages and medications doesn't hit the database again."""
+        # Imported here, so that importing the models doesn't import the services
+        # and the storage
+        from services.task_service import TaskService
+
+        patient_requests = list(patient_requests)
+        task_service = task_service or TaskService()
+
+        all_task_ids = set().union(*(req.task_ids for req in patient_requests))
+        tasks_by_id = {
+            task.id: task for task in task_service.get_tasks_by_ids(all_task_ids)
+        }
+
+        for patient_request in patient_requests:
+            patient_request._tasks = [
+                tasks_by_id[task_id]
+                for task_id in patient_request.task_ids
+                if task_id in tasks_by_id
+            ]
+
+    def _get_tasks(self) -> list[PatientTask]:
+        """Returns the tasks referenced by task_ids, fetching them on first use."""
+        if self._tasks is None:
+            from services.task_service import TaskService
+
+            task_service = TaskService()
+            self._tasks = task_service.get_tasks_by_ids(self.task_ids)
+        return self._tasks
 
     @property
     def messages(self) -> list[str]:
         """Property that returns messages from all tasks referenced by task_ids.
-        This dynamically fetches the current messages from the database."""
-        task_service = TaskService()
-        tasks = task_service.get_tasks_by_ids(self.task_ids)
+        The tasks are fetched from the database on first use."""
+        tasks = self._get_tasks()
         tasks_by_updated_asc = sorted(tasks, key=task_date_getter)
 
         return [task.message for task in tasks_by_updated_asc]
@@ -33,8 +93,7 @@ class PatientRequest(BaseModel):
     @property
     def medications(self) -> list[dict]:
         """Property that returns a list of medications from all tasks referenced by task_ids."""
-        task_service = TaskService()
-        tasks = task_service.get_tasks_by_ids(self.task_ids)
+        tasks = self._get_tasks()
 
         medications = []
         for task in tasks:
@@ -19,3 +19,24 @@ class PatientTask(BaseModel):
     message: str
     medications: list[Medication] = Field(default_factory=list)
     pharmacy_id: Optional[int] = None
+
+    @classmethod
+    def from_storage(cls, task_doc: dict, trusted: bool = False) -> "PatientTask":
+        """Builds a PatientTask from a document read from the DB.
+
+        With trusted=True the document is not validated again (it was validated
+        when it was first written), which is much faster. Only use it for
+        documents that come from our own DB, never for external input.
+        """
+        if not trusted:
+            return cls(**task_doc)
+
+        return cls.model_construct(
+            **{
+                **task_doc,
+                "medications": [
+                    Medication.model_construct(**medication)
+                    for medication in task_doc.get("medications") or ()
+                ],
+            }
+        )
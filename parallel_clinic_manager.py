@@ -0,0 +1,125 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
+from db.sharding import shard_for
+from db.storage import Storage
+from models import TaskInput
+from services.abstract_patient_request_service import PatientRequestService
+from services.patient_request_service import PerPatientRequestService
+
+# The ClinicManager of every shard processed by this (worker) process, so that
+# each worker opens the storage of a shard only once
+_shard_managers: dict[int, ClinicManager] = {}
+
+
+class SQLiteShardStorageFactory:
+    """Opens the SQLite storage of a shard, each shard in its own file.
+    Picklable, so it can be handed to worker processes."""
+
+    def __init__(self, path_template: str = "sqlite/shard_{shard}.sqlite3"):
+        self.path_template = path_template
+
+    def __call__(self, shard: int) -> SQLiteStorage:
+        return SQLiteStorage(self.path_template.format(shard=shard))
+
+
+def partition_task_input(task_input: TaskInput, shard_count: int) -> list[TaskInput]:
+    """Splits task_input into shard_count inputs by the shard of each task's
+    patient_id. All the tasks of a patient end up in the same input, in their
+    original order."""
+    shards = [TaskInput() for _ in range(shard_count)]
+    for task in task_input.tasks:
+        shards[shard_for(task.patient_id, shard_count)].tasks.append(task)
+    return shards
+
+
+def _process_shard(
+    storage_factory: Callable[[int], Storage],
+    request_service_class: type[PatientRequestService],
+    shard: int,
+    task_input: TaskInput,
+) -> int:
+    """Processes the task_input of a shard in a worker process."""
+    if shard not in _shard_managers:
+        storage = storage_factory(shard)
+        _shard_managers[shard] = ClinicManager(request_service_class(storage=storage))
+
+    _shard_managers[shard].process_tasks_update(task_input)
+    return shard
+
+
+class ParallelClinicManager:
+    """Processes task updates on all CPU cores, by partitioning every TaskInput by
+    a stable hash of patient_id and processing the shards in a process pool.
+
+    The requests of a patient only depend on that patient's tasks, so processing
+    the shards independently gives the same results as the serial ClinicManager.
+    Every shard has its own storage, opened by storage_factory(shard), which must
+    be picklable and safe to open from several processes (e.g. a file per shard,
+    as with SQLiteShardStorageFactory). The module level TinyDB storage is not.
+
+    shard_count decides which shard holds the documents of a patient, so it must
+    stay the same for as long as the shard storages are kept (it doesn't depend
+    on the machine, unlike the number of workers).
+
+    Example:
+        with ParallelClinicManager(shard_count=8) as clinic_manager:
+            for task_input in iter_task_inputs("backfill.ndjson"):
+                clinic_manager.process_tasks_update(task_input)
+    """
+
+    def __init__(
+        self,
+        shard_count: int,
+        storage_factory: Callable[[int], Storage] = None,
+        patientRequestServiceClass: type[
+            PatientRequestService
+        ] = PerPatientRequestService,
+        max_workers: int = None,
+    ):
+        """
+        Args:
+            shard_count (int): The number of shards the patients are split into.
+            storage_factory (Callable[[int], Storage]): Opens the storage of a
+                shard, defaults to a SQLiteShardStorageFactory.
+            patientRequestServiceClass (type[PatientRequestService]): The request
+                service of every shard.
+            max_workers (int): The number of worker processes, defaults to the
+                number of CPUs.
+        """
+        self.shard_count = shard_count
+        self.storage_factory = storage_factory or SQLiteShardStorageFactory()
+        self.patient_request_service_class = patientRequestServiceClass
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    def process_tasks_update(self, task_input: TaskInput):
+        """Processes task_input like ClinicManager.process_tasks_update, with the
+        shards processed in parallel. Returns once all the shards were processed,
+        and raises the first error of a shard, if any."""
+        futures = [
+            self.executor.submit(
+                _process_shard,
+                self.storage_factory,
+                self.patient_request_service_class,
+                shard,
+                shard_input,
+            )
+            for shard, shard_input in enumerate(
+                partition_task_input(task_input, self.shard_count)
+            )
+            if shard_input.tasks
+        ]
+
+        for future in futures:
+            future.result()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
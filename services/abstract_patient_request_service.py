@@ -1,22 +1,76 @@
 from abc import ABC, abstractmethod
 from operator import attrgetter
-from typing import Generator, Literal
+from typing import Generator, Iterable, Literal
 from uuid import uuid4
 
+from db.storage import Storage, get_storage
 from models.patient_request import PatientRequest
 from models.patient_task import PatientTask
 
+from .task_service import TaskService, TaskState
+
 task_date_getter = attrgetter("updated_date")
 
 
 class PatientRequestService(ABC):
-    """Abstract base class for patient request services."""
+    """Abstract base class for patient request services.
+
+    In incremental mode, update_requests expects only the modified tasks (rather
+    than all the open tasks of the affected patients), and applies them to the
+    existing requests with to_patient_request_incremental.
+
+    With trusted_reads, requests and tasks read from the storage are built without
+    validating them again (see PatientRequest.from_storage).
+    """
+
+    def __init__(
+        self,
+        storage: Storage = None,
+        incremental: bool = False,
+        trusted_reads: bool = False,
+    ):
+        self.storage = storage or get_storage()
+        self.incremental = incremental
+        self.trusted_reads = trusted_reads
 
     @abstractmethod
-    def update_requests(self, tasks: Generator[PatientTask, None, None]):
-        """Accepts a generator of modified and open tasks and updates the relevant PatientRequest objects."""
+    def update_requests(
+        self,
+        tasks: Generator[PatientTask, None, None],
+        previous_states: dict[str, TaskState | None] | None = None,
+    ):
+        """Accepts a generator of modified and open tasks and updates the relevant PatientRequest objects.
+
+        previous_states holds the stored state of the modified tasks before the
+        update (see TaskService.updates_tasks), when it is known."""
         raise NotImplementedError
 
+    def get_open_patient_requests(
+        self, patient_ids: Iterable[str]
+    ) -> list[PatientRequest]:
+        """Retrieves from the DB, with a single query, the open patient requests
+        of all the given patient_ids."""
+        return [
+            PatientRequest.from_storage(request_dict, trusted=self.trusted_reads)
+            for request_dict in self.storage.search_patient_requests(
+                patient_ids=set(patient_ids), status="Open"
+            )
+        ]
+
+    def build_patient_request(
+        self,
+        patient_id: str,
+        existing_request: PatientRequest | None,
+        patient_tasks: list[PatientTask],
+    ) -> PatientRequest:
+        """Returns the up to date request for patient_tasks, either recomputed from
+        scratch or, in incremental mode, by applying them to existing_request."""
+        if self.incremental:
+            return self.to_patient_request_incremental(
+                patient_id, existing_request, patient_tasks
+            )
+        return self.to_patient_request(patient_id, patient_tasks)
+
     def to_patient_request(self, patient_id, patient_tasks):
         """Converts a list of PatientTask objects into a PatientRequest object for the given patient_id."""
         open_tasks: list[PatientTask] = [t for t in patient_tasks if t.status == "Open"]
@@ -43,6 +97,83 @@ class PatientRequestService(ABC):
             pharmacy_id=newest_task.pharmacy_id,
             task_ids={t.id for t in req_tasks},
             status=req_status,
+            newest_task_id=newest_task.id,
         )
 
         return new_pat_req
+
+    def to_patient_request_incremental(
+        self,
+        patient_id: str,
+        existing_request: PatientRequest | None,
+        modified_tasks: list[PatientTask],
+    ) -> PatientRequest:
+        """Applies the modified tasks to the aggregates of existing_request (its
+        newest task, its created_date as the oldest created date and its task_ids as
+        the open tasks), without reading the request's other tasks.
+
+        The request is recomputed from its open tasks (as to_patient_request would)
+        only when the aggregates can't be updated in place: when the newest task or
+        the oldest task is closed, or when existing_request has no aggregates (e.g.
+        it was created before they were kept, or a task was moved out of it).
+        Ties on updated_date go to the most recently modified task.
+
+        Note: Assumes a task's created_date never changes.
+        """
+        if existing_request is None:
+            return self.to_patient_request(patient_id, modified_tasks)
+
+        # The latest version of every modified task
+        modified_tasks_by_id = {task.id: task for task in modified_tasks}
+
+        task_ids = set(existing_request.task_ids)
+        newest_task_id = existing_request.newest_task_id
+        needs_recompute = newest_task_id not in task_ids
+        newest_task = None
+        updated_date = existing_request.updated_date
+        created_date = existing_request.created_date
+
+        for task in modified_tasks_by_id.values():
+            if task.status == "Open":
+                task_ids.add(task.id)
+                created_date = min(created_date, task.created_date)
+                if task.updated_date >= updated_date:
+                    newest_task, updated_date = task, task.updated_date
+                elif task.id == newest_task_id:
+                    # The newest task went back in time
+                    needs_recompute = True
+            elif task.id in task_ids:
+                task_ids.discard(task.id)
+                if (
+                    task.id == newest_task_id
+                    or task.created_date <= existing_request.created_date
+                ):
+                    needs_recompute = True
+
+        if not task_ids:
+            # All the tasks are closed, so the request is closed with the closed tasks
+            return self.to_patient_request(patient_id, modified_tasks)
+
+        if needs_recompute:
+            task_service = TaskService(
+                storage=self.storage.for_patients({patient_id}),
+                trusted_reads=self.trusted_reads,
+            )
+            open_tasks = task_service.get_tasks_by_ids(task_ids)
+            return self.to_patient_request(patient_id, open_tasks)
+
+        if newest_task is None:
+            return existing_request.model_copy(
+                update={"task_ids": task_ids, "created_date": created_date}
+            )
+
+        return existing_request.model_copy(
+            update={
+                "task_ids": task_ids,
+                "created_date": created_date,
+                "updated_date": newest_task.updated_date,
+                "assigned_to": newest_task.assigned_to,
+                "pharmacy_id": newest_task.pharmacy_id,
+                "newest_task_id": newest_task.id,
+            }
+        )
@@ -1,44 +1,116 @@
 from collections import defaultdict
 from typing import Dict, Generator
 
-import db.db_tinydb as db
+from db.unit_of_work import deferred_counts
+from metrics import TASKS_MOVED, get_metrics
 from models.patient_request import PatientRequest
 from models.patient_task import PatientTask
-from tinydb import Query, where
 
 from .abstract_patient_request_service import PatientRequestService
+from .task_service import TaskService, TaskState
 from .utils import create_or_update_db
 
-# Create a Query object for TinyDB queries
-item = Query()
-
 
 class DepartmentPatientRequestService(PatientRequestService):
     """Service for managing patient requests with department support."""
 
-    def update_requests(self, tasks: Generator[PatientTask, None, None]) -> None:
+    # The open requests of the patients affected by the update in progress, keyed
+    # by (patient_id, assigned_to). None when no update is in progress.
+    _open_requests: Dict[tuple[str, str], PatientRequest] | None = None
+    # The requests referencing the tasks of the update in progress (and the
+    # requests written during it), by id, and their ids by task id. The task
+    # index may be stale (a superset), so lookups check the request's task_ids.
+    _requests_by_id: Dict[str, PatientRequest] | None = None
+    _request_ids_by_task: Dict[str, set[str]] | None = None
+    # The tasks of the update in progress that may be in the request of another
+    # patient or department, or None when every task may be (the previous states
+    # are unknown)
+    _moved_task_ids: set[str] | None = None
+
+    def update_requests(
+        self,
+        tasks: Generator[PatientTask, None, None],
+        previous_states: dict[str, TaskState | None] | None = None,
+    ) -> None:
         """Accepts a generator of modified and open tasks and creates/updates the relevant
         patient requests in the DB.
 
         Args:
             tasks (Generator[PatientTask, None, None]): A generator yielding
                 PatientTask objects.
+            previous_states (dict[str, TaskState | None] | None): The stored state
+                of the modified tasks before the update, by task id. When given,
+                only the tasks that moved to another patient or department (or
+                were reopened) are removed from their other requests, otherwise
+                all of them are looked up.
 
         Returns:
             None
         """
+        metrics = get_metrics()
+
         # Group tasks by patient_id and department (assigned_to)
-        tasks_by_patient_dept = self._get_tasks_data_structure(tasks)
-
-        # Iterate over the patient-department tasks and create/update
-        # patient requests accordingly in the DB
-        for patient_id, department_tasks in tasks_by_patient_dept.items():
-            for assigned_to, patient_dept_tasks in department_tasks.items():
-                self._upload_changes_to_db(
-                    patient_id=patient_id,
-                    assigned_to=assigned_to,
-                    patient_dept_tasks=patient_dept_tasks,
-                )
+        with metrics.timer("group_tasks"):
+            tasks_by_patient_dept = self._get_tasks_data_structure(tasks)
+
+        # Fetch the open requests of all the affected patients with a single query
+        self._open_requests = {}
+        with metrics.timer("get_open_patient_requests"):
+            open_requests = self.get_open_patient_requests(tasks_by_patient_dept)
+        for open_request in open_requests:
+            self._open_requests.setdefault(
+                (open_request.patient_id, open_request.assigned_to), open_request
+            )
+
+        all_tasks = [
+            task
+            for department_tasks in tasks_by_patient_dept.values()
+            for patient_dept_tasks in department_tasks.values()
+            for task in patient_dept_tasks
+        ]
+        if previous_states is not None:
+            self._moved_task_ids = {
+                task.id
+                for task in all_tasks
+                if self._is_moved(task, previous_states.get(task.id))
+            }
+
+        # Fetch the requests referencing any of the (moved) tasks with a single
+        # query too, rather than a query per task when removing moved tasks. A
+        # task only moves between patients of the same shard (see
+        # TaskService.updates_tasks), so only the patients' shards are queried
+        self._requests_by_id, self._request_ids_by_task = {}, defaultdict(set)
+        moved_task_ids = (
+            {task.id for task in all_tasks}
+            if self._moved_task_ids is None
+            else self._moved_task_ids
+        )
+        with metrics.timer("get_patient_requests_by_tasks"):
+            request_dicts = (
+                self.storage.for_patients(
+                    tasks_by_patient_dept
+                ).search_patient_requests_by_tasks(moved_task_ids)
+                if moved_task_ids
+                else []
+            )
+        for request_dict in request_dicts:
+            self._track_request(
+                PatientRequest.from_storage(request_dict, trusted=self.trusted_reads)
+            )
+
+        try:
+            # Iterate over the patient-department tasks and create/update
+            # patient requests accordingly in the DB
+            for patient_id, department_tasks in tasks_by_patient_dept.items():
+                for assigned_to, patient_dept_tasks in department_tasks.items():
+                    self._upload_changes_to_db(
+                        patient_id=patient_id,
+                        assigned_to=assigned_to,
+                        patient_dept_tasks=patient_dept_tasks,
+                    )
+        finally:
+            self._open_requests = self._moved_task_ids = None
+            self._requests_by_id = self._request_ids_by_task = None
 
     def _upload_changes_to_db(
         self,
@@ -51,9 +123,9 @@ class DepartmentPatientRequestService(PatientRequestService):
             the department (assinged_to) of patient_id
         - Removes tasks from any other patient requests if they were assigned
 
-         TODO: If this was a production code using a production database
-            (e.g., PostgreSQL), we would want to have the
-            changes to the DB wrapped in a single transaction to ensure ACID properties.
+         Note: When called through ClinicManager.process_tasks_update, the changes
+            to the DB are buffered in a unit of work (see db/unit_of_work.py) and
+            written as a single batch for the whole update, or not at all if it fails.
 
         Args:
             patient_id (str): The ID of the patient.
@@ -65,17 +137,35 @@ class DepartmentPatientRequestService(PatientRequestService):
             None
 
         """
-        patient_request_id = self._process_patient_request(
-            patient_id=patient_id,
-            assigned_to=assigned_to,
-            patient_dept_tasks=patient_dept_tasks,
-        )
+        metrics = get_metrics()
+
+        with metrics.timer("build_patient_requests"):
+            patient_request_id = self._process_patient_request(
+                patient_id=patient_id,
+                assigned_to=assigned_to,
+                patient_dept_tasks=patient_dept_tasks,
+            )
         # If tasks were assigned to another patient request,
         # remove them from the other requests
         task_ids = {task.id for task in patient_dept_tasks}
-        self._remove_tasks_from_other_patient_requests(
-            task_ids=task_ids,
-            exclude_request_id=patient_request_id,
+        if self._moved_task_ids is not None:
+            # The other tasks can only be in the request of their department
+            task_ids &= self._moved_task_ids
+        with metrics.timer("remove_tasks_from_other_requests"):
+            self._remove_tasks_from_other_patient_requests(
+                task_ids=task_ids,
+                exclude_request_id=patient_request_id,
+            )
+
+    @staticmethod
+    def _is_moved(task: PatientTask, previous_state: TaskState | None) -> bool:
+        """Whether task may be in another request: it was stored for another
+        patient or in another department, or it was closed (in a request that may
+        be closed too) and is reopened."""
+        return previous_state is not None and (
+            previous_state.patient_id != task.patient_id
+            or previous_state.assigned_to != task.assigned_to
+            or (previous_state.status != "Open" and task.status == "Open")
         )
 
     @staticmethod
@@ -129,33 +219,44 @@ class DepartmentPatientRequestService(PatientRequestService):
             patient_id=patient_id,
         )
         # Create a new patient request object
-        patient_request = self.to_patient_request(patient_id, patient_dept_tasks)
+        patient_request = self.build_patient_request(
+            patient_id, existing_request, patient_dept_tasks
+        )
 
         create_or_update_db(
             existing_request=existing_request,
             patient_request=patient_request,
+            storage=self.storage,
         )
+        self._track_request(patient_request)
 
         return patient_request.id
 
-    @staticmethod
     def _get_open_patient_request(
+        self,
         patient_id: str,
         assigned_to: str,
     ) -> PatientRequest | None:
         """Retrieves from the DB the open patient request for a given
-        patient_id and department (assigned_to)
+        patient_id and department (assigned_to).
+        During update_requests, the request is taken from the open requests
+        prefetched for the whole update instead.
         TODO: Improve documentation as above"""
-        patient_request_dict = db.patient_requests.get(
-            (where("patient_id") == patient_id)
-            & (where("assigned_to") == assigned_to)
-            & (where("status") == "Open")
+        if self._open_requests is not None:
+            return self._open_requests.get((patient_id, assigned_to))
+
+        patient_request_dicts = self.storage.search_patient_requests(
+            patient_ids={patient_id},
+            assigned_to=assigned_to,
+            status="Open",
         )
 
-        if not patient_request_dict:
+        if not patient_request_dicts:
             return None
 
-        return PatientRequest(**patient_request_dict)
+        return PatientRequest.from_storage(
+            patient_request_dicts[0], trusted=self.trusted_reads
+        )
 
     def _remove_tasks_from_other_patient_requests(
         self,
@@ -167,38 +268,133 @@ class DepartmentPatientRequestService(PatientRequestService):
         2. If a request has no tasks left, it will change its status to `Closed`.
 
         Note: Assuming a task can appear in one request only
+        Note: The moved tasks and closed requests are counted in the metrics once
+            the update is committed (see db/unit_of_work.py)
+        Note: The requests of all the tasks of the update are fetched with a
+            single (indexed) query by update_requests, so the lookups by task
+            don't query the DB
         TODO: Improve documentation as above
         """
-        for task_id in task_ids:
-            request_by_task = self._get_patient_request_by_task(
-                task_id=task_id,
-                exclude_patient_request_id=exclude_request_id,
-            )
-
-            if request_by_task is not None:
-                # Remove the task_id from the request's task_ids
-                request_by_task.task_ids.discard(task_id)
-                # If the request has no tasks left, close it
-                if not request_by_task.task_ids:
-                    request_by_task.status = "Closed"
-
-                # Update the request in the DB
-                db.patient_requests.update(
-                    request_by_task.model_dump(),
-                    where("id") == request_by_task.id,
+        with deferred_counts(self.storage) as counts:
+            for task_id in task_ids:
+                request_by_task = self._get_patient_request_by_task(
+                    task_id=task_id,
+                    exclude_patient_request_id=exclude_request_id,
                 )
 
-    @staticmethod
+                if request_by_task is not None:
+                    if self._is_moved_from(request_by_task, exclude_request_id):
+                        counts.increment(TASKS_MOVED)
+                    previous_status = request_by_task.status
+                    # Remove the task_id from the request's task_ids
+                    request_by_task.task_ids.discard(task_id)
+                    # Its aggregates may refer to the removed task, so the next
+                    # incremental update of the request recomputes it
+                    request_by_task.newest_task_id = None
+                    # If the request has no tasks left, close it
+                    if not request_by_task.task_ids:
+                        request_by_task.status = "Closed"
+                    elif self.incremental and request_by_task.status == "Open":
+                        request_by_task = self._recompute_request(request_by_task)
+
+                    # Update the request in the DB
+                    self.storage.upsert_patient_request(request_by_task.model_dump())
+                    counts.add_request(
+                        request_by_task.id,
+                        previous_status,
+                        request_by_task.status,
+                        True,
+                    )
+                    self._refresh_open_request(request_by_task)
+                    self._track_request(request_by_task)
+
+    def _is_moved_from(
+        self, patient_request: PatientRequest, exclude_request_id: str
+    ) -> bool:
+        """Whether a task of patient_request that is now in exclude_request_id
+        moved to another patient or department, rather than being reopened in
+        another request of its department."""
+        if self._requests_by_id is None:
+            return True
+
+        new_request = self._requests_by_id.get(exclude_request_id)
+        return new_request is None or (
+            new_request.patient_id,
+            new_request.assigned_to,
+        ) != (patient_request.patient_id, patient_request.assigned_to)
+
+    def _recompute_request(self, patient_request: PatientRequest) -> PatientRequest:
+        """Returns patient_request recomputed from the tasks it has left.
+
+        Only needed in incremental mode: otherwise all the open tasks of the
+        patient are in the update, so the request is recomputed with the other
+        tasks of its department anyway.
+        """
+        task_service = TaskService(
+            storage=self.storage.for_patients({patient_request.patient_id}),
+            trusted_reads=self.trusted_reads,
+        )
+        recomputed_request = self.to_patient_request(
+            patient_request.patient_id,
+            task_service.get_tasks_by_ids(patient_request.task_ids),
+        )
+        recomputed_request.id = patient_request.id
+        # Another task of the request may be moving out in the same update, and
+        # be removed from it next
+        recomputed_request.assigned_to = patient_request.assigned_to
+        return recomputed_request
+
+    def _refresh_open_request(self, patient_request: PatientRequest) -> None:
+        """Keeps the prefetched open requests in line with a request that was
+        changed in the DB during the update (i.e. forgets it once it is closed)."""
+        if self._open_requests is None:
+            return
+
+        key = (patient_request.patient_id, patient_request.assigned_to)
+        open_request = self._open_requests.get(key)
+        if open_request is None or open_request.id != patient_request.id:
+            return
+
+        if patient_request.status == "Open":
+            self._open_requests[key] = patient_request
+        else:
+            del self._open_requests[key]
+
+    def _track_request(self, patient_request: PatientRequest) -> None:
+        """Keeps the prefetched requests by task in line with a request that was
+        read or written during the update."""
+        if self._requests_by_id is None:
+            return
+
+        self._requests_by_id[patient_request.id] = patient_request
+        for task_id in patient_request.task_ids:
+            self._request_ids_by_task[task_id].add(patient_request.id)
+
     def _get_patient_request_by_task(
+        self,
         task_id: str,
         exclude_patient_request_id: str,
     ) -> PatientRequest | None:
         """Retrieves from the DB a patient request with the given task_id, if exists,
-        excluding exclude_patient_request_id
+        excluding exclude_patient_request_id.
+        During update_requests, the requests are taken from the ones prefetched
+        for the whole update instead.
         TODO: Improve documentation as above"""
-        patient_requests = db.patient_requests.search(
-            (item.task_ids.any(task_id)) & (item.id != exclude_patient_request_id)
-        )
+        if self._requests_by_id is not None:
+            patient_requests = [
+                self._requests_by_id[request_id]
+                for request_id in self._request_ids_by_task.get(task_id, ())
+                if request_id != exclude_patient_request_id
+                and task_id in self._requests_by_id[request_id].task_ids
+            ]
+        else:
+            patient_requests = [
+                PatientRequest.from_storage(request_dict, trusted=self.trusted_reads)
+                for request_dict in self.storage.search_patient_requests_by_task(
+                    task_id
+                )
+                if request_dict["id"] != exclude_patient_request_id
+            ]
 
         if not patient_requests:
             return None
@@ -206,4 +402,4 @@ class DepartmentPatientRequestService(PatientRequestService):
         if len(patient_requests) > 1:
             raise ValueError(f"Multiple patient requests found with task_id {task_id}")
 
-        return PatientRequest(**patient_requests[0])
+        return patient_requests[0]
@@ -2,46 +2,59 @@ from collections import defaultdict
 from operator import attrgetter
 from typing import Generator
 
-import db.db_tinydb as db
+from metrics import get_metrics
 from models.patient_request import PatientRequest
 from models.patient_task import PatientTask
-from tinydb import Query, where
 
 from .abstract_patient_request_service import PatientRequestService
-from .utils import create_or_update_db
+from .task_service import TaskState
+from .utils import create_or_update_many_db
 
 task_date_getter = attrgetter("updated_date")
 
-# Create a Query object for TinyDB queries
-item = Query()
-
 
 class PerPatientRequestService(PatientRequestService):
 
     def get_open_patient_request(self, patient_id) -> PatientRequest | None:
         """Retrieves from the DB the open patient request for a given patient_id"""
-        result_dict = db.patient_requests.get(
-            (where("patient_id") == patient_id) & (where("status") == "Open")
+        result_dicts = self.storage.search_patient_requests(
+            patient_ids={patient_id}, status="Open"
         )
 
-        if not result_dict:
+        if not result_dicts:
             return None
 
-        return PatientRequest(**result_dict)
+        return PatientRequest.from_storage(result_dicts[0], trusted=self.trusted_reads)
 
-    def update_requests(self, tasks: Generator[PatientTask, None, None]):
+    def update_requests(
+        self,
+        tasks: Generator[PatientTask, None, None],
+        previous_states: dict[str, TaskState | None] | None = None,
+    ):
         """Accepts a generator of tasks and updates or creates the relevant
-        patient requests in the DB."""
+        patient requests in the DB. A patient has a single open request whatever
+        the departments of the tasks, so previous_states isn't needed."""
+        metrics = get_metrics()
         grouped_by_patient: dict[str, list[PatientTask]] = defaultdict(list)
 
-        for task in tasks:
-            grouped_by_patient[task.patient_id].append(task)
-
-        for patient_id, patient_tasks in grouped_by_patient.items():
-            existing_request: PatientRequest = self.get_open_patient_request(patient_id)
-            patient_request = self.to_patient_request(patient_id, patient_tasks)
-
-            create_or_update_db(
-                existing_request=existing_request,
-                patient_request=patient_request,
-            )
+        with metrics.timer("group_tasks"):
+            for task in tasks:
+                grouped_by_patient[task.patient_id].append(task)
+
+        # Fetch the open requests of all the affected patients with a single query
+        open_requests_by_patient: dict[str, PatientRequest] = {}
+        with metrics.timer("get_open_patient_requests"):
+            open_requests = self.get_open_patient_requests(grouped_by_patient.keys())
+        for open_request in open_requests:
+            open_requests_by_patient.setdefault(open_request.patient_id, open_request)
+
+        request_pairs = []
+        with metrics.timer("build_patient_requests"):
+            for patient_id, patient_tasks in grouped_by_patient.items():
+                existing_request = open_requests_by_patient.get(patient_id)
+                patient_request = self.build_patient_request(
+                    patient_id, existing_request, patient_tasks
+                )
+                request_pairs.append((existing_request, patient_request))
+
+        create_or_update_many_db(request_pairs, storage=self.storage)
@@ -1,50 +1,154 @@
 from operator import attrgetter
-from typing import Generator
+from typing import Generator, NamedTuple
 
-import db.db_tinydb as db
+from db.storage import Storage, get_storage
+from db.unit_of_work import deferred_counts
+from metrics import TASKS_UNCHANGED
 from models.patient_task import PatientTask
-from tinydb import Query, where
 
 task_date_getter = attrgetter("updated_date")
 
-# Create a Query object for TinyDB queries
-item = Query()
+
+class TaskState(NamedTuple):
+    """The fields of a stored task that decide which request it belongs to."""
+
+    patient_id: str
+    assigned_to: str
+    status: str
 
 
 class TaskService:
     """Service for managing patient tasks in the database."""
 
-    def updates_tasks(self, tasks: list[PatientTask]):
-        """Updates the tasks in the database with the provided list of tasks."""
+    def __init__(self, storage: Storage = None, trusted_reads: bool = False):
+        """
+        Args:
+            storage (Storage): The storage to use, defaults to the default storage.
+            trusted_reads (bool): Whether tasks read from the storage are built
+                without validating them again (see PatientTask.from_storage).
+        """
+        self.storage = storage or get_storage()
+        self.trusted_reads = trusted_reads
+
+    def updates_tasks(
+        self, tasks: list[PatientTask]
+    ) -> tuple[list[PatientTask], dict[str, TaskState | None]]:
+        """Updates the tasks in the database with the provided list of tasks.
+
+        Tasks that are identical to their stored version (e.g. resent by the
+        external system) are not written.
+
+        Raises:
+            ValueError: If the storage is partitioned by patient (see
+                ShardedStorage) and a task moves to a patient of another
+                partition. Tasks can only move between patients of a partition.
+
+        Returns:
+            tuple[list[PatientTask], dict[str, TaskState | None]]: The tasks
+                that were actually changed (or new), and the stored state of each
+                of them before the update (None for new tasks), by task id.
+        """
         # Question : This code is the result of a limitation by TinyDB. What is the issue and what feature
         # would a more complete DB solution offer ?
         # NOTE: See answer in README_NOAMS_USAGE_INSTRUCTIONS_CHANGES_ANSWERS_AND_FINAL_THOUGHTS.md
+        # Note: The storages now offer a batch upsert, so the whole batch is
+        #   written with a single storage read/write
+        # The tasks are looked up in the shards of their patients first (see
+        # ShardedStorage)
+        task_ids = {task.id for task in tasks}
+        storage = self.storage.for_patients({task.patient_id for task in tasks})
+        task_docs_by_id = {
+            task_doc["id"]: task_doc for task_doc in storage.get_tasks(task_ids)
+        }
+        self._check_partition_moves(tasks, task_docs_by_id, storage)
+
+        previous_states = {}
+        changed_tasks, changed_task_docs = [], []
         for task in tasks:
-            db.tasks.upsert(task.model_dump(), item.id == task.id)
+            task_doc = task.model_dump()
+            stored_doc = task_docs_by_id.get(task.id)
+            if stored_doc == task_doc:
+                continue
+            if task.id not in previous_states:
+                previous_states[task.id] = (
+                    TaskState(
+                        stored_doc["patient_id"],
+                        stored_doc["assigned_to"],
+                        stored_doc["status"],
+                    )
+                    if stored_doc is not None
+                    else None
+                )
+            # Later versions of the task are compared to this one
+            task_docs_by_id[task.id] = task_doc
+            changed_tasks.append(task)
+            changed_task_docs.append(task_doc)
+
+        with deferred_counts(self.storage) as counts:
+            counts.increment(TASKS_UNCHANGED, len(tasks) - len(changed_tasks))
+            if changed_task_docs:
+                storage.upsert_tasks(changed_task_docs)
+        return changed_tasks, previous_states
+
+    def _check_partition_moves(
+        self,
+        tasks: list[PatientTask],
+        task_docs_by_id: dict[str, dict],
+        storage: Storage,
+    ) -> None:
+        """Raises a ValueError if any of the tasks moves to a patient of another
+        partition of the storage (see Storage.partition_for).
+
+        task_docs_by_id are the stored tasks found in storage, the storage scoped
+        to the patients of the tasks. If the scoping skips the other partitions,
+        the tasks that weren't found are looked up in the whole storage, and the
+        ones found there moved from another partition.
+        """
+        patient_ids_by_task = {task.id: task.patient_id for task in tasks}
+        moved_task_docs = [
+            task_doc
+            for task_doc in task_docs_by_id.values()
+            if task_doc["patient_id"] != patient_ids_by_task[task_doc["id"]]
+            and self.storage.partition_for(task_doc["patient_id"])
+            != self.storage.partition_for(patient_ids_by_task[task_doc["id"]])
+        ]
+        missing_task_ids = patient_ids_by_task.keys() - task_docs_by_id.keys()
+        if storage is not self.storage and missing_task_ids:
+            moved_task_docs += self.storage.get_tasks(missing_task_ids)
+
+        for task_doc in moved_task_docs:
+            raise ValueError(
+                f"Task {task_doc['id']} can't move from patient"
+                f" {task_doc['patient_id']} to patient"
+                f" {patient_ids_by_task[task_doc['id']]}, which is in another"
+                " partition of the storage"
+            )
 
     def get_open_tasks(
         self, patient_ids: set[str]
     ) -> Generator[PatientTask, None, None]:
         """Returns a generator of open patient tasks for patient_ids retrieved from the database."""
         return (
-            PatientTask(**task_doc)
-            for task_doc in db.tasks.search(
-                (where("status") == "Open") & (item.patient_id.one_of(patient_ids))
+            PatientTask.from_storage(task_doc, trusted=self.trusted_reads)
+            for task_doc in self.storage.search_tasks(
+                patient_ids=patient_ids, status="Open"
             )
         )
 
     def get_task_by_id(self, task_id: str) -> PatientTask | None:
         """Returns a PatientTask object by its ID, or None if not found."""
-        task_doc = db.tasks.get(where("id") == task_id)
+        task_doc = self.storage.get_task(task_id)
         if task_doc:
-            return PatientTask(**task_doc)
+            return PatientTask.from_storage(task_doc, trusted=self.trusted_reads)
         return None
 
     def get_tasks_by_ids(self, task_ids: set[str]) -> list[PatientTask]:
-        """Returns a list of PatientTask objects for the given task IDs."""
-        tasks = []
-        for task_id in task_ids:
-            task = self.get_task_by_id(task_id)
-            if task:
-                tasks.append(task)
-        return tasks
+        """Returns a list of PatientTask objects for the given task IDs, fetched
+        with a single lookup. IDs that are not found are skipped."""
+        if not task_ids:
+            return []
+
+        return [
+            PatientTask.from_storage(task_doc, trusted=self.trusted_reads)
+            for task_doc in self.storage.get_tasks(task_ids)
+        ]
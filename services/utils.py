@@ -1,15 +1,42 @@
-import db.db_tinydb as db
-from tinydb import Query
+from typing import Iterable
 
-# Create a Query object for TinyDB queries
-item = Query()
+from db.storage import Storage, get_storage
+from db.unit_of_work import deferred_counts
 
 
-def create_or_update_db(existing_request, patient_request):
+def create_or_update_db(existing_request, patient_request, storage: Storage = None):
     """Create a patient request in the DB OR update it if exists already."""
-    if existing_request:
-        patient_request.id = existing_request.id
+    create_or_update_many_db([(existing_request, patient_request)], storage=storage)
 
-    db.patient_requests.upsert(
-        patient_request.model_dump(), item.id == patient_request.id
-    )
+
+def create_or_update_many_db(request_pairs: Iterable[tuple], storage: Storage = None):
+    """Create or update many patient requests in the DB with a single batch upsert.
+    Requests that are identical to their existing version are not written.
+
+    Args:
+        request_pairs (Iterable[tuple]): (existing_request, patient_request) pairs,
+            where existing_request is None if patient_request is a new request.
+        storage (Storage): The storage to write to, defaults to the default storage.
+    """
+    storage = storage or get_storage()
+
+    with deferred_counts(storage) as counts:
+        request_docs = []
+        for existing_request, patient_request in request_pairs:
+            request_doc = patient_request.model_dump()
+            previous_status = None
+            if existing_request:
+                patient_request.id = request_doc["id"] = existing_request.id
+                previous_status = existing_request.status
+                if request_doc == existing_request.model_dump():
+                    counts.add_request(
+                        patient_request.id, previous_status, previous_status, False
+                    )
+                    continue
+            counts.add_request(
+                patient_request.id, previous_status, patient_request.status, True
+            )
+            request_docs.append(request_doc)
+
+        if request_docs:
+            storage.upsert_patient_requests(request_docs)
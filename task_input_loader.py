@@ -0,0 +1,241 @@
+import json
+from collections import defaultdict
+from itertools import islice
+from os import PathLike
+from pathlib import Path
+from typing import Generator, Iterable, TextIO
+
+from metrics import TASKS_COALESCED, get_metrics
+from models import PatientTask, TaskInput
+
+NDJSON_SUFFIXES = {".ndjson", ".jsonl"}
+
+# How many characters are read from the file at a time
+READ_SIZE = 64 * 1024
+
+WHITESPACE = " \t\n\r"
+
+
+class _JSONStream:
+    """A cursor over a JSON text that is read from a file on demand, so that only
+    a bounded window of the text is held in memory."""
+
+    def __init__(self, file: TextIO, read_size: int = READ_SIZE):
+        self.file = file
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _read_more(self) -> bool:
+        """Reads the next part of the file into the buffer, dropping the part
+        that was already consumed. Returns False at the end of the file."""
+        if self.eof:
+            return False
+
+        data = self.file.read(self.read_size)
+        if not data:
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.pos :] + data
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Returns the next non whitespace character without consuming it, or ""
+        at the end of the file."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._read_more():
+                return self.buffer[self.pos : self.pos + 1]
+
+    def expect(self, chars: str) -> str:
+        """Consumes the next non whitespace character, which must be one of chars."""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(
+                f"Invalid task input: expected one of {chars!r}, found {char!r}"
+            )
+        self.pos += 1
+        return char
+
+    def decode_value(self):
+        """Decodes and consumes the next JSON value, reading as much of the file as
+        the value needs."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._read_more():
+                    raise
+                continue
+
+            # A value that runs up to the end of the buffer (e.g. a number) may
+            # continue in the part of the file that wasn't read yet
+            if end == len(self.buffer) and self._read_more():
+                continue
+
+            self.pos = end
+            return value
+
+
+def _iter_json_task_docs(file: TextIO, read_size: int) -> Generator[dict, None, None]:
+    """Yields the task documents of a {"tasks": [...]} JSON file one at a time."""
+    stream = _JSONStream(file, read_size=read_size)
+
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+
+    while True:
+        key = stream.decode_value()
+        stream.expect(":")
+
+        if key != "tasks":
+            stream.decode_value()
+        else:
+            stream.expect("[")
+            if stream.peek() == "]":
+                stream.expect("]")
+            else:
+                while True:
+                    yield stream.decode_value()
+                    if stream.expect(",]") == "]":
+                        break
+
+        if stream.expect(",}") == "}":
+            return
+
+
+def _iter_ndjson_task_docs(file: TextIO) -> Generator[str, None, None]:
+    """Yields the (JSON encoded) task documents of a file with a task per line."""
+    for line in file:
+        if line.strip():
+            yield line
+
+
+def iter_tasks(
+    file: PathLike, ndjson: bool | None = None, read_size: int = READ_SIZE
+) -> Generator[PatientTask, None, None]:
+    """Yields the validated tasks of a task input file one at a time, without
+    loading the whole file in memory.
+
+    Args:
+        file (PathLike): Either a TaskInput JSON file ({"tasks": [...]}) or an
+            NDJSON file, with a task per line.
+        ndjson (bool | None): Whether the file is an NDJSON file. Defaults to
+            True for .ndjson/.jsonl files and False otherwise.
+        read_size (int): How many characters are read from the file at a time.
+
+    Yields:
+        PatientTask: The tasks in the order of the file.
+    """
+    if ndjson is None:
+        ndjson = Path(file).suffix in NDJSON_SUFFIXES
+
+    with open(file) as f:
+        if ndjson:
+            for line in _iter_ndjson_task_docs(f):
+                yield PatientTask.model_validate_json(line)
+        else:
+            for task_doc in _iter_json_task_docs(f, read_size=read_size):
+                yield PatientTask.model_validate(task_doc)
+
+
+def chunk_tasks(
+    tasks: Iterable[PatientTask], chunk_size: int
+) -> Generator[TaskInput, None, None]:
+    """Groups tasks into TaskInput objects of at most chunk_size tasks."""
+    tasks = iter(tasks)
+    while chunk := list(islice(tasks, chunk_size)):
+        yield TaskInput(tasks=chunk)
+
+
+def iter_task_inputs(
+    file: PathLike, chunk_size: int = 1000, ndjson: bool | None = None
+) -> Generator[TaskInput, None, None]:
+    """Yields the tasks of a task input file as TaskInput objects of at most
+    chunk_size tasks, so that memory use doesn't depend on the file size."""
+    return chunk_tasks(iter_tasks(file, ndjson=ndjson), chunk_size)
+
+
+def coalesce_tasks(tasks: Iterable[PatientTask]) -> list[PatientTask]:
+    """Keeps only the latest version (by updated_date, and then by position) of
+    every task, in the order the tasks first appear.
+
+    As long as the versions of a task are sent in order, processing the result
+    is the same as processing the versions one by one, since every version
+    overwrites the previous one and the requests are built from the latest
+    versions of the tasks.
+    """
+    latest_tasks: dict[str, PatientTask] = {}
+    version_count = 0
+    for task in tasks:
+        version_count += 1
+        latest_task = latest_tasks.get(task.id)
+        if latest_task is None or task.updated_date >= latest_task.updated_date:
+            latest_tasks[task.id] = task
+
+    get_metrics().increment(TASKS_COALESCED, version_count - len(latest_tasks))
+    return list(latest_tasks.values())
+
+
+def _department(tasks: list[PatientTask]) -> str | None:
+    """Returns the department of tasks, or None if some of them are closed or
+    they are in several departments."""
+    departments = {
+        task.assigned_to if task.status == "Open" else None for task in tasks
+    }
+    return departments.pop() if len(departments) == 1 else None
+
+
+def _coalesce_window(
+    task_inputs: Iterable[TaskInput],
+) -> Generator[TaskInput, None, None]:
+    """Merges task_inputs into as few task inputs (stages) as possible, see
+    coalesce_task_inputs."""
+    stages: list[list[PatientTask]] = []
+    # The stage of the latest tasks of every patient, and their department
+    patient_stages: dict[str, tuple[int, str | None]] = {}
+
+    for task_input in task_inputs:
+        tasks_by_patient = defaultdict(list)
+        for task in task_input.tasks:
+            tasks_by_patient[task.patient_id].append(task)
+
+        for patient_id, tasks in tasks_by_patient.items():
+            department = _department(tasks)
+            stage, stage_department = patient_stages.get(patient_id, (-1, None))
+            if stage_department is None or stage_department != department:
+                stage += 1
+                if stage == len(stages):
+                    stages.append([])
+            patient_stages[patient_id] = (stage, department)
+            stages[stage] += tasks
+
+    for stage_tasks in stages:
+        yield TaskInput(tasks=coalesce_tasks(stage_tasks))
+
+
+def coalesce_task_inputs(
+    task_inputs: Iterable[TaskInput], max_batches: int = 10
+) -> Generator[TaskInput, None, None]:
+    """Merges every window of max_batches consecutive (e.g. queued) task inputs
+    into as few task inputs as possible, with only the latest version of every
+    task, so that processing them gives the same tasks and requests as
+    processing the task inputs one by one.
+
+    The requests of a patient only depend on the patient's tasks, so the tasks of
+    different patients are merged freely. But a task that is closed or moves to
+    another department can close a request, after which the next open task of
+    the patient starts a new request. So the tasks a patient has in successive
+    inputs are only merged while they are all open and in the same department;
+    the other ones go to the next merged task input, in order.
+    """
+    task_inputs = iter(task_inputs)
+    while window := list(islice(task_inputs, max_batches)):
+        yield from _coalesce_window(window)
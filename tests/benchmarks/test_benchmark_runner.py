@@ -0,0 +1,77 @@
+import pytest
+
+import db.db_tinydb as db_tinydb
+from benchmarks import run
+from benchmarks.data_generator import SyntheticConfig
+
+CONFIG = SyntheticConfig(patient_count=20, batch_count=3, batch_size=10)
+
+
+def create_result(scenario="per_patient/sqlite", **measurements):
+    measurements = {
+        "tasks_per_second": 1000.0,
+        "p50_ms": 10.0,
+        "p95_ms": 20.0,
+        "p99_ms": 30.0,
+        "peak_memory_mb": 5.0,
+        **measurements,
+    }
+    return run.BenchmarkResult(
+        scenario=scenario, tasks=30, batches=3, seconds=0.03, **measurements
+    )
+
+
+@pytest.mark.parametrize("request_service", run.REQUEST_SERVICES)
+def test_run_scenario(request_service):
+    result = run.run_scenario(CONFIG, request_service, "sqlite")
+
+    assert result.scenario == f"{request_service}/sqlite"
+    assert result.tasks == 30
+    assert 0 < result.p50_ms <= result.p95_ms <= result.p99_ms
+    assert result.peak_memory_mb > 0
+
+
+def test_tinydb_scenario_leaves_the_process_wide_database_as_is(tmp_path):
+    clinic = db_tinydb.open_clinic(str(tmp_path / "db.json"))
+    clinic.table(db_tinydb.TASKS_TABLE).insert({"id": "task1"})
+
+    with db_tinydb.restoring_clinic():
+        db_tinydb.set_clinic(clinic)
+        result = run.run_scenario(CONFIG, "per_patient", "tinydb", False)
+
+        assert result.tasks == 30
+        assert db_tinydb.get_clinic() is clinic
+        assert clinic.table(db_tinydb.TASKS_TABLE).all() == [{"id": "task1"}]
+
+
+def test_percentile():
+    assert run.percentile([1.0], 0.99) == 1.0
+    assert run.percentile([1.0, 2.0, 3.0], 0.5) == 2.0
+    assert run.percentile([1.0, 2.0], 0.25) == 1.25
+
+
+def test_find_regressions():
+    baseline = run.Baseline(config=CONFIG, results=[create_result()])
+
+    regressions = run.find_regressions(
+        [
+            create_result(tasks_per_second=700.0, p50_ms=11.0, p99_ms=40.0),
+            create_result("department/sqlite", p50_ms=100.0),
+        ],
+        baseline,
+        tolerance=0.2,
+    )
+
+    assert [regression.split(":")[0] for regression in regressions] == [
+        "per_patient/sqlite tasks_per_second",
+        "per_patient/sqlite p99_ms",
+    ]
+
+
+def test_baseline_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(run, "BASELINES_DIR", tmp_path)
+    baseline = run.Baseline(config=CONFIG, results=[create_result()])
+
+    run.save_baseline("main", baseline)
+
+    assert run.load_baseline("main") == baseline
@@ -0,0 +1,55 @@
+from benchmarks.data_generator import SyntheticConfig, SyntheticDataGenerator
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
+from services.patient_department_request_service import DepartmentPatientRequestService
+
+CONFIG = SyntheticConfig(patient_count=50, batch_count=5, batch_size=20)
+
+
+def generate_all(config):
+    generator = SyntheticDataGenerator(config)
+    return (
+        list(generator.history_batches(patients_per_batch=20)),
+        generator.initial_open_tasks(),
+        list(generator.task_inputs()),
+    )
+
+
+def test_generation_is_deterministic():
+    assert generate_all(CONFIG) == generate_all(CONFIG)
+    assert generate_all(CONFIG) != generate_all(CONFIG.model_copy(update={"seed": 1}))
+
+
+def test_history_matches_config():
+    history, open_tasks, _ = generate_all(CONFIG)
+
+    request_docs = [doc for _, request_docs in history for doc in request_docs]
+    assert len(history) == 3
+    assert len(request_docs) == 50 * CONFIG.closed_requests_per_patient
+    assert all(doc["status"] == "Closed" for doc in request_docs)
+    assert len(open_tasks) == round(50 * 0.05) * CONFIG.tasks_per_request
+
+
+def test_task_inputs_update_the_open_tasks():
+    generator = SyntheticDataGenerator(
+        CONFIG.model_copy(update={"new_task_rate": 0, "open_patient_ratio": 1})
+    )
+    open_task_ids = {task.id for task in generator.initial_open_tasks()}
+
+    for task_input in generator.task_inputs():
+        for task in task_input.tasks:
+            assert task.id in open_task_ids
+            if task.status == "Closed":
+                open_task_ids.discard(task.id)
+
+    assert set(generator.open_tasks) == open_task_ids
+
+
+def test_seed_builds_the_open_requests():
+    storage = SQLiteStorage(":memory:")
+    clinic_manager = ClinicManager(DepartmentPatientRequestService(storage=storage))
+
+    SyntheticDataGenerator(CONFIG).seed(clinic_manager)
+
+    assert len(storage.search_patient_requests(status="Closed")) == 100
+    assert len(storage.search_patient_requests(status="Open")) == round(50 * 0.05)
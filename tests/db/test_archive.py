@@ -0,0 +1,112 @@
+from datetime import datetime
+
+import pytest
+
+from clinic_manager import ClinicManager
+from db.archive import ArchivingStorage
+from db.db_log import LogStorage
+from db.db_sqlite import SQLiteStorage
+from main import load_all_inputs
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+from tests.utils import create_request_doc, create_task_doc
+
+
+@pytest.fixture
+def storage(tmp_path):
+    """Fixture providing an archiving storage, with an in-memory SQLite working
+    storage and a log storage archive."""
+    archive = LogStorage(tmp_path, fsync=False)
+    yield ArchivingStorage(working=SQLiteStorage(":memory:"), archive=archive)
+    archive.close()
+
+
+def test_closed_documents_are_moved_to_the_archive(storage):
+    storage.write_batch([create_task_doc("t1")], [create_request_doc("req1")])
+    storage.write_batch(
+        [create_task_doc("t1", "Closed")], [create_request_doc("req1", "Closed")]
+    )
+
+    assert storage.working.search_tasks() == []
+    assert storage.working.search_patient_requests() == []
+    assert storage.search_archived_tasks() == [create_task_doc("t1", "Closed")]
+    assert storage.search_archived_patient_requests() == [
+        create_request_doc("req1", "Closed")
+    ]
+
+
+def test_reopened_task_is_moved_back_to_the_working_storage(storage):
+    storage.upsert_task(create_task_doc("t1", "Closed"))
+    storage.upsert_task(create_task_doc("t1"))
+
+    assert storage.archive.search_tasks() == []
+    assert storage.search_tasks(status="Open") == [create_task_doc("t1")]
+
+
+def test_lookups_span_the_archive(storage):
+    storage.write_batch(
+        [create_task_doc("t1"), create_task_doc("t2", "Closed")],
+        [create_request_doc("req1", "Closed", task_ids={"t2"})],
+    )
+
+    assert {t["id"] for t in storage.get_tasks({"t1", "t2"})} == {"t1", "t2"}
+    assert storage.get_task("t2") == create_task_doc("t2", "Closed")
+    assert [r["id"] for r in storage.search_patient_requests_by_task("t2")] == ["req1"]
+    assert len(storage.search_tasks()) == 2
+
+
+def test_archive_closed_moves_the_existing_history(storage):
+    storage.working.upsert_patient_requests(
+        [create_request_doc("req1", "Closed"), create_request_doc("req2")]
+    )
+
+    storage.archive_closed()
+
+    assert [r["id"] for r in storage.working.search_patient_requests()] == ["req2"]
+    assert [r["id"] for r in storage.search_archived_patient_requests()] == ["req1"]
+
+
+@pytest.mark.parametrize(
+    "service_cls, expected_open_counts",
+    [
+        (PerPatientRequestService, [3, 2, 0, 1]),
+        (DepartmentPatientRequestService, [5, 3, 0, 1]),
+    ],
+)
+def test_task_processing(storage, service_cls, expected_open_counts):
+    clinic_manager = ClinicManager(service_cls(storage=storage))
+
+    for task_input, expected_open_count in zip(load_all_inputs(), expected_open_counts):
+        clinic_manager.process_tasks_update(task_input)
+
+        assert (
+            len(storage.search_patient_requests(status="Open")) == expected_open_count
+        )
+        assert storage.working.search_patient_requests(status="Closed") == []
+        assert storage.working.search_tasks(status="Closed") == []
+
+
+def test_interrupted_moves_are_read_once_and_repaired(storage):
+    # The process died after writing the archived (closed) and the working
+    # (reopened) copies, before removing the previous ones
+    closed_task = {
+        **create_task_doc("t1", "Closed"),
+        "updated_date": datetime(2023, 5, 2),
+    }
+    reopened_task = {**create_task_doc("t2"), "updated_date": datetime(2023, 5, 2)}
+    storage.working.upsert_tasks([create_task_doc("t1"), reopened_task])
+    storage.archive.upsert_tasks([closed_task, create_task_doc("t2", "Closed")])
+    storage.working.upsert_patient_requests([create_request_doc("req1")])
+    storage.archive.upsert_patient_requests([create_request_doc("req1", "Closed", ())])
+
+    assert sorted(d["id"] for d in storage.search_tasks()) == ["t1", "t2"]
+    assert [r["id"] for r in storage.search_patient_requests_by_task("t1")] == ["req1"]
+
+    storage.archive_closed()
+
+    assert storage.working.search_tasks() == [reopened_task]
+    assert storage.archive.search_tasks() == [closed_task]
+    assert storage.working.search_patient_requests() == []
+    assert storage.archive.search_patient_requests() == [
+        create_request_doc("req1", "Closed", ())
+    ]
@@ -0,0 +1,106 @@
+from unittest.mock import patch
+
+import pytest
+
+from clinic_manager import ClinicManager
+from db.bloom import BloomFilter, OpenRequestsFilter
+from db.cache import OpenRequestsCache
+from db.db_sqlite import SQLiteStorage
+from main import load_all_inputs
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+from tests.utils import create_request_doc
+
+
+@pytest.fixture
+def storage():
+    """Fixture providing an open requests filter on top of an in-memory SQLite
+    storage."""
+    return OpenRequestsFilter(SQLiteStorage(":memory:"), capacity=100)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom_filter = BloomFilter(capacity=1000, false_positive_rate=0.01)
+    for i in range(1000):
+        bloom_filter.add(f"patient{i}")
+
+    assert all(f"patient{i}" in bloom_filter for i in range(1000))
+    false_positives = sum(f"other{i}" in bloom_filter for i in range(10_000))
+    assert false_positives < 300
+
+
+def test_patients_without_open_requests_are_not_queried(storage):
+    storage.write_batch(
+        [],
+        [
+            create_request_doc("r1", patient_id="patient1"),
+            create_request_doc("r2", patient_id="patient2", status="Closed"),
+        ],
+    )
+
+    with patch.object(
+        storage.storage,
+        "search_patient_requests",
+        wraps=storage.storage.search_patient_requests,
+    ) as mock_search:
+        assert (
+            storage.search_patient_requests(
+                patient_ids={"patient2", "patient3"}, status="Open"
+            )
+            == []
+        )
+        assert (
+            storage.search_patient_requests(
+                patient_ids={"patient1"}, status="Open", assigned_to="Radiology"
+            )
+            == []
+        )
+        mock_search.assert_not_called()
+
+        [request_doc] = storage.search_patient_requests(
+            patient_ids={"patient1", "patient2", "patient3"}, status="Open"
+        )
+
+    assert request_doc["id"] == "r1"
+    mock_search.assert_called_once_with(
+        patient_ids={"patient1"}, status="Open", assigned_to=None
+    )
+    assert storage.negatives == 5
+
+
+def test_filter_is_built_from_the_storage_and_rebuilt_after_closes():
+    sqlite_storage = SQLiteStorage(":memory:")
+    sqlite_storage.upsert_patient_requests([create_request_doc("r1")])
+    storage = OpenRequestsFilter(sqlite_storage, capacity=100)
+    assert storage.search_patient_requests(patient_ids={"patient1"}, status="Open")
+
+    storage.upsert_patient_requests([create_request_doc("r1", status="Closed")])
+
+    # As many requests were closed as opened, so the filter was rebuilt
+    assert "patient1\x1f" not in storage.filter
+    assert (
+        storage.search_patient_requests(patient_ids={"patient1"}, status="Open") == []
+    )
+
+
+@pytest.mark.parametrize(
+    "service_cls", [PerPatientRequestService, DepartmentPatientRequestService]
+)
+def test_task_processing_with_the_filter(service_cls):
+    filtered_storage = OpenRequestsCache(OpenRequestsFilter(SQLiteStorage(":memory:")))
+    storage = SQLiteStorage(":memory:")
+
+    for s in (filtered_storage, storage):
+        clinic_manager = ClinicManager(service_cls(storage=s))
+        for task_input in load_all_inputs():
+            clinic_manager.process_tasks_update(task_input)
+
+    assert sorted(
+        (r["patient_id"], r["assigned_to"], r["status"], sorted(r["task_ids"]))
+        for r in filtered_storage.search_patient_requests()
+    ) == sorted(
+        (r["patient_id"], r["assigned_to"], r["status"], sorted(r["task_ids"]))
+        for r in storage.search_patient_requests()
+    )
+    # The patients of the first input had no requests
+    assert filtered_storage.storage.negatives >= 3
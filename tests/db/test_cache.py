@@ -0,0 +1,111 @@
+from unittest.mock import patch
+
+import pytest
+
+from clinic_manager import ClinicManager
+from db.cache import OpenRequestsCache
+from db.db_sqlite import SQLiteStorage
+from main import load_all_inputs
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+from tests.utils import create_request_doc
+
+
+@pytest.fixture
+def storage():
+    """Fixture providing a cache of up to 2 patients on top of an in-memory
+    SQLite storage."""
+    return OpenRequestsCache(SQLiteStorage(":memory:"), max_patients=2)
+
+
+def search_open(storage, *patient_ids, assigned_to=None):
+    return sorted(
+        request_doc["id"]
+        for request_doc in storage.search_patient_requests(
+            patient_ids=set(patient_ids), status="Open", assigned_to=assigned_to
+        )
+    )
+
+
+def test_open_requests_are_read_through(storage):
+    storage.upsert_patient_requests(
+        [create_request_doc("r1"), create_request_doc("r2", status="Closed")]
+    )
+
+    with patch.object(
+        storage.storage,
+        "search_patient_requests",
+        wraps=storage.storage.search_patient_requests,
+    ) as mock_search:
+        assert search_open(storage, "patient1", "patient2") == ["r1"]
+        assert search_open(storage, "patient1", "patient2") == ["r1"]
+        assert search_open(storage, "patient1", assigned_to="Radiology") == []
+
+    mock_search.assert_called_once_with(
+        patient_ids={"patient1", "patient2"}, status="Open"
+    )
+    assert (storage.hits, storage.misses) == (3, 2)
+
+
+def test_writes_update_the_cached_patients(storage):
+    storage.upsert_patient_requests([create_request_doc("r1")])
+    assert search_open(storage, "patient1") == ["r1"]
+
+    storage.write_batch([], [create_request_doc("r1", status="Closed")])
+    assert search_open(storage, "patient1") == []
+
+    storage.upsert_patient_requests([create_request_doc("r2")])
+    assert search_open(storage, "patient1") == ["r2"]
+
+    storage.delete_patient_requests(["r2"])
+    assert search_open(storage, "patient1") == []
+    assert storage.misses == 1
+
+
+def test_returned_requests_can_be_changed(storage):
+    storage.upsert_patient_requests([create_request_doc("r1")])
+
+    [request_doc] = storage.search_patient_requests(
+        patient_ids={"patient1"}, status="Open"
+    )
+    request_doc["task_ids"].add("t2")
+
+    [request_doc] = storage.search_patient_requests(
+        patient_ids={"patient1"}, status="Open"
+    )
+    assert request_doc["task_ids"] == {"t1"}
+
+
+def test_least_recently_used_patients_are_evicted(storage):
+    search_open(storage, "patient1")
+    search_open(storage, "patient2")
+    search_open(storage, "patient1")
+    search_open(storage, "patient3")
+
+    assert list(storage._open_requests) == ["patient1", "patient3"]
+    search_open(storage, "patient2")
+    assert storage.misses == 4
+
+
+@pytest.mark.parametrize(
+    "service_cls", [PerPatientRequestService, DepartmentPatientRequestService]
+)
+def test_task_processing_with_the_cache(service_cls):
+    cached_storage = OpenRequestsCache(SQLiteStorage(":memory:"))
+    storage = SQLiteStorage(":memory:")
+
+    for s in (cached_storage, storage):
+        clinic_manager = ClinicManager(service_cls(storage=s))
+        for task_input in load_all_inputs():
+            clinic_manager.process_tasks_update(task_input)
+
+    assert sorted(
+        (r["patient_id"], r["assigned_to"], r["status"], sorted(r["task_ids"]))
+        for r in cached_storage.search_patient_requests()
+    ) == sorted(
+        (r["patient_id"], r["assigned_to"], r["status"], sorted(r["task_ids"]))
+        for r in storage.search_patient_requests()
+    )
+    # Only the first update of a patient goes to the storage
+    assert cached_storage.misses == 3
+    assert cached_storage.hits > 0
@@ -0,0 +1,125 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from clinic_manager import ClinicManager
+from db.db_log import LogStorage
+from main import load_all_inputs
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+from tests.utils import create_request_doc
+
+# Stored documents mix timezone aware and naive datetimes
+AWARE_DATE = datetime(2023, 5, 1, 10, 0, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def storage(tmp_path):
+    """Fixture providing a log storage in a temporary directory."""
+    log_storage = LogStorage(tmp_path, fsync=False)
+    yield log_storage
+    log_storage.close()
+
+
+def reopen(storage):
+    storage.close()
+    return LogStorage(storage.directory, fsync=False)
+
+
+def test_state_is_rebuilt_from_the_log(storage):
+    storage.upsert_patient_request(
+        create_request_doc("req1", task_ids={"t1", "t2"}, created_date=AWARE_DATE)
+    )
+    storage.upsert_patient_request(
+        create_request_doc("req1", task_ids={"t2"}, created_date=AWARE_DATE)
+    )
+    storage.upsert_patient_request(
+        create_request_doc("req2", status="Closed", task_ids=())
+    )
+
+    reopened = reopen(storage)
+
+    assert reopened.search_patient_requests() == [
+        create_request_doc("req1", task_ids={"t2"}, created_date=AWARE_DATE),
+        create_request_doc("req2", status="Closed", task_ids=()),
+    ]
+    assert reopened.search_patient_requests_by_task("t1") == []
+    assert [r["id"] for r in reopened.search_patient_requests_by_task("t2")] == ["req1"]
+    reopened.close()
+
+
+def test_writes_append_to_the_log(storage):
+    storage.upsert_patient_request(create_request_doc("req1"))
+    log_size = storage.log_path.stat().st_size
+
+    storage.upsert_patient_request(create_request_doc("req2"))
+
+    assert storage.log_path.stat().st_size < 2 * log_size + 1
+    assert len(storage.log_path.read_text().splitlines()) == 2
+
+
+def test_log_is_compacted_into_the_snapshot(tmp_path):
+    storage = LogStorage(tmp_path, min_compaction_size=1, fsync=False)
+
+    storage.upsert_patient_request(create_request_doc("req1"))
+    storage.upsert_patient_request(create_request_doc("req2"))
+
+    assert storage.log_path.stat().st_size == 0
+    assert [r["id"] for r in reopen(storage).search_patient_requests()] == [
+        "req1",
+        "req2",
+    ]
+
+
+def test_partially_written_batch_is_dropped(storage):
+    storage.upsert_patient_request(create_request_doc("req1"))
+    with open(storage.log_path, "a") as f:
+        f.write('{"tasks":[],"patient_requests":[{"id":"req2"')
+
+    reopened = reopen(storage)
+    reopened.upsert_patient_request(create_request_doc("req3"))
+
+    assert [r["id"] for r in reopen(reopened).search_patient_requests()] == [
+        "req1",
+        "req3",
+    ]
+
+
+def test_drop_tables_is_persisted(storage):
+    storage.upsert_patient_request(create_request_doc("req1"))
+
+    storage.drop_tables()
+
+    assert reopen(storage).search_patient_requests() == []
+
+
+@pytest.mark.parametrize(
+    "service_cls, expected_open_counts",
+    [
+        (PerPatientRequestService, [3, 2, 0, 1]),
+        (DepartmentPatientRequestService, [5, 3, 0, 1]),
+    ],
+)
+def test_task_processing(storage, service_cls, expected_open_counts):
+    clinic_manager = ClinicManager(service_cls(storage=storage))
+
+    for task_input, expected_open_count in zip(load_all_inputs(), expected_open_counts):
+        clinic_manager.process_tasks_update(task_input)
+
+        open_requests = storage.search_patient_requests(status="Open")
+        assert len(open_requests) == expected_open_count
+
+    stored_requests = storage.search_patient_requests()
+    assert reopen(storage).search_patient_requests() == stored_requests
+
+
+def test_deletes_are_replayed(storage):
+    storage.upsert_patient_request(create_request_doc("req1", task_ids={"t1"}))
+    storage.upsert_patient_request(create_request_doc("req2", task_ids=()))
+
+    storage.delete_patient_requests({"req1"})
+    reopened = reopen(storage)
+
+    assert [r["id"] for r in reopened.search_patient_requests()] == ["req2"]
+    assert reopened.search_patient_requests_by_task("t1") == []
+    reopened.close()
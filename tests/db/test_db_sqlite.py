@@ -0,0 +1,88 @@
+import pytest
+
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
+from db.storage import set_storage
+from main import load_all_inputs
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+from tests.utils import create_request_doc
+
+
+@pytest.fixture
+def storage():
+    """Fixture providing an in-memory SQLite storage, used as the default storage."""
+    sqlite_storage = SQLiteStorage(":memory:")
+    set_storage(sqlite_storage)
+    yield sqlite_storage
+    set_storage(None)
+
+
+def test_upsert_patient_request_round_trip(storage):
+    storage.upsert_patient_request(create_request_doc("req1", task_ids={"t1", "t2"}))
+
+    assert storage.search_patient_requests(patient_ids={"patient1"}) == [
+        create_request_doc("req1", task_ids={"t1", "t2"})
+    ]
+
+
+def test_upsert_patient_request_updates_task_index(storage):
+    storage.upsert_patient_request(create_request_doc("req1", task_ids={"t1", "t2"}))
+    storage.upsert_patient_request(create_request_doc("req1", task_ids={"t2"}))
+
+    assert storage.search_patient_requests_by_task("t1") == []
+    assert [r["id"] for r in storage.search_patient_requests_by_task("t2")] == ["req1"]
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT doc FROM tasks WHERE patient_id = 'p' AND status = 'Open'",
+        "SELECT doc FROM patient_requests WHERE patient_id = 'p' AND status = 'Open'",
+        "SELECT request_id FROM request_tasks WHERE task_id = 't'",
+    ],
+)
+def test_lookups_use_an_index(storage, sql):
+    plan = storage.connection.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+
+    assert all("USING" in row[-1] for row in plan), plan
+
+
+@pytest.mark.parametrize(
+    "service_cls, expected_open_counts",
+    [
+        (PerPatientRequestService, [3, 2, 0, 1]),
+        (DepartmentPatientRequestService, [5, 3, 0, 1]),
+    ],
+)
+def test_task_processing(storage, service_cls, expected_open_counts):
+    clinic_manager = ClinicManager(service_cls(storage=storage))
+
+    for task_input, expected_open_count in zip(load_all_inputs(), expected_open_counts):
+        clinic_manager.process_tasks_update(task_input)
+
+        open_requests = storage.search_patient_requests(status="Open")
+        assert len(open_requests) == expected_open_count
+
+
+def test_delete_patient_requests_updates_task_index(storage):
+    storage.upsert_patient_request(create_request_doc("req1", task_ids={"t1"}))
+
+    storage.delete_patient_requests({"req1", "req2"})
+
+    assert storage.search_patient_requests() == []
+    assert storage.search_patient_requests_by_task("t1") == []
+
+
+def test_search_patient_requests_by_tasks(storage):
+    storage.upsert_patient_requests(
+        [
+            create_request_doc("req1", task_ids={"t1", "t2"}),
+            create_request_doc("req2", task_ids={"t3"}),
+            create_request_doc("req3", task_ids={"t4"}),
+        ]
+    )
+
+    assert [
+        r["id"] for r in storage.search_patient_requests_by_tasks({"t1", "t2", "t3"})
+    ] == ["req1", "req2"]
@@ -0,0 +1,150 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+import db.db_tinydb as db
+from tests.utils import create_request_doc, create_task_doc
+
+
+@pytest.fixture
+def storage():
+    """Fixture providing a TinyDB storage on top of empty tables."""
+    db.clinic.drop_tables()
+    return db.TinyDBStorage()
+
+
+def request_ids_by_task(storage, task_id):
+    return {r["id"] for r in storage.search_patient_requests_by_task(task_id)}
+
+
+def test_task_index_follows_request_upserts(storage):
+    storage.upsert_patient_request(create_request_doc("req1", task_ids={"t1", "t2"}))
+    storage.upsert_patient_request(create_request_doc("req2", task_ids={"t3"}))
+    storage.upsert_patient_request(create_request_doc("req1", task_ids={"t2", "t3"}))
+
+    assert request_ids_by_task(storage, "t1") == set()
+    assert request_ids_by_task(storage, "t2") == {"req1"}
+    assert request_ids_by_task(storage, "t3") == {"req1", "req2"}
+    assert len(db.patient_requests) == 2, "Upserts should not duplicate requests"
+
+
+def test_task_index_is_built_from_existing_requests(storage):
+    db.patient_requests.insert(create_request_doc("req1", task_ids={"t1"}))
+
+    assert request_ids_by_task(db.TinyDBStorage(), "t1") == {"req1"}
+
+
+def test_task_index_is_rebuilt_after_drop_tables(storage):
+    storage.upsert_patient_request(create_request_doc("req1", task_ids={"t1"}))
+
+    db.clinic.drop_tables()
+
+    assert request_ids_by_task(storage, "t1") == set()
+
+
+def test_upsert_tasks_reads_and_writes_the_storage_once(storage):
+    storage.upsert_tasks([create_task_doc("t1"), create_task_doc("t2")])
+    batch = [create_task_doc(f"t{i}", status="Closed") for i in range(1, 51)]
+
+    with patch.object(
+        db.clinic.storage, "read", wraps=db.clinic.storage.read
+    ) as mock_read, patch.object(
+        db.clinic.storage, "write", wraps=db.clinic.storage.write
+    ) as mock_write:
+        storage.upsert_tasks(batch)
+
+    assert mock_read.call_count == 1
+    assert mock_write.call_count == 1
+    assert len(db.tasks) == 50, "Existing tasks should be updated, not duplicated"
+    assert storage.search_tasks(status="Closed") == batch
+
+
+def test_upsert_tasks_keeps_the_last_version_of_a_task(storage):
+    storage.upsert_tasks([create_task_doc("t1"), create_task_doc("t1", "Closed")])
+
+    assert storage.search_tasks() == [create_task_doc("t1", "Closed")]
+    assert db.tasks.insert(create_task_doc("t2")) == 2, "Next doc_id is kept in sync"
+
+
+def test_delete_patient_requests_updates_task_index(storage):
+    storage.upsert_patient_request(create_request_doc("req1", task_ids={"t1"}))
+    storage.upsert_patient_request(create_request_doc("req2", task_ids={"t2"}))
+
+    storage.delete_patient_requests({"req1"})
+
+    assert [r["id"] for r in storage.search_patient_requests()] == ["req2"]
+    assert request_ids_by_task(storage, "t1") == set()
+    assert request_ids_by_task(db.TinyDBStorage(), "t1") == set()
+
+
+def test_storages_of_the_same_database_share_the_task_index(storage):
+    other_storage = db.TinyDBStorage()
+    storage.upsert_patient_request(create_request_doc("req1", task_ids={"t1"}))
+    assert request_ids_by_task(other_storage, "t1") == {"req1"}
+
+    # The task moves to a request written through the other storage
+    other_storage.upsert_patient_request(create_request_doc("req1", task_ids=set()))
+    other_storage.upsert_patient_request(create_request_doc("req2", task_ids={"t1"}))
+
+    assert request_ids_by_task(storage, "t1") == {"req2"}
+    storage.delete_patient_requests({"req2"})
+    assert request_ids_by_task(other_storage, "t1") == set()
+    assert [r["id"] for r in other_storage.search_patient_requests()] == ["req1"]
+
+
+def test_delete_tasks(storage):
+    storage.upsert_tasks([create_task_doc("t1"), create_task_doc("t2")])
+
+    storage.delete_tasks({"t1"})
+
+    assert storage.search_tasks() == [create_task_doc("t2")]
+
+
+def test_importing_the_module_does_not_open_the_database(tmp_path):
+    subprocess.run(
+        [sys.executable, "-c", "import db.db_tinydb, models, services"],
+        cwd=tmp_path,
+        env={**os.environ, "PYTHONPATH": str(Path(db.__file__).parents[1])},
+        check=True,
+    )
+
+    assert not (tmp_path / "tinydb").exists()
+
+
+def test_storage_on_a_snapshot_file(storage, tmp_path):
+    storage.upsert_tasks([create_task_doc("t1")])
+    path = str(tmp_path / "db.snapshot")
+    db.set_clinic(db.open_clinic(path))
+    try:
+        snapshot_storage = db.TinyDBStorage()
+        snapshot_storage.upsert_tasks([create_task_doc("t2")])
+        snapshot_storage.upsert_patient_request(
+            create_request_doc("req1", task_ids={"t2"})
+        )
+
+        db.set_clinic(db.open_clinic(path))
+        assert isinstance(db.clinic.storage, db.ClinicSnapshotStorage)
+        assert snapshot_storage.search_tasks() == [create_task_doc("t2")]
+        assert request_ids_by_task(snapshot_storage, "t2") == {"req1"}
+    finally:
+        db.set_clinic(None)
+
+    assert storage.search_tasks() == [create_task_doc("t1")]
+
+
+def test_snapshot_storage_closes_the_mapping_of_its_last_read(tmp_path):
+    path = str(tmp_path / "db.snapshot")
+    snapshot_storage = db.ClinicSnapshotStorage(path)
+    snapshot_storage.write({"Tasks": {"1": create_task_doc("t1")}})
+
+    tables = snapshot_storage.read()
+    snapshot_storage.read()
+    assert tables._buffer.closed
+
+    tables = snapshot_storage.read()
+    snapshot_storage.close()
+    assert tables._buffer.closed
@@ -0,0 +1,76 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+import db.db_tinydb as db
+from db import encoding
+
+AWARE_DATE = datetime(2023, 5, 1, 10, 0, 0, 123456, tzinfo=timezone.utc)
+NAIVE_DATE = datetime(2023, 5, 1, 10, 0, 0)
+
+
+@pytest.mark.parametrize("date", [AWARE_DATE, NAIVE_DATE], ids=["aware", "naive"])
+def test_doc_round_trip(date):
+    doc = {
+        "id": "req1",
+        "created_date": date,
+        "updated_date": date,
+        "task_ids": {"t1", "t2"},
+        "medications": [{"code": "ACET001", "name": "Acetaminophen"}],
+    }
+
+    assert encoding.loads_doc(encoding.dumps(doc)) == doc
+
+
+def test_aware_dates_are_encoded_as_epoch_integers():
+    encoded = json.loads(encoding.dumps({"created_date": AWARE_DATE}))
+
+    assert encoded == {"created_date": 1682935200123456}
+
+
+def test_legacy_tagged_documents_are_decoded():
+    legacy_doc = {
+        "created_date": "{TinyDate}:2023-05-01T10:00:00",
+        "task_ids": '{TinySet}:["t1"]',
+    }
+
+    assert encoding.decode_doc(legacy_doc) == {
+        "created_date": NAIVE_DATE,
+        "task_ids": {"t1"},
+    }
+
+
+def test_migrate_db_file(tmp_path):
+    db_file = tmp_path / "db.json"
+    db_file.write_text(
+        json.dumps(
+            {
+                "Tasks": {
+                    "1": {
+                        "id": "t1",
+                        "created_date": "{TinyDate}:2023-05-01T10:00:00+00:00",
+                    }
+                }
+            }
+        )
+    )
+
+    encoding.migrate_db_file(db_file)
+
+    assert json.loads(db_file.read_text()) == {
+        "Tasks": {"1": {"id": "t1", "created_date": 1682935200000000}}
+    }
+
+
+def test_clinic_json_storage_reads_legacy_files(tmp_path):
+    db_file = tmp_path / "db.json"
+    db_file.write_text(
+        json.dumps({"Tasks": {"1": {"created_date": "{TinyDate}:2023-05-01T10:00:00"}}})
+    )
+    storage = db.ClinicJSONStorage(str(db_file))
+
+    assert storage.read() == {"Tasks": {"1": {"created_date": NAIVE_DATE}}}
+    storage.write(storage.read())
+    assert '"created_date":"2023-05-01T10:00:00"' in db_file.read_text()
+    storage.close()
@@ -0,0 +1,172 @@
+from contextlib import ExitStack
+
+import pytest
+
+from clinic_manager import ClinicManager
+from db.archive import ArchivingStorage
+from db.bloom import OpenRequestsFilter
+from db.cache import OpenRequestsCache
+from db.db_sqlite import SQLiteStorage
+from db.sharding import ShardedStorage, shard_for
+from db.tracing import TracingStorage
+from main import load_all_inputs
+from models import TaskInput
+from parallel_clinic_manager import ParallelClinicManager, SQLiteShardStorageFactory
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+from tests.utils import create_task_doc
+
+SHARD_COUNT = 3
+
+
+@pytest.fixture
+def storage():
+    """Fixture providing a storage of 3 traced in-memory SQLite shards."""
+    return ShardedStorage(
+        [TracingStorage(SQLiteStorage(":memory:")) for _ in range(SHARD_COUNT)]
+    )
+
+
+def queried_shards(storage, function):
+    """Returns the shards that function(storage) issued operations to."""
+    with ExitStack() as stack:
+        traces = [stack.enter_context(shard.update()) for shard in storage.shards]
+        function(storage)
+    return {shard for shard, trace in enumerate(traces) if trace.records}
+
+
+def test_documents_are_written_to_the_shard_of_their_patient(storage):
+    patient_ids = [f"patient{i}" for i in range(10)]
+    storage.write_batch(
+        [
+            create_task_doc(f"t{i}", patient_id=patient_id)
+            for i, patient_id in enumerate(patient_ids)
+        ],
+        [],
+    )
+
+    for shard, shard_storage in enumerate(storage.shards):
+        assert {d["patient_id"] for d in shard_storage.search_tasks()} == {
+            patient_id
+            for patient_id in patient_ids
+            if shard_for(patient_id, SHARD_COUNT) == shard
+        }
+    assert len(storage.search_tasks()) == 10
+    assert [d["id"] for d in storage.search_tasks(patient_ids={"patient3"})] == ["t3"]
+
+
+def test_lookups_only_query_the_shards_of_their_patients(storage):
+    storage.upsert_tasks([create_task_doc("t1", patient_id="patient1")])
+    shard = shard_for("patient1", SHARD_COUNT)
+
+    assert queried_shards(
+        storage, lambda s: s.search_tasks(patient_ids={"patient1"})
+    ) == {shard}
+    assert queried_shards(storage, lambda s: s.get_tasks({"t1"})) == {0, 1, 2}
+    assert queried_shards(
+        storage, lambda s: s.for_patients({"patient1"}).get_tasks({"t1"})
+    ) == {shard}
+    assert storage.for_patients({"patient1"}).get_tasks({"t1"}) == [
+        create_task_doc("t1", patient_id="patient1")
+    ]
+
+
+@pytest.mark.parametrize(
+    "service_cls", [PerPatientRequestService, DepartmentPatientRequestService]
+)
+def test_task_processing_on_shards_matches_a_single_storage(storage, service_cls):
+    single_storage = SQLiteStorage(":memory:")
+
+    for s in (storage, single_storage):
+        clinic_manager = ClinicManager(service_cls(storage=s))
+        for task_input in load_all_inputs():
+            clinic_manager.process_tasks_update(task_input)
+
+    assert sorted(
+        (r["patient_id"], r["assigned_to"], r["status"], sorted(r["task_ids"]))
+        for r in storage.search_patient_requests()
+    ) == sorted(
+        (r["patient_id"], r["assigned_to"], r["status"], sorted(r["task_ids"]))
+        for r in single_storage.search_patient_requests()
+    )
+
+
+@pytest.mark.parametrize(
+    "service_cls", [PerPatientRequestService, DepartmentPatientRequestService]
+)
+def test_an_update_only_touches_the_shards_of_its_patients(storage, service_cls):
+    clinic_manager = ClinicManager(service_cls(storage=storage))
+    for task_input in load_all_inputs():
+        clinic_manager.process_tasks_update(task_input)
+    # Reopens a task of a patient of the last shard, in another department
+    task = load_all_inputs()[0].tasks[0]
+    assert shard_for(task.patient_id, SHARD_COUNT) == SHARD_COUNT - 1
+    update = TaskInput(tasks=[task.model_copy(update={"assigned_to": "Radiology"})])
+
+    shards = queried_shards(
+        storage, lambda s: clinic_manager.process_tasks_update(update)
+    )
+
+    assert shards == {shard_for(task.patient_id, SHARD_COUNT)}
+
+
+def test_shards_written_by_parallel_workers_can_be_read_together(tmp_path):
+    storage_factory = SQLiteShardStorageFactory(str(tmp_path / "shard_{shard}.db"))
+    with ParallelClinicManager(
+        shard_count=SHARD_COUNT, storage_factory=storage_factory, max_workers=2
+    ) as parallel_manager:
+        for task_input in load_all_inputs():
+            parallel_manager.process_tasks_update(task_input)
+
+    storage = ShardedStorage.open(storage_factory, SHARD_COUNT)
+    patient_ids = {t.patient_id for i in load_all_inputs() for t in i.tasks}
+    assert {r["patient_id"] for r in storage.search_patient_requests()} == patient_ids
+
+
+@pytest.mark.parametrize(
+    "wrap",
+    [
+        lambda storage: storage,
+        OpenRequestsCache,
+        OpenRequestsFilter,
+        TracingStorage,
+        lambda storage: ArchivingStorage(storage, SQLiteStorage(":memory:")),
+    ],
+    ids=["sharded", "cache", "filter", "tracing", "archive"],
+)
+def test_tasks_only_move_between_patients_of_the_same_shard(storage, wrap):
+    clinic_manager = ClinicManager(
+        DepartmentPatientRequestService(storage=wrap(storage))
+    )
+    clinic_manager.process_tasks_update(load_all_inputs()[0])
+    task = load_all_inputs()[0].tasks[0]
+    shard = shard_for(task.patient_id, SHARD_COUNT)
+    other_patient_ids = [f"other{i}" for i in range(20)]
+    same_shard_patient_id = next(
+        p for p in other_patient_ids if shard_for(p, SHARD_COUNT) == shard
+    )
+    other_shard_patient_id = next(
+        p for p in other_patient_ids if shard_for(p, SHARD_COUNT) != shard
+    )
+
+    with pytest.raises(ValueError, match="another partition"):
+        clinic_manager.process_tasks_update(
+            TaskInput(
+                tasks=[task.model_copy(update={"patient_id": other_shard_patient_id})]
+            )
+        )
+    assert [d["patient_id"] for d in storage.search_tasks() if d["id"] == task.id] == [
+        task.patient_id
+    ]
+
+    clinic_manager.process_tasks_update(
+        TaskInput(tasks=[task.model_copy(update={"patient_id": same_shard_patient_id})])
+    )
+    assert [d["patient_id"] for d in storage.search_tasks() if d["id"] == task.id] == [
+        same_shard_patient_id
+    ]
+    assert [
+        r["patient_id"]
+        for r in storage.search_patient_requests(status="Open")
+        if task.id in r["task_ids"]
+    ] == [same_shard_patient_id]
@@ -0,0 +1,80 @@
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+import pytest
+
+from db import encoding
+from db.snapshot import dump_tables, load_tables
+
+
+def create_tables():
+    return {
+        "Tasks": {
+            "1": {
+                "id": "t1",
+                "updated_date": datetime(2023, 5, 1, 10, 0, tzinfo=timezone.utc),
+            }
+        },
+        "PatientRequest": {"1": {"id": "req1", "task_ids": {"t1", "t2"}}},
+    }
+
+
+def test_tables_are_written_and_read_back(tmp_path):
+    path = tmp_path / "db.snapshot"
+    dump_tables(path, create_tables())
+
+    tables = load_tables(path)
+
+    assert set(tables) == {"Tasks", "PatientRequest"}
+    assert dict(tables) == create_tables()
+
+
+def test_only_the_accessed_tables_are_decoded(tmp_path):
+    path = tmp_path / "db.snapshot"
+    dump_tables(path, create_tables())
+
+    tables = load_tables(path)
+    tables["Tasks"]["2"] = {"id": "t2"}
+    assert tables.raw_table("PatientRequest") is not None
+    with patch.object(encoding, "dumps", wraps=encoding.dumps) as mock_dumps:
+        dump_tables(path, tables)
+
+    # The requests were copied without being decoded and encoded again
+    mock_dumps.assert_called_once_with(tables["Tasks"])
+    tables = load_tables(path)
+    assert tables["PatientRequest"] == create_tables()["PatientRequest"]
+    assert tables["Tasks"]["2"] == {"id": "t2"}
+
+
+def test_empty_files_have_no_tables(tmp_path):
+    path = tmp_path / "db.snapshot"
+    path.touch()
+
+    assert load_tables(path) is None
+
+
+def test_mapping_is_closed_once_every_table_is_decoded(tmp_path):
+    path = tmp_path / "db.snapshot"
+    dump_tables(path, create_tables())
+
+    tables = load_tables(path)
+    tables["Tasks"]
+    assert tables.raw_table("PatientRequest") is not None
+    tables["PatientRequest"]
+
+    assert tables._buffer.closed
+
+
+def test_mapping_is_closed_by_close_and_dump(tmp_path):
+    path = tmp_path / "db.snapshot"
+    dump_tables(path, create_tables())
+
+    with load_tables(path) as tables:
+        pass
+    with pytest.raises(ValueError):
+        tables.raw_table("Tasks")
+
+    tables = load_tables(path)
+    dump_tables(path, tables)
+    assert tables._buffer.closed
+    assert dict(load_tables(path)) == create_tables()
@@ -0,0 +1,86 @@
+import pytest
+
+from benchmarks.data_generator import SyntheticConfig, SyntheticDataGenerator
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
+from db.tracing import QueryBudget, QueryBudgetExceeded, TracingStorage
+from main import load_all_inputs
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+
+# An update reads the stored versions of its tasks, the open tasks, the open
+# requests and (with departments) the requests of the tasks once, and writes
+# once, whatever the number of tasks
+BUDGET = QueryBudget(max_reads=4, max_writes=1, max_per_operation=1)
+
+
+@pytest.fixture
+def storage():
+    """Fixture providing a tracing storage on top of an in-memory SQLite storage."""
+    return TracingStorage(SQLiteStorage(":memory:"), budget=BUDGET)
+
+
+@pytest.mark.parametrize("incremental", [False, True])
+@pytest.mark.parametrize(
+    "service_cls", [PerPatientRequestService, DepartmentPatientRequestService]
+)
+def test_task_processing_is_within_the_query_budget(storage, service_cls, incremental):
+    if incremental:
+        # A request whose newest task closed is recomputed from its stored tasks
+        storage.budget = QueryBudget(max_reads=5, max_writes=1, max_per_operation=2)
+    clinic_manager = ClinicManager(
+        service_cls(storage=storage, incremental=incremental)
+    )
+
+    for i, task_input in enumerate(load_all_inputs(), start=1):
+        with storage.update(f"input {i}"):
+            clinic_manager.process_tasks_update(task_input)
+
+    assert len(storage.traces) == 4
+
+
+@pytest.mark.parametrize(
+    "service_cls", [PerPatientRequestService, DepartmentPatientRequestService]
+)
+def test_resent_input_is_not_written(storage, service_cls):
+    clinic_manager = ClinicManager(service_cls(storage=storage))
+    task_input = load_all_inputs()[0]
+    clinic_manager.process_tasks_update(task_input)
+
+    with storage.update("resent") as trace:
+        clinic_manager.process_tasks_update(task_input)
+
+    assert trace.writes == []
+
+
+@pytest.mark.parametrize(
+    "service_cls", [PerPatientRequestService, DepartmentPatientRequestService]
+)
+def test_synthetic_batches_are_within_the_query_budget(storage, service_cls):
+    clinic_manager = ClinicManager(service_cls(storage=storage))
+    generator = SyntheticDataGenerator(
+        SyntheticConfig(patient_count=50, open_patient_ratio=0.5, batch_count=3)
+    )
+    generator.seed(clinic_manager)
+
+    for task_input in generator.task_inputs():
+        with storage.update():
+            clinic_manager.process_tasks_update(task_input)
+
+
+def test_trace_records_the_operations(storage):
+    with storage.update("lookups") as trace:
+        storage.search_tasks(patient_ids=["patient1"], status="Open")
+        storage.get_task("t1")
+
+    assert [(r.operation, r.predicate, r.rows) for r in trace.records] == [
+        ("search_tasks", {"patient_ids": {"patient1"}, "status": "Open"}, 0),
+        ("get_task", {"id": "t1"}, 0),
+    ]
+
+
+def test_query_per_item_goes_over_the_budget(storage):
+    with pytest.raises(QueryBudgetExceeded, match="3 calls of get_task > 1"):
+        with storage.update():
+            for task_id in ("t1", "t2", "t3"):
+                storage.get_task(task_id)
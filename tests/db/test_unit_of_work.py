@@ -0,0 +1,131 @@
+from unittest.mock import Mock, patch
+
+import pytest
+
+import db.db_tinydb as db
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
+from db.unit_of_work import UnitOfWork
+from main import load_all_inputs
+from services.patient_department_request_service import DepartmentPatientRequestService
+from tests.utils import create_request_doc
+
+
+@pytest.fixture
+def storage():
+    """Fixture providing an in-memory SQLite storage."""
+    return SQLiteStorage(":memory:")
+
+
+def test_reads_see_buffered_writes(storage):
+    storage.upsert_patient_request(create_request_doc("req1"))
+    unit_of_work = UnitOfWork(storage)
+
+    with unit_of_work:
+        unit_of_work.upsert_patient_request(create_request_doc("req1", "Closed", ()))
+        unit_of_work.upsert_patient_request(create_request_doc("req2"))
+
+        assert [
+            r["id"] for r in unit_of_work.search_patient_requests(status="Open")
+        ] == ["req2"]
+        assert [
+            r["id"] for r in unit_of_work.search_patient_requests_by_task("t1")
+        ] == ["req2"]
+        assert [r["id"] for r in storage.search_patient_requests(status="Open")] == [
+            "req1"
+        ], "Nothing should be written before the unit of work ends"
+
+    assert [r["id"] for r in storage.search_patient_requests(status="Open")] == ["req2"]
+
+
+def test_writes_are_applied_with_a_single_write_batch():
+    storage = Mock()
+    unit_of_work = UnitOfWork(storage)
+
+    with unit_of_work:
+        unit_of_work.upsert_patient_request(create_request_doc("req1"))
+        unit_of_work.upsert_patient_request(create_request_doc("req1", "Closed"))
+
+    storage.upsert_patient_requests.assert_not_called()
+    storage.write_batch.assert_called_once_with(
+        task_docs=[], request_docs=[create_request_doc("req1", "Closed")]
+    )
+
+
+def test_writes_are_discarded_when_raising(storage):
+    unit_of_work = UnitOfWork(storage)
+
+    with pytest.raises(ValueError):
+        with unit_of_work:
+            unit_of_work.upsert_patient_request(create_request_doc("req1"))
+            raise ValueError()
+
+    assert storage.search_patient_requests() == []
+    assert not unit_of_work.active
+
+
+def test_process_tasks_update_writes_the_tinydb_storage_once():
+    db.clinic.drop_tables()
+    clinic_manager = ClinicManager(DepartmentPatientRequestService())
+
+    with patch.object(
+        db.clinic.storage, "write", wraps=db.clinic.storage.write
+    ) as mock_write:
+        clinic_manager.process_tasks_update(load_all_inputs()[0])
+
+    assert mock_write.call_count == 1
+    assert len(db.patient_requests) == 5
+
+
+def test_process_tasks_update_is_rolled_back_when_raising(storage):
+    clinic_manager = ClinicManager(DepartmentPatientRequestService(storage=storage))
+
+    with patch.object(
+        DepartmentPatientRequestService,
+        "_remove_tasks_from_other_patient_requests",
+        side_effect=RuntimeError(),
+    ):
+        with pytest.raises(RuntimeError):
+            clinic_manager.process_tasks_update(load_all_inputs()[0])
+
+    assert storage.search_tasks() == []
+    assert storage.search_patient_requests() == []
+
+
+def test_clinic_manager_leaves_the_given_service_storage_as_is(storage):
+    patient_request_service = DepartmentPatientRequestService(storage=storage)
+    clinic_manager = ClinicManager(patient_request_service)
+
+    assert patient_request_service.storage is storage
+    assert clinic_manager.patient_request_service.storage is clinic_manager.unit_of_work
+
+    clinic_manager.process_tasks_update(load_all_inputs()[0])
+
+    assert patient_request_service.storage is storage
+
+
+def test_deletes_are_buffered(storage):
+    storage.upsert_patient_request(create_request_doc("req1"))
+    unit_of_work = UnitOfWork(storage)
+
+    with unit_of_work:
+        unit_of_work.delete_patient_requests({"req1"})
+
+        assert unit_of_work.search_patient_requests() == []
+        assert unit_of_work.search_patient_requests_by_task("t1") == []
+        assert len(storage.search_patient_requests()) == 1
+
+    assert storage.search_patient_requests() == []
+
+
+def test_search_by_tasks_sees_buffered_writes(storage):
+    storage.upsert_patient_request(create_request_doc("req1", task_ids={"t1"}))
+    unit_of_work = UnitOfWork(storage)
+
+    with unit_of_work:
+        unit_of_work.upsert_patient_request(create_request_doc("req1", task_ids={"t3"}))
+        unit_of_work.upsert_patient_request(create_request_doc("req2", task_ids={"t2"}))
+
+        assert [
+            r["id"] for r in unit_of_work.search_patient_requests_by_tasks({"t1", "t2"})
+        ] == ["req2"]
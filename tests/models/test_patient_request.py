@@ -5,7 +5,6 @@ import pytest
 
 from models.patient_request import PatientRequest
 from models.patient_task import Medication, PatientTask
-from services.task_service import TaskService
 
 
 def create_patient_task(
@@ -105,14 +104,14 @@ def empty_patient_request():
 class TestPatientRequestMessages:
     """Test cases for the messages property of PatientRequest."""
 
-    @patch.object(TaskService, "__new__")
+    @patch("services.task_service.TaskService")
     def test_messages_property_returns_sorted_messages(
-        self, mock_task_service_new, patient_request, sample_patient_tasks
+        self, mock_task_service_cls, patient_request, sample_patient_tasks
     ):
         """Test that messages property returns messages sorted by updated_date."""
         # Arrange
         mock_task_service = Mock()
-        mock_task_service_new.return_value = mock_task_service
+        mock_task_service_cls.return_value = mock_task_service
         mock_task_service.get_tasks_by_ids.return_value = sample_patient_tasks
 
         # Act
@@ -125,14 +124,14 @@ class TestPatientRequestMessages:
             {"task1", "task2", "task3"}
         )
 
-    @patch.object(TaskService, "__new__")
+    @patch("services.task_service.TaskService")
     def test_messages_property_with_empty_task_ids(
-        self, mock_task_service_new, empty_patient_request
+        self, mock_task_service_cls, empty_patient_request
     ):
         """Test messages property when task_ids is empty."""
         # Arrange
         mock_task_service = Mock()
-        mock_task_service_new.return_value = mock_task_service
+        mock_task_service_cls.return_value = mock_task_service
         mock_task_service.get_tasks_by_ids.return_value = []
 
         # Act
@@ -146,14 +145,14 @@ class TestPatientRequestMessages:
 class TestPatientRequestMedications:
     """Test cases for the medications property of PatientRequest."""
 
-    @patch.object(TaskService, "__new__")
+    @patch("services.task_service.TaskService")
     def test_medications_property_returns_all_medications(
-        self, mock_task_service_new, patient_request, sample_patient_tasks
+        self, mock_task_service_cls, patient_request, sample_patient_tasks
     ):
         """Test that medications property returns all medications from all tasks."""
         # Arrange
         mock_task_service = Mock()
-        mock_task_service_new.return_value = mock_task_service
+        mock_task_service_cls.return_value = mock_task_service
         mock_task_service.get_tasks_by_ids.return_value = sample_patient_tasks
 
         # Act
@@ -170,14 +169,14 @@ class TestPatientRequestMedications:
             {"task1", "task2", "task3"}
         )
 
-    @patch.object(TaskService, "__new__")
+    @patch("services.task_service.TaskService")
     def test_medications_property_with_empty_task_ids(
-        self, mock_task_service_new, empty_patient_request
+        self, mock_task_service_cls, empty_patient_request
     ):
         """Test medications property when task_ids is empty."""
         # Arrange
         mock_task_service = Mock()
-        mock_task_service_new.return_value = mock_task_service
+        mock_task_service_cls.return_value = mock_task_service
         mock_task_service.get_tasks_by_ids.return_value = []
 
         # Act
@@ -231,3 +230,78 @@ class TestPatientRequestModelValidation:
         assert patient_request.assigned_to == "Primary"
         assert patient_request.pharmacy_id == expected_pharmacy_id
         assert patient_request.task_ids == expected_task_ids
+
+
+class TestPatientRequestTasksFetching:
+    """Test cases for how PatientRequest fetches the tasks of its properties."""
+
+    @patch("services.task_service.TaskService")
+    def test_properties_fetch_the_tasks_once(
+        self, mock_task_service_cls, patient_request, sample_patient_tasks
+    ):
+        """Test that reading both properties fetches the tasks a single time."""
+        # Arrange
+        mock_task_service = Mock()
+        mock_task_service_cls.return_value = mock_task_service
+        mock_task_service.get_tasks_by_ids.return_value = sample_patient_tasks
+
+        # Act
+        patient_request.messages
+        patient_request.medications
+
+        # Assert
+        mock_task_service.get_tasks_by_ids.assert_called_once_with(
+            {"task1", "task2", "task3"}
+        )
+
+    def test_prefetch_tasks_fetches_all_requests_tasks_at_once(
+        self, patient_request, sample_patient_tasks
+    ):
+        """Test that prefetch_tasks makes a single fetch for many requests."""
+        # Arrange
+        other_request = patient_request.model_copy(
+            update={"id": "request2", "task_ids": {"task3"}}
+        )
+        mock_task_service = Mock()
+        mock_task_service.get_tasks_by_ids.return_value = sample_patient_tasks
+
+        # Act
+        PatientRequest.prefetch_tasks(
+            [patient_request, other_request], task_service=mock_task_service
+        )
+
+        # Assert
+        mock_task_service.get_tasks_by_ids.assert_called_once_with(
+            {"task1", "task2", "task3"}
+        )
+        assert patient_request.messages == [
+            "First message",
+            "Second message",
+            "Third message",
+        ]
+        assert other_request.messages == ["Third message"]
+        assert other_request.medications == []
+
+
+class TestPatientRequestFromStorage:
+    """Test cases for building PatientRequest objects from DB documents."""
+
+    @pytest.mark.parametrize("trusted", [True, False])
+    def test_from_storage_builds_the_same_request(self, patient_request, trusted):
+        """Test that trusted and validated reads build the same request."""
+        # Act
+        loaded = PatientRequest.from_storage(patient_request.model_dump(), trusted)
+
+        # Assert
+        assert loaded == patient_request
+
+    def test_trusted_from_storage_copies_task_ids(self, patient_request):
+        """Test that changing a trusted request doesn't change the document."""
+        # Arrange
+        request_doc = patient_request.model_dump()
+
+        # Act
+        PatientRequest.from_storage(request_doc, trusted=True).task_ids.clear()
+
+        # Assert
+        assert request_doc["task_ids"] == {"task1", "task2", "task3"}
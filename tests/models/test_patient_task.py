@@ -0,0 +1,41 @@
+from datetime import datetime
+
+import pytest
+
+from models.patient_task import Medication, PatientTask
+
+
+@pytest.fixture
+def patient_task():
+    """Fixture providing a sample PatientTask with medications."""
+    return PatientTask(
+        id="task1",
+        patient_id="patient1",
+        status="Open",
+        assigned_to="Primary",
+        created_date=datetime(2023, 5, 1, 10, 0, 0),
+        updated_date=datetime(2023, 5, 2, 11, 0, 0),
+        message="First message",
+        medications=[Medication(code="ACET001", name="Acetaminophen")],
+        pharmacy_id=123,
+    )
+
+
+@pytest.mark.parametrize("trusted", [True, False])
+def test_from_storage_builds_the_same_task(patient_task, trusted):
+    """Test that trusted and validated reads build the same task, medications
+    included."""
+    loaded = PatientTask.from_storage(patient_task.model_dump(), trusted=trusted)
+
+    assert loaded == patient_task
+    assert loaded.model_dump() == patient_task.model_dump()
+    assert isinstance(loaded.medications[0], Medication)
+
+
+def test_trusted_from_storage_does_not_validate(patient_task):
+    """Test that trusted reads skip validation (so must only be used for DB data)."""
+    task_doc = {**patient_task.model_dump(), "status": "Unknown"}
+
+    assert PatientTask.from_storage(task_doc, trusted=True).status == "Unknown"
+    with pytest.raises(ValueError):
+        PatientTask.from_storage(task_doc)
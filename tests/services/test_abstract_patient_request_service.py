@@ -0,0 +1,184 @@
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
+from main import load_all_inputs
+from models import TaskInput
+from models.patient_request import PatientRequest
+from models.patient_task import PatientTask
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+from services.task_service import TaskService
+
+
+def create_task(task_id, status="Open", created_day=1, updated_day=1, pharmacy_id=1):
+    return PatientTask(
+        id=task_id,
+        patient_id="patient1",
+        status=status,
+        assigned_to="Primary",
+        created_date=datetime(2023, 5, created_day),
+        updated_date=datetime(2023, 5, updated_day),
+        message=f"message {task_id}",
+        pharmacy_id=pharmacy_id,
+    )
+
+
+@pytest.fixture
+def request_service():
+    return PerPatientRequestService(storage=SQLiteStorage(":memory:"), incremental=True)
+
+
+@pytest.fixture
+def existing_request(request_service):
+    """Fixture providing a request with task1 (oldest) and task2 (newest), both
+    stored in the DB."""
+    tasks = [
+        create_task("task1", created_day=1, updated_day=2),
+        create_task("task2", created_day=2, updated_day=3, pharmacy_id=2),
+    ]
+    TaskService(storage=request_service.storage).updates_tasks(tasks)
+    return request_service.to_patient_request("patient1", tasks)
+
+
+def test_incremental_update_does_not_read_other_tasks(
+    request_service, existing_request
+):
+    with patch.object(TaskService, "get_tasks_by_ids") as mock_get_tasks:
+        patient_request = request_service.to_patient_request_incremental(
+            "patient1",
+            existing_request,
+            [create_task("task3", created_day=4, updated_day=5, pharmacy_id=3)],
+        )
+
+    mock_get_tasks.assert_not_called()
+    assert patient_request.task_ids == {"task1", "task2", "task3"}
+    assert patient_request.newest_task_id == "task3"
+    assert patient_request.pharmacy_id == 3
+    assert patient_request.updated_date == datetime(2023, 5, 5)
+    assert patient_request.created_date == datetime(2023, 5, 1)
+
+
+@pytest.mark.parametrize(
+    "closed_task, expected_newest_task_id, expected_created_date",
+    [
+        (create_task("task2", "Closed", 2, 4), "task1", datetime(2023, 5, 1)),
+        (create_task("task1", "Closed", 1, 4), "task2", datetime(2023, 5, 2)),
+    ],
+    ids=["newest closed", "oldest closed"],
+)
+def test_incremental_update_recomputes_when_aggregate_task_is_closed(
+    request_service,
+    existing_request,
+    closed_task,
+    expected_newest_task_id,
+    expected_created_date,
+):
+    TaskService(storage=request_service.storage).updates_tasks([closed_task])
+
+    patient_request = request_service.to_patient_request_incremental(
+        "patient1", existing_request, [closed_task]
+    )
+
+    assert patient_request.status == "Open"
+    assert patient_request.task_ids == {expected_newest_task_id}
+    assert patient_request.newest_task_id == expected_newest_task_id
+    assert patient_request.created_date == expected_created_date
+
+
+def test_incremental_update_closes_request_when_all_tasks_are_closed(
+    request_service, existing_request
+):
+    closed_tasks = [
+        create_task("task1", "Closed", 1, 4),
+        create_task("task2", "Closed", 2, 5),
+    ]
+
+    patient_request = request_service.to_patient_request_incremental(
+        "patient1", existing_request, closed_tasks
+    )
+
+    assert patient_request == request_service.to_patient_request(
+        "patient1", closed_tasks
+    ).model_copy(update={"id": patient_request.id})
+
+
+def normalized_requests(storage):
+    """Returns the requests of storage, without their (random) ids."""
+    return sorted(
+        (
+            r["patient_id"],
+            r["assigned_to"],
+            r["status"],
+            sorted(r["task_ids"]),
+            r["created_date"],
+            r["updated_date"],
+            r["pharmacy_id"],
+        )
+        for r in storage.search_patient_requests()
+    )
+
+
+@pytest.mark.parametrize("trusted_reads", [False, True])
+@pytest.mark.parametrize(
+    "service_cls", [PerPatientRequestService, DepartmentPatientRequestService]
+)
+def test_incremental_processing_matches_full_recompute(service_cls, trusted_reads):
+    full_storage = SQLiteStorage(":memory:")
+    incremental_storage = SQLiteStorage(":memory:")
+    full_manager = ClinicManager(service_cls(storage=full_storage))
+    incremental_manager = ClinicManager(
+        service_cls(
+            storage=incremental_storage,
+            incremental=True,
+            trusted_reads=trusted_reads,
+        ),
+        trusted_reads=trusted_reads,
+    )
+
+    for task_input in load_all_inputs():
+        full_manager.process_tasks_update(task_input)
+        incremental_manager.process_tasks_update(task_input)
+
+        assert normalized_requests(incremental_storage) == normalized_requests(
+            full_storage
+        )
+
+
+@pytest.mark.parametrize("moved_task_ids", [["task2"], ["task2", "task3"]])
+def test_incremental_department_move_matches_full_recompute(moved_task_ids):
+    """Test that the request tasks move out of is recomputed from the tasks
+    it has left, rather than keeping the dates and pharmacy of a moved task."""
+    full_storage = SQLiteStorage(":memory:")
+    incremental_storage = SQLiteStorage(":memory:")
+    full_manager = ClinicManager(DepartmentPatientRequestService(storage=full_storage))
+    incremental_manager = ClinicManager(
+        DepartmentPatientRequestService(storage=incremental_storage, incremental=True)
+    )
+    tasks = [
+        create_task("task1", created_day=1, updated_day=1, pharmacy_id=1),
+        create_task("task2", created_day=2, updated_day=3, pharmacy_id=2),
+        create_task("task3", created_day=2, updated_day=2, pharmacy_id=3),
+    ]
+    moved_tasks = [
+        task.model_copy(
+            update={"assigned_to": "Radiology", "updated_date": datetime(2023, 5, 4)}
+        )
+        for task in tasks
+        if task.id in moved_task_ids
+    ]
+
+    for task_input in (TaskInput(tasks=tasks), TaskInput(tasks=moved_tasks)):
+        full_manager.process_tasks_update(task_input)
+        incremental_manager.process_tasks_update(task_input)
+
+    assert normalized_requests(incremental_storage) == normalized_requests(full_storage)
+    [primary_request] = incremental_storage.search_patient_requests(
+        assigned_to="Primary"
+    )
+    # Not the dates and pharmacy of task2
+    assert primary_request["updated_date"] < datetime(2023, 5, 3)
+    assert primary_request["pharmacy_id"] != 2
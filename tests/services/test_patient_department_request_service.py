@@ -3,7 +3,10 @@ from unittest.mock import patch
 
 import pytest
 
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
 from main import load_all_inputs
+from models import TaskInput
 from models.patient_task import Medication, PatientTask
 from services.patient_department_request_service import DepartmentPatientRequestService
 
@@ -110,7 +113,7 @@ def test_upload_changes_to_db(
     patient_key,
     expected_task_ids,
     request,
-        patient_data,
+    patient_data,
 ):
     """Test _upload_changes_to_db method with parametrized fixtures."""
     # Get test data from fixtures
@@ -149,3 +152,65 @@ def test_upload_changes_to_db(
 
 # TODO: Continue adding tests for all other methods in the DepartmentPatientRequestService class
 ...
+
+
+def test_update_requests_fetches_open_requests_once():
+    """Test that the open requests of all the groups are fetched with one query."""
+    storage = SQLiteStorage(":memory:")
+    dept_request_service = DepartmentPatientRequestService(storage=storage)
+
+    with patch.object(
+        storage, "search_patient_requests", wraps=storage.search_patient_requests
+    ) as mock_search:
+        dept_request_service.update_requests(tasks=load_all_inputs()[0].tasks)
+
+    mock_search.assert_called_once_with(
+        patient_ids={"patient1", "patient2", "patient3"}, status="Open"
+    )
+    assert len(storage.search_patient_requests(status="Open")) == 5
+
+
+def test_update_requests_only_looks_up_the_moved_tasks():
+    """Test that only the tasks that changed department are removed from the
+    requests of other departments."""
+    storage = SQLiteStorage(":memory:")
+    clinic_manager = ClinicManager(DepartmentPatientRequestService(storage=storage))
+    inputs = load_all_inputs()
+    clinic_manager.process_tasks_update(inputs[0])
+
+    with patch.object(
+        storage,
+        "search_patient_requests_by_tasks",
+        wraps=storage.search_patient_requests_by_tasks,
+    ) as mock_search:
+        # task3 moves from Radiology to Primary, the other tasks stay put
+        clinic_manager.process_tasks_update(inputs[1])
+        mock_search.assert_called_once_with({"task3"})
+
+        mock_search.reset_mock()
+        clinic_manager.process_tasks_update(inputs[3])
+        mock_search.assert_not_called()
+
+    radiology_requests = storage.search_patient_requests(
+        patient_ids={"patient3"}, assigned_to="Radiology"
+    )
+    assert [(r["status"], r["task_ids"]) for r in radiology_requests] == [
+        ("Closed", set())
+    ]
+
+
+def test_task_reassigned_to_another_patient_leaves_its_request(sample_tasks):
+    """Test that a task moved to another patient (in the same department) is
+    removed from the request of its previous patient."""
+    storage = SQLiteStorage(":memory:")
+    clinic_manager = ClinicManager(DepartmentPatientRequestService(storage=storage))
+    clinic_manager.process_tasks_update(TaskInput(tasks=sample_tasks))
+
+    reassigned_task = sample_tasks[0].model_copy(update={"patient_id": "patient2"})
+    clinic_manager.process_tasks_update(TaskInput(tasks=[reassigned_task]))
+
+    open_requests = storage.search_patient_requests(status="Open")
+    assert sorted((r["patient_id"], sorted(r["task_ids"])) for r in open_requests) == [
+        ("patient1", ["task2"]),
+        ("patient2", ["task1"]),
+    ]
@@ -0,0 +1,23 @@
+from unittest.mock import patch
+
+from db.db_sqlite import SQLiteStorage
+from main import load_all_inputs
+from services.patient_request_service import PerPatientRequestService
+
+
+def test_update_requests_fetches_open_requests_once():
+    """Test that the open requests of all the patients are fetched with one query."""
+    storage = SQLiteStorage(":memory:")
+    request_service = PerPatientRequestService(storage=storage)
+    inputs = load_all_inputs()
+    request_service.update_requests(tasks=inputs[0].tasks)
+
+    with patch.object(
+        storage, "search_patient_requests", wraps=storage.search_patient_requests
+    ) as mock_search:
+        request_service.update_requests(tasks=inputs[1].tasks)
+
+    mock_search.assert_called_once_with(
+        patient_ids={"patient1", "patient2", "patient3"}, status="Open"
+    )
+    assert len(storage.search_patient_requests()) == 3, "Requests should be updated"
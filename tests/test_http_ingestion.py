@@ -0,0 +1,207 @@
+import asyncio
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
+from http_ingestion import IngestionServer
+from main import load_all_inputs
+from models import PatientTask, TaskInput
+
+
+async def post(port: int, body: bytes, path: str = "/tasks") -> tuple[int, dict]:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: localhost\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    head, _, response_body = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(response_body)
+
+
+def serve(clinic_manager, coroutine_function, **kwargs):
+    """Runs coroutine_function(server) with a started server on a free port."""
+
+    async def run():
+        server = IngestionServer(clinic_manager, port=0, **kwargs)
+        await server.start()
+        try:
+            return await coroutine_function(server)
+        finally:
+            await server.close()
+
+    return asyncio.run(run())
+
+
+def task_input(task_id, status="Open", updated_day=1):
+    return TaskInput(
+        tasks=[
+            PatientTask(
+                id=task_id,
+                patient_id="patient1",
+                status=status,
+                assigned_to="Primary",
+                created_date=datetime(2023, 5, 1, tzinfo=timezone.utc),
+                updated_date=datetime(2023, 5, updated_day, tzinfo=timezone.utc),
+                message=f"message {task_id}",
+                pharmacy_id=1,
+            )
+        ]
+    )
+
+
+def test_concurrent_submissions_are_processed_in_one_batch():
+    storage = SQLiteStorage(":memory:")
+    clinic_manager = ClinicManager(storage=storage)
+    inputs = load_all_inputs()
+
+    async def submit_all(server):
+        return await asyncio.gather(
+            *(
+                post(server.port, each_input.model_dump_json().encode())
+                for each_input in (inputs[0], task_input("task9"))
+            )
+        )
+
+    with patch.object(
+        clinic_manager,
+        "process_tasks_update",
+        wraps=clinic_manager.process_tasks_update,
+    ) as mock_process:
+        responses = serve(clinic_manager, submit_all, tick_seconds=0.2)
+
+    assert responses == [
+        (200, {"status": "committed", "tasks": 6}),
+        (200, {"status": "committed", "tasks": 1}),
+    ]
+    mock_process.assert_called_once()
+    assert len(storage.search_tasks()) == 7
+
+
+def requests(storage):
+    return sorted(
+        (r["status"], sorted(r["task_ids"])) for r in storage.search_patient_requests()
+    )
+
+
+def test_batches_give_the_same_requests_as_the_submissions_one_by_one():
+    # task1 closes the request of patient1, and task2 starts a new one
+    task_inputs = [
+        task_input("task1"),
+        task_input("task1", status="Closed", updated_day=2),
+        task_input("task2", updated_day=3),
+    ]
+    expected_storage = SQLiteStorage(":memory:")
+    expected_clinic_manager = ClinicManager(storage=expected_storage)
+    for each_input in task_inputs:
+        expected_clinic_manager.process_tasks_update(each_input)
+
+    storage = SQLiteStorage(":memory:")
+
+    async def submit_all(server):
+        await server.submit(task_inputs[0])
+        await asyncio.gather(*(server.submit(t) for t in task_inputs[1:]))
+
+    serve(ClinicManager(storage=storage), submit_all, tick_seconds=0.2)
+
+    assert requests(storage) == requests(expected_storage)
+    assert len(requests(storage)) == 2
+
+
+def test_invalid_submissions_are_rejected():
+    storage = SQLiteStorage(":memory:")
+
+    async def submit_invalid(server):
+        return [
+            await post(server.port, b'{"tasks": [{"id": "task1"}]}'),
+            await post(server.port, b"{", path="/other"),
+        ]
+
+    invalid_input, wrong_path = serve(ClinicManager(storage=storage), submit_invalid)
+
+    assert invalid_input[0] == 400
+    assert {error["loc"][-1] for error in invalid_input[1]["error"]} >= {
+        "patient_id",
+        "status",
+    }
+    assert wrong_path[0] == 404
+    assert storage.search_tasks() == []
+
+
+def test_failed_batches_are_reported():
+    clinic_manager = ClinicManager(storage=SQLiteStorage(":memory:"))
+    body = load_all_inputs()[0].model_dump_json().encode()
+
+    with patch.object(
+        clinic_manager, "process_tasks_update", side_effect=RuntimeError("DB down")
+    ):
+        status, response = serve(clinic_manager, lambda server: post(server.port, body))
+
+    assert status == 500
+    assert "DB down" in response["error"]
+
+
+def test_submissions_of_a_failed_batch_get_their_own_outcome():
+    storage = SQLiteStorage(":memory:")
+    clinic_manager = ClinicManager(storage=storage)
+    process_tasks_update = clinic_manager.process_tasks_update
+
+    def fail_on_bad_task(task_input):
+        if any(task.id == "bad" for task in task_input.tasks):
+            raise RuntimeError("Bad task")
+        process_tasks_update(task_input)
+
+    async def submit_all(server):
+        return await asyncio.gather(
+            *(
+                post(server.port, each_input.model_dump_json().encode())
+                for each_input in (task_input("task1"), task_input("bad"))
+            )
+        )
+
+    with patch.object(
+        clinic_manager, "process_tasks_update", side_effect=fail_on_bad_task
+    ) as mock_process:
+        responses = serve(clinic_manager, submit_all, tick_seconds=0.2)
+
+    assert responses[0] == (200, {"status": "committed", "tasks": 1})
+    assert responses[1][0] == 500
+    assert "Bad task" in responses[1][1]["error"]
+    # The batch, and then each submission
+    assert mock_process.call_count == 3
+    assert [t["id"] for t in storage.search_tasks()] == ["task1"]
+
+
+def test_close_waits_for_the_batch_in_progress():
+    storage = SQLiteStorage(":memory:")
+    clinic_manager = ClinicManager(storage=storage)
+    process_tasks_update = clinic_manager.process_tasks_update
+    started = threading.Event()
+
+    def slow_process_tasks_update(task_input):
+        started.set()
+        time.sleep(0.2)
+        process_tasks_update(task_input)
+
+    async def run():
+        server = IngestionServer(clinic_manager, port=0, tick_seconds=0.01)
+        await server.start()
+        submitted = asyncio.create_task(server.submit(task_input("task1")))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        await server.close()
+        return submitted
+
+    with patch.object(
+        clinic_manager, "process_tasks_update", side_effect=slow_process_tasks_update
+    ):
+        submitted = asyncio.run(run())
+
+    assert submitted.done() and submitted.result() is None
+    assert [t["id"] for t in storage.search_tasks()] == ["task1"]
@@ -0,0 +1,193 @@
+import queue
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
+from ingestion import IngestionService
+from main import load_all_inputs
+from models import TaskInput
+
+
+@pytest.fixture
+def storage():
+    """Fixture providing an in-memory SQLite storage."""
+    return SQLiteStorage(":memory:")
+
+
+def write_spool(spool_dir, task_inputs):
+    spool_dir.mkdir(exist_ok=True)
+    for i, task_input in enumerate(task_inputs, start=1):
+        (spool_dir / f"input_{i:03}.json").write_text(task_input.model_dump_json())
+
+
+def open_requests(storage):
+    return sorted(
+        (r["patient_id"], sorted(r["task_ids"]))
+        for r in storage.search_patient_requests(status="Open")
+    )
+
+
+def test_spool_files_are_processed_in_windows_and_checkpointed(tmp_path, storage):
+    spool_dir = tmp_path / "spool"
+    write_spool(spool_dir, load_all_inputs())
+    service = IngestionService(
+        ClinicManager(storage=storage), spool_dir=spool_dir, max_batch_inputs=3
+    )
+
+    assert service.process_window(wait=False) == 3
+    assert sorted(p.name for p in (spool_dir / "processed").iterdir()) == [
+        "input_001.json",
+        "input_002.json",
+        "input_003.json",
+    ]
+    assert service.process_window(wait=False) == 1
+    assert service.process_window(wait=False) == 0
+
+    expected_storage = SQLiteStorage(":memory:")
+    clinic_manager = ClinicManager(storage=expected_storage)
+    for task_input in load_all_inputs():
+        clinic_manager.process_tasks_update(task_input)
+    assert open_requests(storage) == open_requests(expected_storage)
+
+    # A restarted service doesn't process the checkpointed files again
+    restarted_service = IngestionService(
+        ClinicManager(storage=storage), spool_dir=spool_dir
+    )
+    assert restarted_service.process_window(wait=False) == 0
+
+
+def test_windows_are_limited_by_task_count(tmp_path, storage):
+    spool_dir = tmp_path / "spool"
+    write_spool(spool_dir, load_all_inputs())
+    service = IngestionService(
+        ClinicManager(storage=storage), spool_dir=spool_dir, max_batch_tasks=10
+    )
+
+    # The first two inputs have 6 and 5 tasks
+    assert service.process_window(wait=False) == 2
+
+
+def test_invalid_spool_files_are_set_aside(tmp_path, storage):
+    spool_dir = tmp_path / "spool"
+    write_spool(spool_dir, load_all_inputs()[:1])
+    (spool_dir / "input_000.json").write_text('{"tasks": [{"id": "task1"}]}')
+    (spool_dir / "input_999.json.tmp").write_text("{")
+    service = IngestionService(ClinicManager(storage=storage), spool_dir=spool_dir)
+
+    assert service.process_window(wait=False) == 1
+    assert [p.name for p in (spool_dir / "failed").iterdir()] == ["input_000.json"]
+    assert (spool_dir / "input_999.json.tmp").exists()
+
+
+def test_submit_blocks_while_the_queue_is_full(storage):
+    service = IngestionService(ClinicManager(storage=storage), max_queue_size=1)
+    service.submit(load_all_inputs()[0])
+
+    with pytest.raises(queue.Full):
+        service.submit(load_all_inputs()[1], timeout=0.01)
+
+
+def test_run_processes_queued_inputs_until_stopped(storage):
+    service = IngestionService(
+        ClinicManager(storage=storage), max_wait_seconds=0.01, poll_interval=0.01
+    )
+    thread = threading.Thread(target=service.run)
+    thread.start()
+
+    for task_input in load_all_inputs():
+        service.submit(task_input)
+    service.stop()
+    thread.join(timeout=5)
+
+    assert not thread.is_alive()
+    assert len(storage.search_tasks()) == 8
+    assert service.queue.empty()
+    assert service.process_window(wait=False) == 0
+
+
+def test_stop_leaves_the_unread_spool_files(tmp_path, storage):
+    spool_dir = tmp_path / "spool"
+    inputs = load_all_inputs()
+    write_spool(spool_dir, inputs[:2])
+    service = IngestionService(ClinicManager(storage=storage), spool_dir=spool_dir)
+    service.submit(inputs[2])
+
+    service.stop()
+    service.run()
+
+    # Only the queued input is processed
+    assert service.queue.empty()
+    assert not list((spool_dir / "processed").iterdir())
+    assert sorted(p.name for p in spool_dir.glob("*.json")) == [
+        "input_001.json",
+        "input_002.json",
+    ]
+    assert {t["id"] for t in storage.search_tasks()} == {t.id for t in inputs[2].tasks}
+
+
+def failing(function, should_fail):
+    """Wraps function to raise instead when should_fail(*args) is true."""
+
+    def wrapper(*args, **kwargs):
+        if should_fail(*args):
+            raise RuntimeError("DB down")
+        return function(*args, **kwargs)
+
+    return wrapper
+
+
+def test_failed_windows_are_retried(tmp_path, storage):
+    spool_dir = tmp_path / "spool"
+    write_spool(spool_dir, load_all_inputs())
+    clinic_manager = ClinicManager(storage=storage)
+    service = IngestionService(
+        clinic_manager, spool_dir=spool_dir, retry_backoff_seconds=0
+    )
+    failures = iter([True, True])
+
+    with patch.object(
+        clinic_manager,
+        "process_tasks_update",
+        wraps=failing(
+            clinic_manager.process_tasks_update,
+            lambda task_input: next(failures, False),
+        ),
+    ):
+        assert service.process_window(wait=False) == 4
+
+    assert len(list((spool_dir / "processed").iterdir())) == 4
+    assert not list((spool_dir / "failed").iterdir())
+    assert len(storage.search_tasks()) == 8
+
+
+def test_inputs_that_keep_failing_are_set_aside(tmp_path, storage):
+    spool_dir = tmp_path / "spool"
+    write_spool(spool_dir, load_all_inputs())
+    clinic_manager = ClinicManager(storage=storage)
+    service = IngestionService(
+        clinic_manager, spool_dir=spool_dir, retry_backoff_seconds=0
+    )
+    service.submit(TaskInput(tasks=[load_all_inputs()[3].tasks[0]]))
+
+    with patch.object(
+        clinic_manager,
+        "process_tasks_update",
+        wraps=failing(
+            clinic_manager.process_tasks_update,
+            lambda task_input: "task7" in {task.id for task in task_input.tasks},
+        ),
+    ):
+        assert service.process_window(wait=False) == 5
+
+    assert sorted(p.name for p in (spool_dir / "processed").iterdir()) == [
+        "input_001.json",
+        "input_002.json",
+        "input_003.json",
+    ]
+    failed_names = sorted(p.name for p in (spool_dir / "failed").iterdir())
+    assert failed_names[0] == "input_004.json"
+    assert failed_names[1].startswith("queued_")
+    assert len(storage.search_tasks()) == 7
@@ -0,0 +1,171 @@
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
+from main import load_all_inputs
+from metrics import (
+    InMemorySink,
+    NullSink,
+    get_metrics,
+    set_metrics,
+    to_prometheus_text,
+)
+from models import PatientTask, TaskInput
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+
+
+@pytest.fixture
+def sink():
+    """Fixture providing an in-memory sink, used as the metrics sink."""
+    in_memory_sink = InMemorySink()
+    set_metrics(in_memory_sink)
+    yield in_memory_sink
+    set_metrics(None)
+
+
+@pytest.mark.parametrize(
+    "service_cls, expected_counters, service_stages",
+    [
+        (
+            PerPatientRequestService,
+            {
+                "tasks_processed": 16,
+                "tasks_unchanged": 0,
+                "tasks_coalesced": 0,
+                "requests_created": 4,
+                "requests_updated": 1,
+                "requests_unchanged": 1,
+                "requests_closed": 3,
+            },
+            set(),
+        ),
+        (
+            DepartmentPatientRequestService,
+            {
+                "tasks_processed": 16,
+                "tasks_unchanged": 0,
+                "tasks_coalesced": 0,
+                "requests_created": 6,
+                "requests_updated": 2,
+                "requests_unchanged": 1,
+                "requests_closed": 5,
+                "tasks_moved": 2,
+            },
+            {"get_patient_requests_by_tasks", "remove_tasks_from_other_requests"},
+        ),
+    ],
+)
+def test_task_processing_metrics(sink, service_cls, expected_counters, service_stages):
+    clinic_manager = ClinicManager(service_cls(storage=SQLiteStorage(":memory:")))
+
+    for task_input in load_all_inputs():
+        clinic_manager.process_tasks_update(task_input)
+
+    assert sink.counters == expected_counters
+    assert (
+        set(sink.stages)
+        == {
+            "process_tasks_update",
+            "updates_tasks",
+            "get_open_tasks",
+            "update_requests",
+            "group_tasks",
+            "get_open_patient_requests",
+            "build_patient_requests",
+            "write_batch",
+        }
+        | service_stages
+    )
+    assert sink.stages["process_tasks_update"].count == 4
+
+
+def task_input(status="Open", assigned_to="Primary", updated_day=1):
+    return TaskInput(
+        tasks=[
+            PatientTask(
+                id="task1",
+                patient_id="patient1",
+                status=status,
+                assigned_to=assigned_to,
+                created_date=datetime(2023, 5, 1),
+                updated_date=datetime(2023, 5, updated_day),
+                message="message",
+                pharmacy_id=1,
+            )
+        ]
+    )
+
+
+def test_rolled_back_updates_are_not_counted(sink):
+    clinic_manager = ClinicManager(
+        DepartmentPatientRequestService(storage=SQLiteStorage(":memory:"))
+    )
+
+    with patch.object(SQLiteStorage, "write_batch", side_effect=RuntimeError()):
+        with pytest.raises(RuntimeError):
+            clinic_manager.process_tasks_update(load_all_inputs()[0])
+
+    assert sink.counters == {"tasks_coalesced": 0}
+
+
+def test_requests_are_counted_once_by_their_final_state(sink):
+    clinic_manager = ClinicManager(
+        PerPatientRequestService(storage=SQLiteStorage(":memory:"))
+    )
+
+    # The request is created closed
+    clinic_manager.process_tasks_update(task_input(status="Closed"))
+
+    assert sink.counters["requests_created"] == 1
+    assert "requests_closed" not in sink.counters
+
+
+def test_reopened_tasks_are_not_counted_as_moved(sink):
+    clinic_manager = ClinicManager(
+        DepartmentPatientRequestService(storage=SQLiteStorage(":memory:"))
+    )
+    clinic_manager.process_tasks_update(task_input())
+    clinic_manager.process_tasks_update(task_input(status="Closed", updated_day=2))
+    sink.reset()
+
+    # The task leaves its closed request for a new one
+    clinic_manager.process_tasks_update(task_input(updated_day=3))
+
+    assert sink.counters["requests_created"] == 1
+    assert sink.counters["requests_updated"] == 1
+    assert "tasks_moved" not in sink.counters
+
+    clinic_manager.process_tasks_update(
+        task_input(assigned_to="Radiology", updated_day=4)
+    )
+
+    assert sink.counters["tasks_moved"] == 1
+
+
+def test_prometheus_text(sink):
+    sink.increment("tasks_processed", 3)
+    sink.observe("updates_tasks", 0.5)
+    sink.observe("updates_tasks", 1.5)
+
+    assert to_prometheus_text(sink).splitlines() == [
+        "# TYPE clinic_tasks_processed_total counter",
+        "clinic_tasks_processed_total 3",
+        "# TYPE clinic_stage_duration_seconds summary",
+        'clinic_stage_duration_seconds_count{stage="updates_tasks"} 2',
+        'clinic_stage_duration_seconds_sum{stage="updates_tasks"} 2.0',
+        "# TYPE clinic_stage_duration_max_seconds gauge",
+        'clinic_stage_duration_max_seconds{stage="updates_tasks"} 1.5',
+    ]
+
+
+def test_metrics_are_disabled_by_default():
+    sink = get_metrics()
+
+    assert isinstance(sink, NullSink)
+    with sink.timer("stage") as timer:
+        pass
+    assert timer is None
@@ -0,0 +1,71 @@
+import pytest
+
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
+from db.sharding import shard_for
+from main import load_all_inputs
+from parallel_clinic_manager import (
+    ParallelClinicManager,
+    SQLiteShardStorageFactory,
+    partition_task_input,
+)
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+
+
+def normalized_requests(storages):
+    """Returns the requests of all storages, without their (random) ids."""
+    return sorted(
+        (
+            r["patient_id"],
+            r["assigned_to"],
+            r["status"],
+            sorted(r["task_ids"]),
+            r["created_date"],
+            r["updated_date"],
+            r["pharmacy_id"],
+        )
+        for storage in storages
+        for r in storage.search_patient_requests()
+    )
+
+
+def test_partition_task_input_keeps_patients_together():
+    task_input = load_all_inputs()[0]
+
+    shards = partition_task_input(task_input, shard_count=3)
+
+    assert sorted(t.id for s in shards for t in s.tasks) == sorted(
+        t.id for t in task_input.tasks
+    )
+    for shard, shard_input in enumerate(shards):
+        assert all(shard_for(t.patient_id, 3) == shard for t in shard_input.tasks)
+
+
+@pytest.mark.parametrize(
+    "service_cls", [PerPatientRequestService, DepartmentPatientRequestService]
+)
+def test_parallel_processing_matches_serial_processing(tmp_path, service_cls):
+    serial_storage = SQLiteStorage(":memory:")
+    serial_manager = ClinicManager(service_cls(storage=serial_storage))
+    storage_factory = SQLiteShardStorageFactory(str(tmp_path / "shard_{shard}.db"))
+
+    with ParallelClinicManager(
+        shard_count=3,
+        storage_factory=storage_factory,
+        patientRequestServiceClass=service_cls,
+        max_workers=2,
+    ) as parallel_manager:
+        for task_input in load_all_inputs():
+            serial_manager.process_tasks_update(task_input)
+            parallel_manager.process_tasks_update(task_input)
+
+            shard_storages = [storage_factory(shard) for shard in range(3)]
+            assert normalized_requests(shard_storages) == normalized_requests(
+                [serial_storage]
+            )
+
+
+def test_shard_count_does_not_default_to_the_number_of_cpus():
+    with pytest.raises(TypeError):
+        ParallelClinicManager()
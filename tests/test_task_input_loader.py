@@ -0,0 +1,160 @@
+import json
+from datetime import timedelta
+
+import pytest
+
+from benchmarks.data_generator import SyntheticConfig, SyntheticDataGenerator
+from clinic_manager import ClinicManager
+from db.db_sqlite import SQLiteStorage
+from main import cur_dir, files, load_all_inputs, load_input
+from models import TaskInput
+from services.patient_department_request_service import DepartmentPatientRequestService
+from services.patient_request_service import PerPatientRequestService
+from task_input_loader import (
+    chunk_tasks,
+    coalesce_task_inputs,
+    coalesce_tasks,
+    iter_task_inputs,
+    iter_tasks,
+)
+
+
+@pytest.mark.parametrize("file", files)
+@pytest.mark.parametrize("read_size", [7, 64 * 1024])
+def test_iter_tasks_matches_load_input(file, read_size):
+    """Test that streaming a file yields the same tasks as loading it at once,
+    including when the file is read in chunks smaller than a task."""
+    assert (
+        list(iter_tasks(cur_dir / file, read_size=read_size))
+        == load_input(cur_dir / file).tasks
+    )
+
+
+def test_iter_tasks_reads_ndjson(tmp_path):
+    tasks = load_input(cur_dir / files[0]).tasks
+    ndjson_file = tmp_path / "tasks.ndjson"
+    ndjson_file.write_text("\n".join(task.model_dump_json() for task in tasks) + "\n\n")
+
+    assert list(iter_tasks(ndjson_file)) == tasks
+
+
+@pytest.mark.parametrize(
+    "content, expected_task_count",
+    [
+        ({}, 0),
+        ({"tasks": []}, 0),
+        ({"source": {"name": "ehr", "retries": [1, 2]}, "tasks": [None]}, 1),
+    ],
+    ids=["no tasks key", "empty tasks", "other keys"],
+)
+def test_iter_tasks_json_shapes(tmp_path, content, expected_task_count):
+    task = load_input(cur_dir / files[0]).tasks[0]
+    if content.get("tasks"):
+        content["tasks"] = [task.model_dump(mode="json")]
+    json_file = tmp_path / "tasks.json"
+    json_file.write_text(json.dumps(content, indent=4))
+
+    assert list(iter_tasks(json_file, read_size=5)) == [task] * expected_task_count
+
+
+def test_iter_tasks_rejects_invalid_tasks(tmp_path):
+    json_file = tmp_path / "tasks.json"
+    json_file.write_text('{"tasks": [{"id": "task1"}]}')
+
+    with pytest.raises(ValueError):
+        list(iter_tasks(json_file))
+
+
+def test_iter_task_inputs_chunks_tasks():
+    tasks = load_input(cur_dir / files[1]).tasks
+
+    task_inputs = list(iter_task_inputs(cur_dir / files[1], chunk_size=2))
+
+    assert [len(task_input.tasks) for task_input in task_inputs] == [2, 2, 1]
+    assert [t for task_input in task_inputs for t in task_input.tasks] == tasks
+    assert list(chunk_tasks([], chunk_size=2)) == []
+
+
+def test_process_tasks_stream_processes_all_chunks():
+    storage = SQLiteStorage(":memory:")
+    clinic_manager = ClinicManager(storage=storage)
+
+    clinic_manager.process_tasks_stream(iter_tasks(cur_dir / files[0]), chunk_size=4)
+
+    assert len(storage.search_tasks()) == 6
+    assert len(storage.search_patient_requests(status="Open")) == 3
+
+
+def _stored_state(storage):
+    """The stored tasks, and the stored requests without their (random) ids."""
+    tasks = sorted(storage.search_tasks(), key=lambda task_doc: task_doc["id"])
+    requests = sorted(
+        (
+            {**request_doc, "id": None, "task_ids": sorted(request_doc["task_ids"])}
+            for request_doc in storage.search_patient_requests()
+        ),
+        key=repr,
+    )
+    return tasks, requests
+
+
+def test_coalesce_tasks_keeps_the_latest_versions():
+    task1, task2 = load_input(cur_dir / files[0]).tasks[:2]
+    task1_v2 = task1.model_copy(
+        update={"status": "Closed", "updated_date": task1.updated_date + timedelta(1)}
+    )
+    task1_v3 = task1.model_copy(update={"message": "A late, stale version"})
+
+    assert coalesce_tasks([task1, task2, task1_v2, task1_v3]) == [task1_v2, task2]
+
+
+def test_coalesce_task_inputs_merges_patients_in_order():
+    inputs = load_all_inputs()
+    task7 = inputs[3].tasks[0]
+    task7_v2 = task7.model_copy(update={"message": "Updated"})
+
+    task_inputs = list(
+        coalesce_task_inputs([*inputs, TaskInput(tasks=[task7_v2])], max_batches=3)
+    )
+
+    # The closed tasks (and the tasks in several departments) of a patient keep
+    # the later tasks of the patient in later inputs, and the updates of an open
+    # task are merged
+    assert [{task.id for task in task_input.tasks} for task_input in task_inputs] == [
+        {task.id for task in inputs[0].tasks},
+        {task.id for task in inputs[1].tasks},
+        {task.id for task in inputs[2].tasks},
+        {"task7"},
+    ]
+    assert task_inputs[-1].tasks == [task7_v2]
+
+
+@pytest.mark.parametrize(
+    "service_cls", [PerPatientRequestService, DepartmentPatientRequestService]
+)
+def test_queued_updates_match_processing_one_by_one(service_cls):
+    generator = SyntheticDataGenerator(
+        SyntheticConfig(
+            patient_count=20, open_patient_ratio=0.5, batch_count=12, batch_size=10
+        )
+    )
+    history = list(generator.history_batches())
+    open_tasks = generator.initial_open_tasks()
+    task_inputs = list(generator.task_inputs())
+    coalesced_inputs = list(coalesce_task_inputs(task_inputs, max_batches=4))
+    assert len(coalesced_inputs) < len(task_inputs)
+    assert sum(len(task_input.tasks) for task_input in coalesced_inputs) < 12 * 10
+
+    states = []
+    for task_inputs_to_process in (task_inputs, coalesced_inputs):
+        storage = SQLiteStorage(":memory:")
+        for task_docs, request_docs in history:
+            storage.write_batch(task_docs, request_docs)
+        clinic_manager = ClinicManager(service_cls(storage=storage))
+        clinic_manager.process_tasks_update(TaskInput(tasks=open_tasks))
+
+        for task_input in task_inputs_to_process:
+            clinic_manager.process_tasks_update(task_input)
+        states.append(_stored_state(storage))
+
+    assert states[0] == states[1]
@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from db import db_tinydb as db
 from models import PatientRequest
 from tinydb import where
@@ -11,12 +13,48 @@ def get_open_patient_requests(patient_id) -> list[dict] | None:
     if not raw_requests:
         return []
 
+    patient_requests = [PatientRequest(**request) for request in raw_requests]
+    # Fetch the tasks of all the requests at once, rather than per property
+    PatientRequest.prefetch_tasks(patient_requests)
+
     updated_requests = []
-    for request in raw_requests:
-        updated = PatientRequest(**request)
+    for updated in patient_requests:
         updated_dict = updated.model_dump()  # works with pydantic v2
         updated_dict["messages"] = updated.messages
         updated_dict["medications"] = updated.medications
         updated_requests.append(updated_dict)
 
     return updated_requests
+
+
+def create_request_doc(request_id, status="Open", task_ids=("t1",), **fields):
+    """Returns a patient request document, as the storages store it. fields
+    override the defaults (e.g. patient_id)."""
+    return {
+        "id": request_id,
+        "patient_id": "patient1",
+        "status": status,
+        "assigned_to": "Primary",
+        "created_date": datetime(2023, 5, 1, 10, 0, 0),
+        "updated_date": datetime(2023, 5, 1, 10, 0, 0),
+        "pharmacy_id": 123,
+        "task_ids": set(task_ids),
+        **fields,
+    }
+
+
+def create_task_doc(task_id, status="Open", **fields):
+    """Returns a task document, as the storages store it. fields override the
+    defaults (e.g. patient_id)."""
+    return {
+        "id": task_id,
+        "patient_id": "patient1",
+        "status": status,
+        "assigned_to": "Primary",
+        "created_date": datetime(2023, 5, 1, 10, 0, 0),
+        "updated_date": datetime(2023, 5, 1, 10, 0, 0),
+        "message": f"message {task_id}",
+        "medications": [],
+        "pharmacy_id": None,
+        **fields,
+    }